@@ -1,10 +1,33 @@
 from flask import Flask, request, jsonify
+from datetime import datetime, timedelta
+import atexit
+import click
 import os
 import json
 import dialogflow
 from twilio.rest import Client
 from twilio.twiml.messaging_response import MessagingResponse
 import logging
+from session_store import create_session_store, SessionConflict
+from catalog_loader import CatalogLoader, compile_catalog
+from models import db
+from stats_rollup import rebuild_daily_stats
+from ratings import repair_ratings
+from db_migrations import upgrade as upgrade_database
+from keyword_matcher import KeywordMatcher
+from conversation import Message, StateMachine
+from responses import ResponseRenderer, cart_lines, promotion_lines
+from search import SearchIndex
+from geo import GeoIndex, parse_location, delivery_fee
+from opening_hours import OpenNow
+from catalog_index import parse_position
+from cart import Cart
+from promotions import Pricing
+from order_writer import OrderWriter, PendingOrder, PendingLine
+from webhook_pipeline import WebhookPipeline
+from sharded_executor import ShardedExecutor, ShardQueueFull
+from fakes import FakeTwilioClient, FakeDialogflow
+from dialogflow_client import DialogflowGateway, KeywordIntentClassifier
 
 # Configuração de logging
 logging.basicConfig(level=logging.INFO)
@@ -12,56 +35,205 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
-# Carregar dados dos estabelecimentos
-with open('dados_estabelecimentos.json', 'r', encoding='utf-8') as f:
-    estabelecimentos_data = json.load(f)
+# Configuração do banco de dados (o mesmo do painel dos lojistas)
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///marketplace_bot.db')
+app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+db.init_app(app)
+
+# Origem do catálogo: 'json' (arquivo) ou 'db' (tabelas Establishment/Product)
+CATALOG_SOURCE = os.environ.get('CATALOG_SOURCE', 'json')
+CATALOG_PATH = os.environ.get('CATALOG_PATH', 'dados_estabelecimentos.json')
+CATALOG_CHECK_INTERVAL = float(os.environ.get('CATALOG_CHECK_INTERVAL', 5))  # segundos
+
+# Pedidos concluídos gravados em Order/OrderItem em lotes (uma transação por N pedidos ou T ms)
+ORDER_BATCH_SIZE = int(os.environ.get('ORDER_BATCH_SIZE', 50))
+ORDER_BATCH_MS = int(os.environ.get('ORDER_BATCH_MS', 200))
+ORDER_QUEUE_SIZE = int(os.environ.get('ORDER_QUEUE_SIZE', 10000))
+
+# Promoções ativas recarregadas no máximo a cada N segundos (e logo após alterações no painel)
+PROMOTIONS_CHECK_INTERVAL = float(os.environ.get('PROMOTIONS_CHECK_INTERVAL', 30))  # segundos
+
+flow_registry = None
+order_writer = None
+promotion_engine = None
+if CATALOG_SOURCE == 'db':
+    from db_catalog import DatabaseCatalogProvider
+    from flow_engine import FlowRegistry
+    # Menus em cache, invalidados quando produtos/estabelecimentos mudam
+    catalog_provider = DatabaseCatalogProvider(app, revalidate_interval=CATALOG_CHECK_INTERVAL)
+    # Fluxos de conversa dos lojistas (ChatFlow), compilados uma única vez
+    flow_registry = FlowRegistry(app, revalidate_interval=CATALOG_CHECK_INTERVAL)
+    # Só com o catálogo do banco os ids da sacola são ids de Establishment/Product
+    order_writer = OrderWriter(
+        app,
+        batch_size=ORDER_BATCH_SIZE,
+        flush_interval=ORDER_BATCH_MS / 1000,
+        max_queue=ORDER_QUEUE_SIZE
+    )
+    atexit.register(order_writer.shutdown, 5)
+    # As promoções referem-se a ids de Product, então só valem com o catálogo do banco
+    from promotions import PromotionEngine
+    promotion_engine = PromotionEngine(app, revalidate_interval=PROMOTIONS_CHECK_INTERVAL)
+else:
+    # Verifica se o arquivo de dados existe (antes do CatalogLoader, que o lê logo)
+    if __name__ == '__main__' and not os.path.exists(CATALOG_PATH):
+        logger.warning("Arquivo de dados não encontrado. Criando dados de exemplo...")
+        # Copia o arquivo de dados do diretório raiz
+        import shutil
+        try:
+            shutil.copy('/home/ubuntu/dados_estabelecimentos.json', CATALOG_PATH)
+            logger.info("Arquivo de dados copiado com sucesso.")
+        except Exception as e:
+            logger.error(f"Erro ao copiar arquivo de dados: {e}")
+            # Cria um arquivo de dados mínimo
+            with open(CATALOG_PATH, 'w', encoding='utf-8') as f:
+                json.dump({"pizzarias": []}, f)
+    # O catálogo é recarregado automaticamente quando o arquivo muda
+    catalog_provider = CatalogLoader(CATALOG_PATH, check_interval=CATALOG_CHECK_INTERVAL)
+
+def current_catalog():
+    """
+    Retorna o índice do snapshot atual do catálogo
+    """
+    return catalog_provider.current().index
+
+def cart_pricing(cart, catalog):
+    """
+    Preço da sacola com as promoções ativas (sem descontos no catálogo JSON)
+    """
+    if promotion_engine is None:
+        return Pricing(cart.subtotal)
+    return promotion_engine.price(cart, catalog)
+
+# Listas de categorias, estabelecimentos e menus pré-renderizadas por versão do catálogo
+renderer = ResponseRenderer()
+
+# Pesquisa de produtos em todo o catálogo, a partir do estado inicial
+search_index = SearchIndex()
+SEARCH_MAX_RESULTS = int(os.environ.get('SEARCH_MAX_RESULTS', 5))
+# No menu, um nome aproximado só é sugerido ("Você quis dizer...?") se o item tiver esta fração das palavras
+ITEM_SUGGESTION_MIN_COVERAGE = float(os.environ.get('ITEM_SUGGESTION_MIN_COVERAGE', 0.5))
+
+# Estabelecimentos abertos no minuto atual (horários compilados no carregamento do catálogo)
+BOT_TIMEZONE = os.environ.get('BOT_TIMEZONE', 'Africa/Maputo')
+HIDE_CLOSED_ESTABLISHMENTS = os.environ.get('HIDE_CLOSED_ESTABLISHMENTS', '1') == '1'
+open_now = OpenNow(BOT_TIMEZONE)
+
+# Estabelecimentos mais próximos de um pin e taxa de entrega pela distância
+geo_index = GeoIndex()
+NEARBY_MAX_RESULTS = int(os.environ.get('NEARBY_MAX_RESULTS', 5))
+NEARBY_MAX_DISTANCE_KM = float(os.environ.get('NEARBY_MAX_DISTANCE_KM', 20))
+DELIVERY_FLAT_FEE = int(os.environ.get('DELIVERY_FLAT_FEE', 80))  # MT, quando a distância não é conhecida
+DELIVERY_BASE_FEE = float(os.environ.get('DELIVERY_BASE_FEE', 50))  # MT
+DELIVERY_FEE_PER_KM = float(os.environ.get('DELIVERY_FEE_PER_KM', 10))  # MT
 
 # Configuração do Twilio
 TWILIO_ACCOUNT_SID = os.environ.get('TWILIO_ACCOUNT_SID', 'ACcbe863f3cb3642of222aa4f3aae6447')
 TWILIO_AUTH_TOKEN = os.environ.get('TWILIO_AUTH_TOKEN', 'ac5db5814b262d8c8ca7c199a987af49')
-twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+TWILIO_PHONE_NUMBER = os.environ.get('TWILIO_PHONE_NUMBER', '')
+if os.environ.get('TWILIO_CLIENT') == 'fake':
+    # Cliente local que apenas regista as mensagens (testes e desenvolvimento)
+    twilio_client = FakeTwilioClient()
+else:
+    twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+
+# Modo do webhook: 'sync' responde com TwiML; 'async' confirma logo e responde pela API REST
+WEBHOOK_MODE = os.environ.get('WEBHOOK_MODE', 'sync')
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', 4))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', 100))
+WEBHOOK_SYNC_TIMEOUT = float(os.environ.get('WEBHOOK_SYNC_TIMEOUT', 10))
 
 # Configuração do Dialogflow
 DIALOGFLOW_PROJECT_ID = os.environ.get('DIALOGFLOW_PROJECT_ID', 'necuro-marketplace-bot')
 DIALOGFLOW_LANGUAGE_CODE = 'pt-BR'  # Português do Brasil como padrão
+DIALOGFLOW_TIMEOUT = float(os.environ.get('DIALOGFLOW_TIMEOUT', 1.5))  # segundos
+DIALOGFLOW_CACHE_SIZE = int(os.environ.get('DIALOGFLOW_CACHE_SIZE', 1000))
+
+# Tabelas de palavras-chave (português e inglês) procuradas nas mensagens
+KEYWORD_TABLES = {
+    'greeting': ['olá', 'ola', 'oi', 'hello', 'hi', 'hey', 'bom dia', 'boa tarde', 'boa noite'],
+    'category_request': ['categorias', 'categories', 'opções', 'options', 'o que tem', 'what do you have'],
+    'positive': ['sim', 'yes', 'quero', 'want', 'mais', 'more'],
+    'negative': ['não', 'nao', 'no', 'pronto', 'finalizar', 'finish', 'done'],
+    'delivery': ['delivery', 'entrega', 'entregar', 'casa', 'home', 'deliver'],
+    'pickup': ['buscar', 'pickup', 'retirar', 'retirada', 'loja', 'store', 'pick up'],
+    'payment_method': {
+        '1': 'E-Mola',
+        '2': 'M-Pesa',
+        '3': 'M-Kesh',
+        'e-mola': 'E-Mola',
+        'm-pesa': 'M-Pesa',
+        'm-kesh': 'M-Kesh',
+        'emola': 'E-Mola',
+        'mpesa': 'M-Pesa',
+        'mkesh': 'M-Kesh'
+    },
+    'quantity': {
+        'um': 1, 'uma': 1, 'one': 1,
+        'dois': 2, 'duas': 2, 'two': 2,
+        'três': 3, 'tres': 3, 'three': 3,
+        'quatro': 4, 'four': 4,
+        'cinco': 5, 'five': 5
+    }
+}
+
+# Matcher compilado uma única vez com todas as tabelas
+intent_matcher = KeywordMatcher(KEYWORD_TABLES)
+
+# Tabela de despacho dos estados da conversa, com métricas por estado
+conversation = StateMachine()
+
+# Comandos globais, reconhecidos apenas quando são a mensagem inteira
+COMMANDS = {}
+for _command, _words in {
+    'language_en': ['english', 'inglês', 'ingles', 'en'],
+    'language_pt': ['português', 'portugues', 'portuguese', 'pt'],
+    'help': ['ajuda', 'help', 'socorro', 'sos'],
+    'cancel': ['cancelar', 'cancel', 'cancelar pedido', 'cancel order'],
+    'view_cart': ['ver sacola', 'view bag', 'carrinho', 'cart', 'sacola', 'bag']
+}.items():
+    for _word in _words:
+        COMMANDS[_word] = _command
+
+# Armazenamento do estado da conversa de cada usuário (memória ou SQLite partilhado)
+session_store = create_session_store()
+# Tentativas de aplicar a mensagem quando outro worker grava a mesma sessão ao mesmo tempo
+SESSION_SAVE_ATTEMPTS = int(os.environ.get('SESSION_SAVE_ATTEMPTS', 3))
 
-# Dicionário para armazenar o estado da conversa de cada usuário
-user_sessions = {}
+# Cliente do Dialogflow partilhado, com cache, tempo limite e classificador local de reserva
+intent_gateway = DialogflowGateway(
+    DIALOGFLOW_PROJECT_ID,
+    DIALOGFLOW_LANGUAGE_CODE,
+    FakeDialogflow() if os.environ.get('DIALOGFLOW_CLIENT') == 'fake' else dialogflow,
+    KeywordIntentClassifier(intent_matcher),
+    timeout=DIALOGFLOW_TIMEOUT,
+    cache_size=DIALOGFLOW_CACHE_SIZE
+)
 
 def detect_intent_text(session_id, text, language_code=DIALOGFLOW_LANGUAGE_CODE):
     """
-    Detecta a intenção do usuário usando o Dialogflow
+    Detecta a intenção do usuário usando o Dialogflow (ou o classificador local)
     """
-    try:
-        session_client = dialogflow.SessionsClient()
-        session = session_client.session_path(DIALOGFLOW_PROJECT_ID, session_id)
-        
-        text_input = dialogflow.types.TextInput(
-            text=text, language_code=language_code)
-        query_input = dialogflow.types.QueryInput(text=text_input)
-        
-        response = session_client.detect_intent(
-            session=session, query_input=query_input)
-        
-        return response.query_result
-    except Exception as e:
-        logger.error(f"Erro ao detectar intenção: {e}")
-        return None
+    return intent_gateway.detect(session_id, text, language_code)
 
 def get_user_session(phone_number):
     """
     Obtém ou cria uma sessão para o usuário
     """
-    if phone_number not in user_sessions:
-        user_sessions[phone_number] = {
+    session = session_store.get(phone_number)
+    if session is None:
+        session = {
             'state': 'initial',
             'selected_category': None,
             'selected_establishment': None,
-            'cart': [],
+            'cart': Cart(),
             'language': 'pt',  # Padrão para português
             'delivery_info': {}
         }
-    return user_sessions[phone_number]
+    elif not isinstance(session['cart'], Cart):
+        # Sessão lida do armazenamento partilhado: a sacola vem na forma compacta
+        session['cart'] = Cart.from_compact(session['cart'])
+    return session
 
 def handle_greeting(session):
     """
@@ -76,45 +248,113 @@ def handle_show_categories(session):
     """
     Mostra as categorias disponíveis
     """
-    categories = list(estabelecimentos_data.keys())
+    response = renderer.categories(current_catalog(), session['language'])
+    
+    session['state'] = 'selecting_category'
+    return response
+
+@conversation.state('initial')
+def handle_initial(session, message):
+    """
+    Início da conversa: saudação ou lista de categorias
+    """
+    # Verifica se é uma saudação
+    if message.matches.has('greeting'):
+        return handle_greeting(session)
+    
+    # Pin de localização: estabelecimentos mais próximos, de todas as categorias
+    if message.location:
+        return show_nearby(session, None)
+    
+    # Texto livre ('pizza quatro queijos') é pesquisado em todos os estabelecimentos
+    if not message.matches.has('category_request') and not message.text.isdigit():
+        hits = search_index.search(current_catalog(), message.text, limit=SEARCH_MAX_RESULTS)
+        if hits:
+            return show_search_results(session, hits)
+    
+    # Senão, mostra as categorias (pedidas ou não)
+    return handle_show_categories(session)
+
+def show_search_results(session, hits):
+    """
+    Lista os itens encontrados pela pesquisa, de vários estabelecimentos
+    """
+    catalog = current_catalog()
+    session['search_results'] = [[hit.establishment_id, hit.item_id] for hit in hits]
+    session['state'] = 'selecting_search_result'
     
     if session['language'] == 'pt':
-        response = "Temos uma variedade de opções para si! As nossas categorias principais são:\n\n"
-        for i, category in enumerate(categories, 1):
-            emoji = "🍔" if category == "pizzarias" or category == "restaurantes" else "🛍️" if category in ["brechos", "boutiques", "eletronicos", "ferragens"] else "🎵" if category == "discotecas" else "📦"
-            response += f"{emoji} {i}. {category.capitalize()}\n"
-        response += "\nEm qual delas está interessado(a)?"
+        response = "Encontrei estes itens:\n\n"
     else:
-        response = "We have a variety of options for you! Our main categories are:\n\n"
-        for i, category in enumerate(categories, 1):
-            emoji = "🍔" if category == "pizzarias" or category == "restaurantes" else "🛍️" if category in ["brechos", "boutiques", "eletronicos", "ferragens"] else "🎵" if category == "discotecas" else "📦"
-            response += f"{emoji} {i}. {category.capitalize()}\n"
-        response += "\nWhich one are you interested in?"
+        response = "I found these items:\n\n"
+    for position, hit in enumerate(hits, 1):
+        establishment = catalog.establishment(hit.establishment_id)
+        item = catalog.menu(hit.establishment_id).item(hit.item_id)
+        response += f"{position}. {item['nome']} - {item['preco']} MT\n   {establishment['nome']}\n"
     
-    session['state'] = 'selecting_category'
+    if session['language'] == 'pt':
+        response += "\nQual deles deseja? Digite o número, ou 'categorias' para ver todas as opções."
+    else:
+        response += "\nWhich one would you like? Type the number, or 'categories' to see all options."
     return response
 
+@conversation.state('selecting_search_result')
+def handle_search_result_selection(session, message):
+    """
+    Manipula a escolha de um dos itens encontrados pela pesquisa
+    """
+    catalog = current_catalog()
+    results = session.get('search_results') or []
+    position = parse_position(message.text, len(results))
+    
+    if position is None:
+        if message.matches.has('category_request'):
+            session.pop('search_results', None)
+            return handle_show_categories(session)
+        
+        # Uma nova pesquisa substitui a anterior
+        hits = search_index.search(catalog, message.text, limit=SEARCH_MAX_RESULTS) if not message.text.isdigit() else []
+        if hits:
+            return show_search_results(session, hits)
+        
+        if session['language'] == 'pt':
+            return "Desculpe, não encontrei esse item. Digite o número de um dos itens listados, pesquise outro produto ou escreva 'categorias'."
+        else:
+            return "Sorry, I couldn't find that item. Type the number of one of the listed items, search for another product or type 'categories'."
+    
+    establishment_id, item_id = results[position - 1]
+    establishment = catalog.establishment(establishment_id)
+    item = catalog.menu(establishment_id).item(item_id) if establishment else None
+    session.pop('search_results', None)
+    
+    if item is None:
+        session['state'] = 'initial'
+        if session['language'] == 'pt':
+            return "O catálogo foi atualizado e esse item já não está disponível. Como posso ajudar hoje?"
+        else:
+            return "The catalog was updated and that item is no longer available. How can I help you today?"
+    
+    session['selected_category'] = catalog.category_of(establishment_id)
+    session['selected_establishment'] = establishment_id
+    session['selected_item'] = item_id
+    session['state'] = 'asking_quantity'
+    
+    if session['language'] == 'pt':
+        return f"Ótima escolha! Quantos {item['nome']} de {establishment['nome']} deseja?"
+    else:
+        return f"Great choice! How many {item['nome']} from {establishment['nome']} would you like?"
+
+@conversation.state('selecting_category')
 def handle_category_selection(session, message):
     """
     Manipula a seleção de categoria
     """
-    categories = list(estabelecimentos_data.keys())
-    selected_category = None
+    catalog = current_catalog()
+    if message.location:
+        return show_nearby(session, None)
     
-    # Tenta encontrar a categoria pelo nome
-    for category in categories:
-        if category.lower() in message.lower() or category[:-1].lower() in message.lower():
-            selected_category = category
-            break
-    
-    # Se não encontrou pelo nome, tenta pelo número
-    if not selected_category:
-        try:
-            category_number = int(message.strip())
-            if 1 <= category_number <= len(categories):
-                selected_category = categories[category_number - 1]
-        except ValueError:
-            pass
+    # Tenta encontrar a categoria pelo nome (ou singular) e depois pelo número
+    selected_category = catalog.resolve_category(message.raw)
     
     if not selected_category:
         if session['language'] == 'pt':
@@ -125,43 +365,49 @@ def handle_category_selection(session, message):
     session['selected_category'] = selected_category
     session['state'] = 'showing_establishments'
     
-    establishments = estabelecimentos_data[selected_category]
-    
-    if session['language'] == 'pt':
-        response = f"Ótimo! Aqui estão os estabelecimentos disponíveis na categoria {selected_category.capitalize()}:\n\n"
-        for i, establishment in enumerate(establishments, 1):
-            response += f"{i}. {establishment['nome']} - ⭐ {establishment['avaliacao_media']}\n"
-        response += "\nQual deles gostaria de explorar?"
-    else:
-        response = f"Great! Here are the available establishments in the {selected_category.capitalize()} category:\n\n"
-        for i, establishment in enumerate(establishments, 1):
-            response += f"{i}. {establishment['nome']} - ⭐ {establishment['avaliacao_media']}\n"
-        response += "\nWhich one would you like to explore?"
+    # Só os abertos agora; a seleção por número segue a lista mostrada
+    listed_ids = open_establishment_ids(catalog, selected_category)
+    if listed_ids:
+        session['listed_establishments'] = listed_ids
+        return renderer.establishments(catalog, selected_category, session['language'], listed_ids)
     
+    session.pop('listed_establishments', None)
+    response = renderer.establishments(catalog, selected_category, session['language'])
+    if listed_ids == []:
+        if session['language'] == 'pt':
+            response = f"Neste momento os estabelecimentos de {selected_category.capitalize()} estão fechados, mas pode ver os menus e os horários.\n\n" + response
+        else:
+            response = f"The {selected_category.capitalize()} establishments are closed right now, but you can see their menus and opening hours.\n\n" + response
     return response
 
+def open_establishment_ids(catalog, category):
+    """
+    Ids dos estabelecimentos abertos da categoria ([] se estão todos fechados),
+    ou None se a lista completa deve ser mostrada
+    """
+    if not HIDE_CLOSED_ESTABLISHMENTS:
+        return None
+    open_ids = open_now.open_ids(catalog)
+    establishments = catalog.establishments(category)
+    listed_ids = [establishment['id'] for establishment in establishments if establishment['id'] in open_ids]
+    if len(listed_ids) == len(establishments):
+        return None
+    return listed_ids
+
+@conversation.state('showing_establishments')
 def handle_establishment_selection(session, message):
     """
     Manipula a seleção de estabelecimento
     """
-    category = session['selected_category']
-    establishments = estabelecimentos_data[category]
-    selected_establishment = None
+    catalog = current_catalog()
+    if message.location:
+        # Pin partilhado: os mais próximos da categoria escolhida
+        return show_nearby(session, session['selected_category'])
     
-    # Tenta encontrar o estabelecimento pelo nome
-    for establishment in establishments:
-        if establishment['nome'].lower() in message.lower():
-            selected_establishment = establishment
-            break
-    
-    # Se não encontrou pelo nome, tenta pelo número
-    if not selected_establishment:
-        try:
-            establishment_number = int(message.strip())
-            if 1 <= establishment_number <= len(establishments):
-                selected_establishment = establishments[establishment_number - 1]
-        except ValueError:
-            pass
+    # Tenta encontrar o estabelecimento pelo nome e depois pelo número
+    selected_establishment = catalog.resolve_establishment(
+        session['selected_category'], message.raw, session.get('listed_establishments')
+    )
     
     if not selected_establishment:
         if session['language'] == 'pt':
@@ -169,76 +415,196 @@ def handle_establishment_selection(session, message):
         else:
             return "Sorry, I couldn't identify that establishment. Please choose one of the listed establishments or type the corresponding number."
     
-    session['selected_establishment'] = selected_establishment
-    session['state'] = 'showing_menu'
+    return open_establishment(session, catalog, selected_establishment)
+
+def open_establishment(session, catalog, selected_establishment):
+    """
+    Entra no estabelecimento escolhido: o fluxo de conversa do lojista, se houver, senão o menu
+    """
+    # A sessão guarda apenas o id, que é resolvido pelo índice do catálogo
+    session['selected_establishment'] = selected_establishment['id']
     
-    # Verifica se o estabelecimento tem menu ou produtos
-    items = []
-    if 'menu' in selected_establishment:
-        items = selected_establishment['menu']
-    elif 'produtos' in selected_establishment:
-        items = selected_establishment['produtos']
+    # Se o lojista desenhou um fluxo de conversa, ele conduz a conversa antes do menu
+    flow = flow_registry.flow_for(selected_establishment['id']) if flow_registry else None
+    if flow is not None:
+        session['flow'] = {'id': flow.flow_id, 'version': flow.version, 'node': flow.start}
+        return enter_flow_node(session, flow.nodes[flow.start])
+    
+    return show_menu(session, catalog, selected_establishment)
+
+def show_nearby(session, category):
+    """
+    Lista os estabelecimentos mais próximos do pin partilhado (da categoria, se indicada)
+    """
+    catalog = current_catalog()
+    lat, lon = session['location']
+    open_ids = open_now.open_ids(catalog) if HIDE_CLOSED_ESTABLISHMENTS else None
+    nearby = geo_index.nearest(
+        catalog, lat, lon, limit=NEARBY_MAX_RESULTS, category=category, max_distance_km=NEARBY_MAX_DISTANCE_KM,
+        predicate=(lambda establishment: establishment['id'] in open_ids) if open_ids is not None else None
+    )
+    
+    if not nearby:
+        if session['language'] == 'pt':
+            return f"Não encontrei estabelecimentos a menos de {NEARBY_MAX_DISTANCE_KM:g} km dessa localização. Escreva 'categorias' para ver todas as opções."
+        else:
+            return f"I couldn't find establishments within {NEARBY_MAX_DISTANCE_KM:g} km of that location. Type 'categories' to see all options."
+    
+    session['nearby'] = [establishment['id'] for _, establishment in nearby]
+    session['state'] = 'showing_nearby'
     
     if session['language'] == 'pt':
-        response = f"Excelente escolha! Aqui está o menu/catálogo de {selected_establishment['nome']}:\n\n"
-        for i, item in enumerate(items, 1):
-            response += f"{i}. {item['nome']} - {item['preco']} MT\n   {item['descricao']}\n\n"
-        
-        response += f"\nLocalização: {selected_establishment['endereco']}\n"
-        response += f"Horário de funcionamento: {selected_establishment['horario_funcionamento']}\n"
-        response += f"Avaliação: ⭐ {selected_establishment['avaliacao_media']}\n\n"
-        
-        response += "O que gostaria de pedir?"
+        response = "Estes são os estabelecimentos mais próximos de si:\n\n"
     else:
-        response = f"Excellent choice! Here's the menu/catalog from {selected_establishment['nome']}:\n\n"
-        for i, item in enumerate(items, 1):
-            response += f"{i}. {item['nome']} - {item['preco']} MT\n   {item['descricao']}\n\n"
-        
-        response += f"\nLocation: {selected_establishment['endereco']}\n"
-        response += f"Opening hours: {selected_establishment['horario_funcionamento']}\n"
-        response += f"Rating: ⭐ {selected_establishment['avaliacao_media']}\n\n"
-        
-        response += "What would you like to order?"
+        response = "These are the establishments closest to you:\n\n"
+    for position, (distance, establishment) in enumerate(nearby, 1):
+        response += f"{position}. {establishment['nome']} - {distance:.1f} km - ⭐ {establishment['avaliacao_media']}\n"
     
+    if session['language'] == 'pt':
+        response += "\nQual deles gostaria de explorar?"
+    else:
+        response += "\nWhich one would you like to explore?"
     return response
 
-def handle_item_selection(session, message):
+@conversation.state('showing_nearby')
+def handle_nearby_selection(session, message):
     """
-    Manipula a seleção de item do menu/catálogo
+    Manipula a escolha de um dos estabelecimentos mais próximos
     """
-    establishment = session['selected_establishment']
+    catalog = current_catalog()
+    if message.location:
+        return show_nearby(session, None)
+    if message.matches.has('category_request'):
+        session.pop('nearby', None)
+        return handle_show_categories(session)
+    
+    nearby = session.get('nearby') or []
+    position = parse_position(message.text, len(nearby))
+    establishment = catalog.establishment(nearby[position - 1]) if position else None
     
-    # Verifica se o estabelecimento tem menu ou produtos
-    items = []
-    if 'menu' in establishment:
-        items = establishment['menu']
-    elif 'produtos' in establishment:
-        items = establishment['produtos']
+    if establishment is None:
+        if session['language'] == 'pt':
+            return "Desculpe, não consegui identificar esse estabelecimento. Por favor, digite o número de um dos estabelecimentos listados."
+        else:
+            return "Sorry, I couldn't identify that establishment. Please type the number of one of the listed establishments."
     
-    selected_item = None
+    session.pop('nearby', None)
+    session['selected_category'] = catalog.category_of(establishment['id'])
+    return open_establishment(session, catalog, establishment)
+
+def show_menu(session, catalog, selected_establishment):
+    """
+    Mostra o menu/catálogo do estabelecimento selecionado
+    """
+    session['state'] = 'showing_menu'
+    return renderer.menu(catalog, selected_establishment, session['language'])
+
+def enter_flow_node(session, node):
+    """
+    Entra num nó do fluxo do lojista: envia a sua mensagem e executa a ação
+    """
+    message = node.message(session['language'])
     
-    # Tenta encontrar o item pelo nome
-    for item in items:
-        if item['nome'].lower() in message.lower():
-            selected_item = item
-            break
+    if node.action == 'show_menu':
+        session.pop('flow', None)
+        catalog = current_catalog()
+        menu = show_menu(session, catalog, catalog.establishment(session['selected_establishment']))
+        return f"{message}\n\n{menu}" if message else menu
     
-    # Se não encontrou pelo nome, tenta pelo número
-    if not selected_item:
-        try:
-            item_number = int(message.strip())
-            if 1 <= item_number <= len(items):
-                selected_item = items[item_number - 1]
-        except ValueError:
-            pass
+    if node.action == 'end':
+        session.pop('flow', None)
+        session['state'] = 'initial'
+        session['selected_category'] = None
+        session['selected_establishment'] = None
+        return message
     
-    if not selected_item:
+    session['flow']['node'] = node.id
+    session['state'] = 'in_flow'
+    return message
+
+@conversation.state('in_flow')
+def handle_flow_step(session, message):
+    """
+    Avança no fluxo do lojista conforme a mensagem (uma consulta à tabela de transições do nó)
+    """
+    flow_state = session['flow']
+    flow = flow_registry.flow_for(session['selected_establishment']) if flow_registry else None
+    
+    # O fluxo foi editado ou desativado a meio da conversa: segue para o menu
+    if flow is None or flow.flow_id != flow_state['id'] or flow.version != flow_state['version'] \
+            or flow_state['node'] not in flow.nodes:
+        session.pop('flow', None)
+        catalog = current_catalog()
+        return show_menu(session, catalog, catalog.establishment(session['selected_establishment']))
+    
+    node = flow.nodes[flow_state['node']]
+    next_node = node.next_node(message.text)
+    if next_node is None:
+        # Nenhuma transição reconhecida e sem default: repete a pergunta
+        return node.message(session['language'])
+    return enter_flow_node(session, flow.nodes[next_node])
+
+@conversation.state('showing_menu')
+def handle_item_selection(session, message):
+    """
+    Manipula a seleção de item do menu/catálogo
+    """
+    catalog = current_catalog()
+    menu = catalog.menu(session['selected_establishment'])
+    
+    # Tenta encontrar o item pelo nome e depois pelo número
+    item_id = menu.resolve(message.raw)
+    if item_id is None and not message.text.isdigit():
+        # Nome aproximado: o melhor resultado da pesquisa neste menu
+        hits = search_index.search(catalog, message.text, limit=1, establishment_id=session['selected_establishment'])
+        if hits and hits[0].name_coverage == 1.0:
+            # Todas as palavras estão no nome do item ('calabreza', 'quatro queijo')
+            item_id = hits[0].item_id
+        elif hits and hits[0].coverage >= ITEM_SUGGESTION_MIN_COVERAGE:
+            # Só parte das palavras, ou só na descrição: pergunta antes de escolher
+            session['suggested_item'] = hits[0].item_id
+            session['state'] = 'confirming_item'
+            name = menu.item(hits[0].item_id)['nome']
+            if session['language'] == 'pt':
+                return f"Você quis dizer {name}? (sim/não)"
+            else:
+                return f"Did you mean {name}? (yes/no)"
+    
+    if item_id is None:
         if session['language'] == 'pt':
             return "Desculpe, não consegui identificar esse item. Por favor, escolha um dos itens listados ou digite o número correspondente."
         else:
             return "Sorry, I couldn't identify that item. Please choose one of the listed items or type the corresponding number."
     
-    session['selected_item'] = selected_item
+    return select_item(session, menu, item_id)
+
+@conversation.state('confirming_item')
+def handle_item_confirmation(session, message):
+    """
+    Confirma o item sugerido a partir de um nome aproximado
+    """
+    item_id = session.pop('suggested_item', None)
+    session['state'] = 'showing_menu'
+    menu = current_catalog().menu(session['selected_establishment'])
+    if menu.resolve(message.raw) is not None:
+        # Escreveu outro item do menu ('não, a calabresa')
+        return handle_item_selection(session, message)
+    if item_id is not None and menu.item(item_id) is not None and message.matches.has('positive'):
+        return select_item(session, menu, item_id)
+    if message.matches.has('negative'):
+        if session['language'] == 'pt':
+            return "Sem problema. Por favor, escolha um dos itens listados ou digite o número correspondente."
+        else:
+            return "No problem. Please choose one of the listed items or type the corresponding number."
+    # Outra resposta: trata-a como uma nova escolha do menu
+    return handle_item_selection(session, message)
+
+def select_item(session, menu, item_id):
+    """
+    Guarda o item escolhido e pergunta a quantidade
+    """
+    selected_item = menu.item(item_id)
+    session['selected_item'] = item_id
     session['state'] = 'asking_quantity'
     
     if session['language'] == 'pt':
@@ -246,30 +612,20 @@ def handle_item_selection(session, message):
     else:
         return f"Great choice! How many {selected_item['nome']} would you like?"
 
+@conversation.state('asking_quantity')
 def handle_quantity_selection(session, message):
     """
     Manipula a seleção de quantidade
     """
+    catalog = current_catalog()
     try:
         # Tenta converter para número
-        quantity = int(message.strip())
+        quantity = int(message.text)
         if quantity <= 0:
             raise ValueError("Quantidade deve ser positiva")
     except ValueError:
-        # Se não for um número, tenta interpretar palavras como "um", "dois", etc.
-        quantity_words = {
-            'um': 1, 'uma': 1, 'one': 1,
-            'dois': 2, 'duas': 2, 'two': 2,
-            'três': 3, 'tres': 3, 'three': 3,
-            'quatro': 4, 'four': 4,
-            'cinco': 5, 'five': 5
-        }
-        
-        quantity = None
-        for word, value in quantity_words.items():
-            if word in message.lower():
-                quantity = value
-                break
+        # Se não for um número, usa a primeira palavra como "um", "dois", etc.
+        quantity = message.matches.value('quantity')
         
         if quantity is None:
             if session['language'] == 'pt':
@@ -277,76 +633,49 @@ def handle_quantity_selection(session, message):
             else:
                 return "Please provide a valid quantity (a number or words like 'one', 'two', etc.)."
     
-    item = session['selected_item']
+    item = catalog.menu(session['selected_establishment']).item(session['selected_item'])
     
-    # Adiciona ao carrinho
-    cart_item = {
-        'nome': item['nome'],
-        'preco': item['preco'],
-        'quantidade': quantity,
-        'subtotal': item['preco'] * quantity
-    }
-    
-    session['cart'].append(cart_item)
+    # Adiciona ao carrinho (soma a quantidade se o item já lá estiver)
+    session['cart'].add(session['selected_establishment'], session['selected_item'], item['preco'], quantity)
     session['state'] = 'asking_more_items'
     
-    # Calcula o total do carrinho
-    total = sum(item['subtotal'] for item in session['cart'])
+    pricing = cart_pricing(session['cart'], catalog)
+    total = pricing.total
     
     if session['language'] == 'pt':
         response = f"{quantity}x {item['nome']} adicionado(s) à sua sacola. ✅\n\n"
         response += "Sua sacola atual:\n"
-        for cart_item in session['cart']:
-            response += f"• {cart_item['quantidade']}x {cart_item['nome']} - {cart_item['subtotal']} MT\n"
+        response += cart_lines(session['cart'], catalog)
+        response += promotion_lines(pricing, catalog, 'pt')
         response += f"\nTotal parcial: {total} MT\n\n"
         response += "Vai querer mais alguma coisa?"
     else:
         response = f"{quantity}x {item['nome']} added to your bag. ✅\n\n"
         response += "Your current bag:\n"
-        for cart_item in session['cart']:
-            response += f"• {cart_item['quantidade']}x {cart_item['nome']} - {cart_item['subtotal']} MT\n"
+        response += cart_lines(session['cart'], catalog)
+        response += promotion_lines(pricing, catalog, 'en')
         response += f"\nSubtotal: {total} MT\n\n"
         response += "Would you like anything else?"
     
     return response
 
+@conversation.state('asking_more_items')
 def handle_more_items_response(session, message):
     """
     Manipula a resposta sobre querer mais itens
     """
-    positive_responses = ['sim', 'yes', 'quero', 'want', 'mais', 'more']
-    negative_responses = ['não', 'nao', 'no', 'pronto', 'finalizar', 'finish', 'done']
-    
+    catalog = current_catalog()
     # Verifica se é uma resposta positiva
-    is_positive = any(word in message.lower() for word in positive_responses)
+    is_positive = message.matches.has('positive')
     
     # Verifica se é uma resposta negativa
-    is_negative = any(word in message.lower() for word in negative_responses)
+    is_negative = message.matches.has('negative')
     
     if is_positive:
         # Se o usuário quer mais itens, volta para o menu
         session['state'] = 'showing_menu'
-        establishment = session['selected_establishment']
-        
-        # Verifica se o estabelecimento tem menu ou produtos
-        items = []
-        if 'menu' in establishment:
-            items = establishment['menu']
-        elif 'produtos' in establishment:
-            items = establishment['produtos']
-        
-        if session['language'] == 'pt':
-            response = f"Claro! Aqui está novamente o menu/catálogo de {establishment['nome']}:\n\n"
-            for i, item in enumerate(items, 1):
-                response += f"{i}. {item['nome']} - {item['preco']} MT\n   {item['descricao']}\n\n"
-            response += "O que mais gostaria de pedir?"
-        else:
-            response = f"Sure! Here's the menu/catalog from {establishment['nome']} again:\n\n"
-            for i, item in enumerate(items, 1):
-                response += f"{i}. {item['nome']} - {item['preco']} MT\n   {item['descricao']}\n\n"
-            response += "What else would you like to order?"
-        
-        return response
+        establishment = catalog.establishment(session['selected_establishment'])
+        return renderer.menu(catalog, establishment, session['language'], again=True)
     
     elif is_negative:
         # Se o usuário não quer mais itens, pergunta sobre entrega
@@ -364,15 +693,13 @@ def handle_more_items_response(session, message):
         else:
             return "Sorry, I didn't understand. Would you like to order anything else? Please answer with 'yes' or 'no'."
 
+@conversation.state('asking_delivery_method')
 def handle_delivery_method(session, message):
     """
     Manipula a escolha do método de entrega
     """
-    delivery_keywords = ['delivery', 'entrega', 'entregar', 'casa', 'home', 'deliver']
-    pickup_keywords = ['buscar', 'pickup', 'retirar', 'retirada', 'loja', 'store', 'pick up']
-    
-    is_delivery = any(word in message.lower() for word in delivery_keywords)
-    is_pickup = any(word in message.lower() for word in pickup_keywords)
+    is_delivery = message.matches.has('delivery')
+    is_pickup = message.matches.has('pickup')
     
     if is_delivery:
         session['delivery_method'] = 'delivery'
@@ -398,37 +725,49 @@ def handle_delivery_method(session, message):
         else:
             return "Sorry, I didn't understand your choice. Please indicate if you prefer delivery or pickup at the establishment."
 
+@conversation.state('asking_delivery_info')
 def handle_delivery_info(session, message):
     """
     Manipula as informações de entrega
     """
-    # Armazena as informações de entrega
-    session['delivery_info'] = message
+    catalog = current_catalog()
+    # Armazena as informações de entrega (um pin partilhado também serve)
+    if message.location:
+        session['delivery_info'] = f"{message.raw} ({message.location[0]:.6f}, {message.location[1]:.6f})".strip()
+    else:
+        session['delivery_info'] = message.raw
     session['state'] = 'showing_payment_methods'
     
-    # Calcula uma taxa de entrega fictícia
-    delivery_fee = 80  # MT
+    # Taxa pela distância até à localização do usuário, se ela e a do estabelecimento forem conhecidas
+    distance = delivery_distance(session, catalog)
+    fee = session['delivery_fee'] = cart_delivery_fee(distance)
     
     # Calcula o total com a taxa de entrega
-    subtotal = sum(item['subtotal'] for item in session['cart'])
-    total = subtotal + delivery_fee
+    pricing = cart_pricing(session['cart'], catalog)
+    total = pricing.total + fee
     
     if session['language'] == 'pt':
-        response = "Obrigado pelas informações! A taxa de entrega para a sua localização é de 80 MT.\n\n"
+        if distance is None:
+            response = f"Obrigado pelas informações! A taxa de entrega para a sua localização é de {fee} MT.\n\n"
+        else:
+            response = f"Obrigado pelas informações! A taxa de entrega para a sua localização ({distance:.1f} km) é de {fee} MT.\n\n"
         response += "Resumo do seu pedido:\n"
-        for item in session['cart']:
-            response += f"• {item['quantidade']}x {item['nome']} - {item['subtotal']} MT\n"
-        response += f"Taxa de entrega - {delivery_fee} MT\n"
+        response += cart_lines(session['cart'], catalog)
+        response += promotion_lines(pricing, catalog, 'pt')
+        response += f"Taxa de entrega - {fee} MT\n"
         response += f"\nTotal a pagar: {total} MT\n\n"
         response += "Estes são os nossos métodos de pagamento:\n\n"
         response += "1. E-Mola\n2. M-Pesa\n3. M-Kesh\n\n"
         response += "Qual prefere?"
     else:
-        response = "Thank you for the information! The delivery fee to your location is 80 MT.\n\n"
+        if distance is None:
+            response = f"Thank you for the information! The delivery fee to your location is {fee} MT.\n\n"
+        else:
+            response = f"Thank you for the information! The delivery fee to your location ({distance:.1f} km) is {fee} MT.\n\n"
         response += "Your order summary:\n"
-        for item in session['cart']:
-            response += f"• {item['quantidade']}x {item['nome']} - {item['subtotal']} MT\n"
-        response += f"Delivery fee - {delivery_fee} MT\n"
+        response += cart_lines(session['cart'], catalog)
+        response += promotion_lines(pricing, catalog, 'en')
+        response += f"Delivery fee - {fee} MT\n"
         response += f"\nTotal to pay: {total} MT\n\n"
         response += "These are our payment methods:\n\n"
         response += "1. E-Mola\n2. M-Pesa\n3. M-Kesh\n\n"
@@ -436,31 +775,57 @@ def handle_delivery_info(session, message):
     
     return response
 
+def delivery_distance(session, catalog):
+    """
+    Distância (km) da localização do usuário ao estabelecimento mais distante da sacola, ou None
+    """
+    if not session.get('location'):
+        return None
+    lat, lon = session['location']
+    distances = [
+        geo_index.distance_to(catalog, establishment_id, lat, lon)
+        for establishment_id in {line.establishment_id for line in session['cart']}
+    ]
+    if not distances or None in distances:
+        return None
+    return max(distances)
+
+def cart_delivery_fee(distance):
+    """
+    Taxa de entrega pela distância, ou a taxa fixa se a distância não for conhecida
+    """
+    if distance is None:
+        return DELIVERY_FLAT_FEE
+    return delivery_fee(distance, DELIVERY_BASE_FEE, DELIVERY_FEE_PER_KM)
+
+@conversation.state('asking_pickup_time')
 def handle_pickup_time(session, message):
     """
     Manipula o horário de retirada
     """
+    catalog = current_catalog()
     # Armazena o horário de retirada
-    session['pickup_time'] = message
+    session['pickup_time'] = message.raw
     session['state'] = 'showing_payment_methods'
     
     # Calcula o total (sem taxa de entrega)
-    total = sum(item['subtotal'] for item in session['cart'])
+    pricing = cart_pricing(session['cart'], catalog)
+    total = pricing.total
     
     if session['language'] == 'pt':
-        response = f"Perfeito! Seu pedido estará pronto para retirada às {message}.\n\n"
+        response = f"Perfeito! Seu pedido estará pronto para retirada às {message.raw}.\n\n"
         response += "Resumo do seu pedido:\n"
-        for item in session['cart']:
-            response += f"• {item['quantidade']}x {item['nome']} - {item['subtotal']} MT\n"
+        response += cart_lines(session['cart'], catalog)
+        response += promotion_lines(pricing, catalog, 'pt')
         response += f"\nTotal a pagar: {total} MT\n\n"
         response += "Estes são os nossos métodos de pagamento:\n\n"
         response += "1. E-Mola\n2. M-Pesa\n3. M-Kesh\n\n"
         response += "Qual prefere?"
     else:
-        response = f"Perfect! Your order will be ready for pickup at {message}.\n\n"
+        response = f"Perfect! Your order will be ready for pickup at {message.raw}.\n\n"
         response += "Your order summary:\n"
-        for item in session['cart']:
-            response += f"• {item['quantidade']}x {item['nome']} - {item['subtotal']} MT\n"
+        response += cart_lines(session['cart'], catalog)
+        response += promotion_lines(pricing, catalog, 'en')
         response += f"\nTotal to pay: {total} MT\n\n"
         response += "These are our payment methods:\n\n"
         response += "1. E-Mola\n2. M-Pesa\n3. M-Kesh\n\n"
@@ -468,27 +833,12 @@ def handle_pickup_time(session, message):
     
     return response
 
+@conversation.state('showing_payment_methods')
 def handle_payment_method(session, message):
     """
     Manipula a escolha do método de pagamento
     """
-    payment_methods = {
-        '1': 'E-Mola',
-        '2': 'M-Pesa',
-        '3': 'M-Kesh',
-        'e-mola': 'E-Mola',
-        'm-pesa': 'M-Pesa',
-        'm-kesh': 'M-Kesh',
-        'emola': 'E-Mola',
-        'mpesa': 'M-Pesa',
-        'mkesh': 'M-Kesh'
-    }
-    
-    selected_method = None
-    for key, value in payment_methods.items():
-        if key.lower() in message.lower():
-            selected_method = value
-            break
+    selected_method = message.matches.value('payment_method')
     
     if not selected_method:
         if session['language'] == 'pt':
@@ -516,44 +866,37 @@ def handle_payment_method(session, message):
     
     details = payment_details[selected_method]
     
+    # Calcula o total (sacola com as promoções mais a taxa de entrega, se houver)
+    total = cart_pricing(session['cart'], current_catalog()).total
+    if session['delivery_method'] == 'delivery':
+        total += session.get('delivery_fee', DELIVERY_FLAT_FEE)  # Taxa de entrega
+    
     if session['language'] == 'pt':
         response = f"Escolheu {selected_method}. Estes são os dados para pagamento:\n\n"
         response += f"• Nome: {details['name']}\n"
         response += f"• Contacto: {details['contact']}\n\n"
         
-        # Calcula o total
-        if session['delivery_method'] == 'delivery':
-            subtotal = sum(item['subtotal'] for item in session['cart'])
-            total = subtotal + 80  # Taxa de entrega
-        else:
-            total = sum(item['subtotal'] for item in session['cart'])
-        
         response += f"Assim que efetuar o pagamento de {total} MT, por favor, envie-nos o print do comprovativo aqui mesmo."
     else:
         response = f"You chose {selected_method}. Here are the payment details:\n\n"
         response += f"• Name: {details['name']}\n"
         response += f"• Contact: {details['contact']}\n\n"
         
-        # Calcula o total
-        if session['delivery_method'] == 'delivery':
-            subtotal = sum(item['subtotal'] for item in session['cart'])
-            total = subtotal + 80  # Taxa de entrega
-        else:
-            total = sum(item['subtotal'] for item in session['cart'])
-        
         response += f"Once you've made the payment of {total} MT, please send us a screenshot of the receipt right here."
     
     return response
 
+@conversation.state('showing_payment_details')
 def handle_payment_proof(session, message):
     """
     Manipula o envio do comprovativo de pagamento
     """
-    # Verifica se a mensagem contém uma imagem (comprovativo)
-    has_image = 'MediaUrl' in message or 'NumMedia' in message and int(message['NumMedia']) > 0
-    
-    if has_image:
+    # Se tiver uma imagem, considera como comprovativo
+    if message.media_url:
         session['state'] = 'order_completed'
+        if order_writer and message.sender:
+            # Enviados ao OrderWriter só depois de a sessão ser gravada (ver process_message)
+            session['orders_to_submit'] = pending_orders(session, message.sender, message.media_url)
         
         if session['language'] == 'pt':
             return "Comprovativo recebido! Muito obrigado. 😊\nUm dos nossos atendentes humanos irá verificar o pagamento e confirmar o seu pedido em breve. Por favor, aguarde a confirmação."
@@ -565,136 +908,225 @@ def handle_payment_proof(session, message):
         else:
             return "Please send an image of the payment receipt so we can process your order."
 
-def process_message(phone_number, message_text, media_url=None):
+def pending_orders(session, phone_number, payment_proof_url):
+    """
+    Pedidos a gravar a partir da sacola: um por estabelecimento, com a taxa de entrega no primeiro.
+    Os brindes das promoções entram como itens a preço zero e os descontos saem do total.
+    """
+    pricing = cart_pricing(session['cart'], current_catalog())
+    lines_by_establishment = {}
+    for line in session['cart']:
+        lines_by_establishment.setdefault(line.establishment_id, []).append(
+            PendingLine(line.item_id, line.quantity, line.unit_price)
+        )
+    for establishment_id, product_id, quantity in pricing.gifts:
+        lines_by_establishment[establishment_id].append(PendingLine(product_id, quantity, 0.0))
+    
+    delivery = session.get('delivery_method') == 'delivery'
+    fee = session.get('delivery_fee', DELIVERY_FLAT_FEE) if delivery else 0  # Taxa de entrega
+    orders = []
+    for establishment_id, lines in lines_by_establishment.items():
+        subtotal = sum(line.unit_price * line.quantity for line in lines) - pricing.establishment_discount(establishment_id)
+        orders.append(PendingOrder(
+            phone_number=phone_number,
+            establishment_id=establishment_id,
+            lines=lines,
+            delivery_type=session.get('delivery_method'),
+            delivery_address=session['delivery_info'][:200] if delivery else None,  # Tamanho da coluna
+            delivery_time_preference=None if delivery else (session.get('pickup_time') or '')[:50] or None,  # Tamanho da coluna
+            delivery_fee=fee,
+            payment_method=session.get('payment_method'),
+            payment_proof_url=payment_proof_url,
+            total_amount=subtotal + fee
+        ))
+        fee = 0
+    return orders
+
+def process_message(phone_number, message_text, media_url=None, location=None):
     """
     Processa a mensagem recebida e retorna uma resposta
     """
-    session = get_user_session(phone_number)
-    
-    # Verifica se é uma mensagem para mudar o idioma
-    if message_text.lower() in ['english', 'inglês', 'ingles', 'en']:
-        session['language'] = 'en'
-        return "Language changed to English. How can I help you today?"
-    elif message_text.lower() in ['português', 'portugues', 'portuguese', 'pt']:
-        session['language'] = 'pt'
-        return "Idioma alterado para Português. Como posso ajudar hoje?"
-    
-    # Verifica se é uma mensagem de ajuda
-    if message_text.lower() in ['ajuda', 'help', 'socorro', 'sos']:
-        if session['language'] == 'pt':
-            return "Estou aqui para ajudar! Você pode dizer o que procura (ex: 'quero uma pizza', 'lojas de roupa'), pedir para ver as 'categorias', ou se estiver a meio de um pedido, pode dizer 'ver sacola' ou 'cancelar pedido'. Como posso assistir?"
-        else:
-            return "I'm here to help! You can tell me what you're looking for (e.g., 'I want a pizza', 'clothing stores'), ask to see the 'categories', or if you're in the middle of an order, you can say 'view bag' or 'cancel order'. How can I assist?"
-    
-    # Verifica se é uma mensagem para cancelar o pedido
-    if message_text.lower() in ['cancelar', 'cancel', 'cancelar pedido', 'cancel order']:
-        session['state'] = 'initial'
-        session['selected_category'] = None
-        session['selected_establishment'] = None
-        session['cart'] = []
-        
-        if session['language'] == 'pt':
-            return "Pedido cancelado. Como posso ajudar hoje?"
-        else:
-            return "Order canceled. How can I help you today?"
-    
-    # Verifica se é uma mensagem para ver o carrinho
-    if message_text.lower() in ['ver sacola', 'view bag', 'carrinho', 'cart', 'sacola', 'bag']:
-        if not session['cart']:
-            if session['language'] == 'pt':
-                return "Sua sacola está vazia. Como posso ajudar hoje?"
-            else:
-                return "Your bag is empty. How can I help you today?"
-        
-        total = sum(item['subtotal'] for item in session['cart'])
+    for attempt in range(SESSION_SAVE_ATTEMPTS):
+        session = get_user_session(phone_number)
+        response = process_session_message(session, message_text, media_url, phone_number, location)
+        orders = session.pop('orders_to_submit', None)
         
-        if session['language'] == 'pt':
-            response = "Sua sacola atual:\n"
-            for item in session['cart']:
-                response += f"• {item['quantidade']}x {item['nome']} - {item['subtotal']} MT\n"
-            response += f"\nTotal parcial: {total} MT\n\n"
-            response += "Deseja continuar com o pedido ou adicionar mais itens?"
-        else:
-            response = "Your current bag:\n"
-            for item in session['cart']:
-                response += f"• {item['quantidade']}x {item['nome']} - {item['subtotal']} MT\n"
-            response += f"\nSubtotal: {total} MT\n\n"
-            response += "Would you like to continue with the order or add more items?"
+        # Grava a sessão (renova o prazo de expiração do carrinho)
+        try:
+            session_store.save(phone_number, session)
+        except SessionConflict:
+            # Outro worker gravou esta conversa entretanto: aplica a mensagem de novo sobre a sessão atual
+            logger.warning(f"Sessão de {phone_number} alterada por outro worker, nova tentativa")
+            continue
         
+        for order in orders or ():
+            order_writer.submit(order)
         return response
     
-    # Processa a mensagem de acordo com o estado atual da conversa
-    if session['state'] == 'initial':
-        # Verifica se é uma saudação
-        greetings = ['olá', 'ola', 'oi', 'hello', 'hi', 'hey', 'bom dia', 'boa tarde', 'boa noite']
-        if any(greeting in message_text.lower() for greeting in greetings):
-            return handle_greeting(session)
-        
-        # Verifica se está pedindo categorias
-        category_requests = ['categorias', 'categories', 'opções', 'options', 'o que tem', 'what do you have']
-        if any(request in message_text.lower() for request in category_requests):
-            return handle_show_categories(session)
-        
-        # Se não for uma saudação ou pedido de categorias, tenta entender a intenção
-        # Aqui seria ideal usar o Dialogflow, mas por enquanto vamos simplificar
-        return handle_show_categories(session)
-    
-    elif session['state'] == 'selecting_category':
-        return handle_category_selection(session, message_text)
-    
-    elif session['state'] == 'showing_establishments':
-        return handle_establishment_selection(session, message_text)
-    
-    elif session['state'] == 'showing_menu':
-        return handle_item_selection(session, message_text)
-    
-    elif session['state'] == 'asking_quantity':
-        return handle_quantity_selection(session, message_text)
-    
-    elif session['state'] == 'asking_more_items':
-        return handle_more_items_response(session, message_text)
-    
-    elif session['state'] == 'asking_delivery_method':
-        return handle_delivery_method(session, message_text)
+    logger.error(f"Sessão de {phone_number} não gravada após {SESSION_SAVE_ATTEMPTS} tentativas")
+    if session['language'] == 'pt':
+        return "Desculpe, ocorreu um erro. Por favor, envie a mensagem de novo."
+    else:
+        return "Sorry, an error occurred. Please send your message again."
+
+@conversation.state('order_completed')
+def handle_order_completed(session, message):
+    """
+    Se o pedido já foi completado, reinicia a conversa
+    """
+    session['state'] = 'initial'
+    session['selected_category'] = None
+    session['selected_establishment'] = None
+    session['cart'] = Cart()
     
-    elif session['state'] == 'asking_delivery_info':
-        return handle_delivery_info(session, message_text)
+    if session['language'] == 'pt':
+        return "Seu pedido anterior foi processado. Como posso ajudar hoje?"
+    else:
+        return "Your previous order has been processed. How can I help you today?"
+
+@conversation.fallback
+def handle_unknown_state(session, message):
+    """
+    Fallback para caso o estado não seja reconhecido
+    """
+    session['state'] = 'initial'
+    if session['language'] == 'pt':
+        return "Desculpe, ocorreu um erro. Como posso ajudar hoje?"
+    else:
+        return "Sorry, an error occurred. How can I help you today?"
+
+@conversation.command('language_en')
+def handle_language_en(session, message):
+    """
+    Muda o idioma da conversa para inglês
+    """
+    session['language'] = 'en'
+    return "Language changed to English. How can I help you today?"
+
+@conversation.command('language_pt')
+def handle_language_pt(session, message):
+    """
+    Muda o idioma da conversa para português
+    """
+    session['language'] = 'pt'
+    return "Idioma alterado para Português. Como posso ajudar hoje?"
+
+@conversation.command('help')
+def handle_help(session, message):
+    """
+    Explica o que o usuário pode pedir em qualquer estado
+    """
+    if session['language'] == 'pt':
+        return "Estou aqui para ajudar! Você pode dizer o que procura (ex: 'quero uma pizza', 'lojas de roupa'), pedir para ver as 'categorias', ou se estiver a meio de um pedido, pode dizer 'ver sacola' ou 'cancelar pedido'. Como posso assistir?"
+    else:
+        return "I'm here to help! You can tell me what you're looking for (e.g., 'I want a pizza', 'clothing stores'), ask to see the 'categories', or if you're in the middle of an order, you can say 'view bag' or 'cancel order'. How can I assist?"
+
+@conversation.command('cancel')
+def handle_cancel(session, message):
+    """
+    Cancela o pedido em curso e esvazia a sacola
+    """
+    session['state'] = 'initial'
+    session['selected_category'] = None
+    session['selected_establishment'] = None
+    session['cart'] = Cart()
+    session.pop('flow', None)
+    session.pop('search_results', None)
+    session.pop('suggested_item', None)
+    session.pop('nearby', None)
     
-    elif session['state'] == 'asking_pickup_time':
-        return handle_pickup_time(session, message_text)
+    if session['language'] == 'pt':
+        return "Pedido cancelado. Como posso ajudar hoje?"
+    else:
+        return "Order canceled. How can I help you today?"
+
+@conversation.command('view_cart')
+def handle_view_cart(session, message):
+    """
+    Mostra a sacola atual com o total
+    """
+    catalog = current_catalog()
+    if not session['cart']:
+        if session['language'] == 'pt':
+            return "Sua sacola está vazia. Como posso ajudar hoje?"
+        else:
+            return "Your bag is empty. How can I help you today?"
     
-    elif session['state'] == 'showing_payment_methods':
-        return handle_payment_method(session, message_text)
+    pricing = cart_pricing(session['cart'], catalog)
+    total = pricing.total
     
-    elif session['state'] == 'showing_payment_details':
-        # Se tiver uma imagem, considera como comprovativo
-        if media_url:
-            return handle_payment_proof(session, {'MediaUrl': media_url})
-        else:
-            # Se não tiver imagem, pede novamente
-            if session['language'] == 'pt':
-                return "Por favor, envie uma imagem do comprovativo de pagamento para podermos processar o seu pedido."
-            else:
-                return "Please send an image of the payment receipt so we can process your order."
+    if session['language'] == 'pt':
+        response = "Sua sacola atual:\n"
+        response += cart_lines(session['cart'], catalog)
+        response += promotion_lines(pricing, catalog, 'pt')
+        response += f"\nTotal parcial: {total} MT\n\n"
+        response += "Deseja continuar com o pedido ou adicionar mais itens?"
+    else:
+        response = "Your current bag:\n"
+        response += cart_lines(session['cart'], catalog)
+        response += promotion_lines(pricing, catalog, 'en')
+        response += f"\nSubtotal: {total} MT\n\n"
+        response += "Would you like to continue with the order or add more items?"
     
-    elif session['state'] == 'order_completed':
-        # Se o pedido já foi completado, reinicia a conversa
+    return response
+
+def process_session_message(session, message_text, media_url=None, sender=None, location=None):
+    """
+    Aplica a mensagem à sessão do usuário e retorna a resposta
+    """
+    # Normaliza a mensagem uma única vez; as palavras-chave são procuradas só se algum handler pedir
+    message = Message(message_text, media_url, intent_matcher, sender, location)
+    
+    # O último pin partilhado fica na sessão (lista de estabelecimentos próximos e taxa de entrega)
+    if location:
+        session['location'] = list(location)
+    
+    # Comandos globais (idioma, ajuda, cancelar, ver sacola) valem em qualquer estado
+    command = COMMANDS.get(message.text)
+    if command:
+        return conversation.run_command(command, session, message)
+    
+    # O catálogo pode ter sido recarregado sem a categoria ou o estabelecimento selecionado
+    catalog = current_catalog()
+    if (session['selected_category'] is not None and session['selected_category'] not in catalog.data) \
+            or (session['selected_establishment'] is not None
+                and catalog.establishment(session['selected_establishment']) is None):
         session['state'] = 'initial'
         session['selected_category'] = None
         session['selected_establishment'] = None
-        session['cart'] = []
+        session.pop('flow', None)
         
         if session['language'] == 'pt':
-            return "Seu pedido anterior foi processado. Como posso ajudar hoje?"
+            return "O catálogo foi atualizado e esse estabelecimento já não está disponível. Como posso ajudar hoje?"
         else:
-            return "Your previous order has been processed. How can I help you today?"
+            return "The catalog was updated and that establishment is no longer available. How can I help you today?"
     
-    # Fallback para caso o estado não seja reconhecido
-    session['state'] = 'initial'
-    if session['language'] == 'pt':
-        return "Desculpe, ocorreu um erro. Como posso ajudar hoje?"
-    else:
-        return "Sorry, an error occurred. How can I help you today?"
+    # Processa a mensagem de acordo com o estado atual da conversa
+    return conversation.dispatch(session, message)
+
+def process_and_reply(phone_number, message_text, media_url=None, reply_from=None, location=None):
+    """
+    Processa a mensagem e envia a resposta pela API REST do Twilio (modo assíncrono)
+    """
+    try:
+        response_text = process_message(phone_number, message_text, media_url, location)
+    except Exception as e:
+        logger.error(f"Erro ao processar mensagem: {e}")
+        response_text = "Desculpe, ocorreu um erro. Por favor, tente novamente mais tarde."
+    
+    twilio_client.messages.create(
+        from_=reply_from or TWILIO_PHONE_NUMBER,
+        to=phone_number,
+        body=response_text
+    )
+
+# Cada telefone cai sempre no mesmo shard: as mensagens de um usuário são
+# processadas uma de cada vez, sem corridas na mesma sessão
+conversation_executor = ShardedExecutor(shards=WEBHOOK_WORKERS, max_queue=WEBHOOK_QUEUE_SIZE)
+
+webhook_pipeline = None
+if WEBHOOK_MODE == 'async':
+    webhook_pipeline = WebhookPipeline(process_and_reply, conversation_executor)
 
 @app.route('/webhook', methods=['POST'])
 def webhook():
@@ -710,8 +1142,19 @@ def webhook():
         num_media = int(request.values.get('NumMedia', 0))
         media_url = request.values.get('MediaUrl0', '') if num_media > 0 else None
         
-        # Processa a mensagem
-        response_text = process_message(phone_number, message_text, media_url)
+        # Pin de localização partilhado pelo WhatsApp
+        location = parse_location(request.values.get('Latitude'), request.values.get('Longitude'))
+        
+        if webhook_pipeline is not None:
+            # Confirma o recebimento ao Twilio já; a resposta segue pela API REST
+            webhook_pipeline.submit(phone_number, message_text, media_url, request.values.get('To'), location)
+            return str(MessagingResponse())
+        
+        # Processa a mensagem no shard do usuário e espera a resposta
+        future = conversation_executor.submit(
+            phone_number, process_message, phone_number, message_text, media_url, location
+        )
+        response_text = future.result(timeout=WEBHOOK_SYNC_TIMEOUT)
         
         # Cria a resposta
         resp = MessagingResponse()
@@ -719,6 +1162,11 @@ def webhook():
         
         return str(resp)
     
+    except ShardQueueFull:
+        # Backpressure: o Twilio volta a tentar mais tarde
+        logger.warning("Webhook sobrecarregado, pedindo nova tentativa")
+        return "", 503
+    
     except Exception as e:
         logger.error(f"Erro no webhook: {e}")
         resp = MessagingResponse()
@@ -732,21 +1180,60 @@ def health_check():
     """
     return jsonify({"status": "healthy"})
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Métricas de fila e backpressure, do Dialogflow e de cada estado da conversa
+    """
+    return jsonify({
+        "pending": conversation_executor.pending(),
+        "shards": conversation_executor.stats(),
+        "dialogflow": intent_gateway.stats(),
+        "conversation": conversation.stats(),
+        "responses": renderer.stats(),
+        "search": search_index.stats(),
+        "geo": geo_index.stats(),
+        "open_now": open_now.stats(),
+        "orders": order_writer.stats() if order_writer else None,
+        "promotions": promotion_engine.stats() if promotion_engine else None
+    })
+
+@app.cli.command('compile-catalog')
+def compile_catalog_command():
+    """
+    Gera a versão binária (msgpack) do catálogo, mais rápida de ler que o JSON em cada worker
+    """
+    binary_path = compile_catalog(CATALOG_PATH)
+    logger.info(f"Catálogo binário gerado em {binary_path}")
+
+@app.cli.command('rebuild-daily-stats')
+@click.option('--days', type=int, default=None, help='Recalcula só os últimos N dias (padrão: tudo)')
+def rebuild_daily_stats_command(days):
+    """
+    Reconstrói a tabela DailyEstablishmentStats a partir dos pedidos
+    """
+    start_day = datetime.utcnow().date() - timedelta(days=days - 1) if days else None
+    rows = rebuild_daily_stats(start_day)
+    logger.info(f"{rows} linhas de resumo diário gravadas")
+
+@app.cli.command('repair-ratings')
+def repair_ratings_command():
+    """
+    Recalcula os contadores de avaliação dos estabelecimentos a partir das avaliações aprovadas
+    """
+    with db.engine.begin() as connection:
+        fixed = repair_ratings(connection)
+    logger.info(f"{fixed} estabelecimentos com avaliações corrigidas")
+
+@app.cli.command('upgrade-db')
+def upgrade_db_command():
+    """
+    Cria as tabelas em falta e aplica as migrações pendentes (colunas e índices)
+    """
+    applied = upgrade_database()
+    logger.info(f"Migrações aplicadas: {applied or 'nenhuma'}")
+
 if __name__ == '__main__':
-    # Verifica se o arquivo de dados existe
-    if not os.path.exists('dados_estabelecimentos.json'):
-        logger.warning("Arquivo de dados não encontrado. Criando dados de exemplo...")
-        # Copia o arquivo de dados do diretório raiz
-        import shutil
-        try:
-            shutil.copy('/home/ubuntu/dados_estabelecimentos.json', 'dados_estabelecimentos.json')
-            logger.info("Arquivo de dados copiado com sucesso.")
-        except Exception as e:
-            logger.error(f"Erro ao copiar arquivo de dados: {e}")
-            # Cria um arquivo de dados mínimo
-            with open('dados_estabelecimentos.json', 'w', encoding='utf-8') as f:
-                json.dump({"pizzarias": []}, f)
-    
     # Inicia o servidor Flask
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=True)
@@ -0,0 +1,80 @@
+class CartLine:
+    """
+    Item da sacola: referência ao item do catálogo, preço unitário e quantidade
+    """
+
+    __slots__ = ('establishment_id', 'item_id', 'unit_price', 'quantity')
+
+    def __init__(self, establishment_id, item_id, unit_price, quantity):
+        self.establishment_id = establishment_id
+        self.item_id = item_id
+        self.unit_price = unit_price
+        self.quantity = quantity
+
+    @property
+    def subtotal(self):
+        return self.unit_price * self.quantity
+
+
+class Cart:
+    """
+    Sacola do usuário com o subtotal mantido a cada alteração.
+
+    O nome do item não é guardado: vem do catálogo quando a sacola é
+    mostrada. O preço fica fixado no momento em que o item foi adicionado.
+    priced guarda o preço com promoções de cada estabelecimento (ver
+    promotions.py) e é descartado quando uma linha dele muda.
+    """
+
+    __slots__ = ('_lines', 'subtotal', 'establishment_subtotals', 'priced')
+
+    def __init__(self):
+        self._lines = {}  # (id do estabelecimento, id do item) -> CartLine, pela ordem de inserção
+        self.subtotal = 0
+        self.establishment_subtotals = {}
+        self.priced = {}  # id do estabelecimento -> (geração das promoções, preço)
+
+    def add(self, establishment_id, item_id, unit_price, quantity):
+        """
+        Adiciona o item; se ele já estiver na sacola, soma a quantidade ao
+        preço que a linha já tem (um novo preço do catálogo não a altera)
+        """
+        key = (establishment_id, item_id)
+        line = self._lines.get(key)
+        if line is None:
+            line = self._lines[key] = CartLine(establishment_id, item_id, unit_price, quantity)
+        else:
+            line.quantity += quantity
+        amount = line.unit_price * quantity
+        self.subtotal += amount
+        self.establishment_subtotals[establishment_id] = self.establishment_subtotals.get(establishment_id, 0) + amount
+        self.priced.pop(establishment_id, None)
+        return line
+
+    def clear(self):
+        self._lines.clear()
+        self.subtotal = 0
+        self.establishment_subtotals.clear()
+        self.priced.clear()
+
+    def __iter__(self):
+        return iter(self._lines.values())
+
+    def __len__(self):
+        return len(self._lines)
+
+    def __bool__(self):
+        return bool(self._lines)
+
+    def to_compact(self):
+        """
+        Forma compacta para gravar na sessão: [[estabelecimento, item, preço, quantidade], ...]
+        """
+        return [[line.establishment_id, line.item_id, line.unit_price, line.quantity] for line in self._lines.values()]
+
+    @classmethod
+    def from_compact(cls, data):
+        cart = cls()
+        for establishment_id, item_id, unit_price, quantity in data or ():
+            cart.add(establishment_id, item_id, unit_price, quantity)
+        return cart
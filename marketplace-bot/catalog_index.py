@@ -0,0 +1,191 @@
+import re
+
+from opening_hours import compile_hours
+
+TOKEN_RE = re.compile(r'\w+')
+
+
+def stem(token):
+    """
+    Reduz plurais simples ('pizzarias' -> 'pizzaria', 'queijos' -> 'queijo')
+    """
+    if len(token) > 3 and token.endswith('s'):
+        return token[:-1]
+    return token
+
+
+def tokenize(text):
+    """
+    Divide o texto em tokens normalizados (minúsculas, sem plural simples)
+    """
+    return [stem(token) for token in TOKEN_RE.findall(text.lower())]
+
+
+def parse_position(message, count):
+    """
+    Interpreta a mensagem como o número de uma opção listada (1..count)
+    """
+    try:
+        position = int(message.strip())
+    except ValueError:
+        return None
+    if 1 <= position <= count:
+        return position
+    return None
+
+
+class PhraseIndex:
+    """
+    Índice invertido de nomes: primeiro token -> [(tokens do nome, posição, valor)].
+
+    Resolver uma mensagem custa O(tokens da mensagem), independentemente
+    do número de nomes indexados.
+    """
+
+    def __init__(self):
+        self._by_first_token = {}
+
+    def add(self, name, position, value):
+        tokens = tuple(tokenize(name))
+        if tokens:
+            self._by_first_token.setdefault(tokens[0], []).append((tokens, position, value))
+
+    def match(self, tokens):
+        """
+        Retorna o valor do nome contido na mensagem com menor posição no catálogo
+        """
+        best = None
+        for i, token in enumerate(tokens):
+            for name_tokens, position, value in self._by_first_token.get(token, ()):
+                if best is not None and position >= best[0]:
+                    continue
+                if tuple(tokens[i:i + len(name_tokens)]) == name_tokens:
+                    best = (position, value)
+        return best[1] if best else None
+
+
+class MenuIndex:
+    """
+    Índice dos itens (menu ou produtos) de um estabelecimento
+    """
+
+    def __init__(self, establishment):
+        # Verifica se o estabelecimento tem menu ou produtos
+        self.items = establishment.get('menu') or establishment.get('produtos') or []
+        self.item_ids = []
+        self._items_by_id = {}
+        self._names = PhraseIndex()
+
+        for position, item in enumerate(self.items, 1):
+            item_id = item.get('id', f"{establishment['id']}:{position}")
+            self.item_ids.append(item_id)
+            self._items_by_id[item_id] = item
+            self._names.add(item['nome'], position, item_id)
+
+    def item(self, item_id):
+        return self._items_by_id.get(item_id)
+
+    def resolve(self, message):
+        """
+        Encontra o item pelo nome ou pelo número; retorna o id do item ou None
+        """
+        item_id = self._names.match(tokenize(message))
+        if item_id is None:
+            position = parse_position(message, len(self.items))
+            if position:
+                item_id = self.item_ids[position - 1]
+        return item_id
+
+
+class CatalogIndex:
+    """
+    Índice do catálogo construído uma única vez no carregamento dos dados.
+
+    Guarda as categorias e estabelecimentos em listas posicionais (para a
+    seleção por número), mapas por id e índices invertidos de nomes (para a
+    seleção por texto). Se menu_loader for indicado, os menus não vêm nos
+    dados e são pedidos a ele sob demanda (catálogo da base de dados);
+    menus_loader, se existir, carrega vários menus de uma só vez.
+    """
+
+    def __init__(self, data, menu_loader=None, version=None, menus_loader=None):
+        self.data = data
+        self.version = version
+        self.menu_loader = menu_loader
+        self.menus_loader = menus_loader
+        self.categories = list(data.keys())
+        self._category_names = PhraseIndex()
+        self._establishments_by_id = {}
+        self._category_by_establishment = {}
+        self._schedules = {}
+        self._establishment_names = {}
+        self._menus = {}
+
+        for position, category in enumerate(self.categories, 1):
+            # O stem também cobre o singular ('pizzaria' para 'pizzarias')
+            self._category_names.add(category, position, category)
+
+            names = PhraseIndex()
+            for est_position, establishment in enumerate(data[category], 1):
+                self._establishments_by_id[establishment['id']] = establishment
+                self._category_by_establishment[establishment['id']] = category
+                # Horário compilado uma única vez por carregamento (None se o texto não for reconhecido)
+                self._schedules[establishment['id']] = compile_hours(establishment.get('horario_funcionamento'))
+                if menu_loader is None:
+                    self._menus[establishment['id']] = MenuIndex(establishment)
+                names.add(establishment['nome'], est_position, establishment)
+            self._establishment_names[category] = names
+
+    def establishments(self, category):
+        return self.data[category]
+
+    def establishment(self, establishment_id):
+        return self._establishments_by_id.get(establishment_id)
+
+    def category_of(self, establishment_id):
+        return self._category_by_establishment.get(establishment_id)
+
+    def schedule(self, establishment_id):
+        return self._schedules.get(establishment_id)
+
+    def menu(self, establishment_id):
+        if self.menu_loader is not None:
+            return self.menu_loader(establishment_id)
+        return self._menus[establishment_id]
+
+    def menus(self, establishment_ids):
+        """
+        {id: MenuIndex} dos estabelecimentos indicados
+        """
+        if self.menus_loader is not None:
+            return self.menus_loader(establishment_ids)
+        return {establishment_id: self.menu(establishment_id) for establishment_id in establishment_ids}
+
+    def resolve_category(self, message):
+        """
+        Encontra a categoria pelo nome ou pelo número
+        """
+        category = self._category_names.match(tokenize(message))
+        if category is None:
+            position = parse_position(message, len(self.categories))
+            if position:
+                category = self.categories[position - 1]
+        return category
+
+    def resolve_establishment(self, category, message, listed_ids=None):
+        """
+        Encontra um estabelecimento da categoria pelo nome ou pelo número.
+        listed_ids são os ids pela ordem em que a lista foi mostrada, se ela
+        não tinha todos os estabelecimentos da categoria.
+        """
+        establishment = self._establishment_names[category].match(tokenize(message))
+        if establishment is None:
+            if listed_ids is not None:
+                establishments = [self._establishments_by_id[establishment_id] for establishment_id in listed_ids
+                                  if establishment_id in self._establishments_by_id]
+            else:
+                establishments = self.data[category]
+            position = parse_position(message, len(establishments))
+            if position:
+                establishment = establishments[position - 1]
+        return establishment
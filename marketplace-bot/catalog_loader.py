@@ -0,0 +1,137 @@
+import json
+import logging
+import mmap
+import os
+import threading
+import time
+
+from catalog_index import CatalogIndex
+
+try:
+    import msgpack
+except ImportError:  # formato binário opcional
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+
+class CatalogSnapshot:
+    """
+    Versão imutável do catálogo: os dados e o índice construído sobre eles.
+
+    Nunca é alterada depois de criada; um recarregamento cria outra e troca a
+    referência, então as conversas em curso continuam com a que já tinham.
+    """
+
+    __slots__ = ('version', 'data', 'index', 'loaded_at')
+
+    def __init__(self, data, version, menu_loader=None, menus_loader=None):
+        self.version = version
+        self.data = data
+        self.index = CatalogIndex(data, menu_loader=menu_loader, menus_loader=menus_loader, version=version)
+        self.loaded_at = time.time()
+
+
+def binary_path_for(path):
+    return os.path.splitext(path)[0] + '.msgpack'
+
+
+def compile_catalog(path, binary_path=None):
+    """
+    Converte o catálogo JSON para o formato binário (msgpack)
+    """
+    if msgpack is None:
+        raise RuntimeError("O pacote msgpack não está instalado")
+
+    binary_path = binary_path or binary_path_for(path)
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+
+    # Grava num arquivo temporário e renomeia, para os workers nunca lerem um arquivo pela metade
+    tmp_path = binary_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(msgpack.packb(data, use_bin_type=True))
+    os.replace(tmp_path, binary_path)
+    return binary_path
+
+
+def read_catalog(path):
+    """
+    Lê o catálogo, preferindo a versão binária se estiver atualizada
+    """
+    binary_path = binary_path_for(path)
+    if msgpack is not None and os.path.exists(binary_path) \
+            and os.stat(binary_path).st_mtime_ns >= os.stat(path).st_mtime_ns:
+        # O mmap evita copiar o arquivo para um buffer; o unpackb ainda cria os objetos
+        # Python em cada worker, só que bem mais depressa que o json.load
+        with open(binary_path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return msgpack.unpackb(mm, raw=False)
+
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+class CatalogLoader:
+    """
+    Carrega o catálogo e troca-o atomicamente quando o arquivo muda.
+
+    current() verifica o mtime no máximo a cada check_interval segundos. Se o
+    arquivo mudou, o novo snapshot é construído numa thread à parte e as
+    mensagens continuam a ser servidas pelo snapshot anterior até à troca.
+    """
+
+    def __init__(self, path, check_interval=5.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._reload_lock = threading.Lock()
+        self._last_check = time.monotonic()
+        self._snapshot = self._load()
+
+    def _source_version(self):
+        paths = [self.path, binary_path_for(self.path)]
+        return max(os.stat(p).st_mtime_ns for p in paths if os.path.exists(p))
+
+    def _load(self):
+        version = self._source_version()
+        snapshot = CatalogSnapshot(read_catalog(self.path), version)
+        logger.info(f"Catálogo carregado (versão {version})")
+        return snapshot
+
+    def current(self):
+        """
+        Retorna o snapshot atual do catálogo
+        """
+        now = time.monotonic()
+        if now - self._last_check >= self.check_interval:
+            self._last_check = now
+            self._check_for_changes()
+        return self._snapshot
+
+    def _check_for_changes(self):
+        try:
+            changed = self._source_version() != self._snapshot.version
+        except OSError as e:
+            logger.error(f"Erro ao verificar o catálogo: {e}")
+            return
+
+        # Só uma thread recarrega; as outras seguem com o snapshot atual
+        if changed and self._reload_lock.acquire(blocking=False):
+            threading.Thread(target=self._reload, name='catalog-reload', daemon=True).start()
+
+    def _reload(self):
+        try:
+            self._snapshot = self._load()
+        except Exception as e:
+            # Um arquivo inválido não derruba o bot: mantém o snapshot anterior
+            logger.error(f"Erro ao recarregar o catálogo: {e}")
+        finally:
+            self._reload_lock.release()
+
+    def reload(self):
+        """
+        Recarrega o catálogo imediatamente (na thread de quem chama)
+        """
+        with self._reload_lock:
+            self._snapshot = self._load()
+        return self._snapshot
@@ -0,0 +1,169 @@
+import bisect
+import threading
+import time
+from collections import Counter
+
+# Limites superiores (ms) dos baldes dos histogramas de latência
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class Message:
+    """
+    Mensagem recebida, normalizada uma única vez e partilhada por todos os handlers
+    """
+
+    __slots__ = ('raw', 'text', 'media_url', 'sender', 'location', '_matcher', '_matches')
+
+    def __init__(self, raw, media_url=None, matcher=None, sender=None, location=None):
+        self.raw = raw
+        self.text = raw.lower().strip()
+        self.media_url = media_url
+        self.sender = sender  # Telefone de quem enviou ('whatsapp:+258...')
+        self.location = location  # (latitude, longitude) de um pin partilhado
+        self._matcher = matcher
+        self._matches = None
+
+    @property
+    def matches(self):
+        """
+        Palavras-chave encontradas na mensagem (uma passagem, feita só quando é pedida)
+        """
+        if self._matches is None:
+            self._matches = self._matcher.find(self.text)
+        return self._matches
+
+
+class LatencyHistogram:
+    """
+    Histograma de latências em baldes fixos, com percentis aproximados
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # o último balde é "acima do maior limite"
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, elapsed_ms):
+        self.counts[bisect.bisect_left(self.buckets, elapsed_ms)] += 1
+        self.count += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+
+    def percentile(self, fraction):
+        """
+        Limite superior do balde onde cai o percentil (max_ms no último balde)
+        """
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return float(self.buckets[index]) if index < len(self.buckets) else round(self.max_ms, 3)
+        return round(self.max_ms, 3)
+
+    def stats(self):
+        return {
+            'count': self.count,
+            'avg_ms': round(self.total_ms / self.count, 3) if self.count else 0.0,
+            'p50_ms': self.percentile(0.5),
+            'p95_ms': self.percentile(0.95),
+            'p99_ms': self.percentile(0.99),
+            'max_ms': round(self.max_ms, 3),
+            'buckets': {
+                (f"le_{bound}" if index < len(self.buckets) else 'inf'): count
+                for index, (bound, count) in enumerate(zip(self.buckets + (None,), self.counts))
+            }
+        }
+
+
+class StateMachine:
+    """
+    Tabela de despacho dos estados da conversa.
+
+    Cada handler é registado com @machine.state('nome') (ou @machine.command
+    para os comandos globais) e recebe (session, message). dispatch() mede a
+    latência de cada estado e conta as transições (estado de origem -> estado
+    em que a sessão ficou), o que mostra onde o funil de pedido é lento ou
+    onde os usuários desistem.
+    """
+
+    def __init__(self):
+        self._handlers = {}
+        self._commands = {}
+        self._fallback = None
+        self._lock = threading.Lock()
+        self._latency = {}
+        self._transitions = Counter()
+        self._failures = Counter()
+
+    def state(self, name):
+        def register(handler):
+            if name in self._handlers:
+                raise ValueError(f"Estado {name!r} já registado")
+            self._handlers[name] = handler
+            return handler
+        return register
+
+    def command(self, name):
+        def register(handler):
+            self._commands[name] = handler
+            return handler
+        return register
+
+    def fallback(self, handler):
+        """
+        Regista o handler dos estados desconhecidos
+        """
+        self._fallback = handler
+        return handler
+
+    @property
+    def states(self):
+        return list(self._handlers)
+
+    def dispatch(self, session, message):
+        """
+        Executa o handler do estado atual da sessão
+        """
+        state = session['state']
+        return self._run(state, self._handlers.get(state, self._fallback), session, message)
+
+    def run_command(self, name, session, message):
+        """
+        Executa um comando global; as métricas ficam em 'command:<nome>'
+        """
+        return self._run(f"command:{name}", self._commands[name], session, message)
+
+    def _run(self, key, handler, session, message):
+        started = time.perf_counter()
+        try:
+            return handler(session, message)
+        except Exception:
+            with self._lock:
+                self._failures[key] += 1
+            raise
+        finally:
+            self._record(key, session['state'], (time.perf_counter() - started) * 1000)
+
+    def _record(self, key, next_state, elapsed_ms):
+        with self._lock:
+            histogram = self._latency.get(key)
+            if histogram is None:
+                histogram = self._latency[key] = LatencyHistogram()
+            histogram.observe(elapsed_ms)
+            self._transitions[(key, next_state)] += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'latency': {state: histogram.stats() for state, histogram in self._latency.items()},
+                'transitions': [
+                    {'from': state, 'to': next_state, 'count': count}
+                    for (state, next_state), count in self._transitions.most_common()
+                ],
+                'failures': dict(self._failures)
+            }
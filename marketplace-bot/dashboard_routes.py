@@ -1,8 +1,19 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, session
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, Response, stream_with_context
 from flask_login import login_required, current_user
-from models import db, User, Establishment, Product, Promotion, Order, Review, Subscription, Payment, ChatFlow, ChatbotConfig, PlanType
+from models import db, Establishment, Order, OrderItem, Subscription, Payment, ChatFlow, ChatbotConfig, PlanType, Category, DailyEstablishmentStats
+import stats_rollup  # Mantém o resumo diário atualizado quando os pedidos mudam
+import ratings  # Mantém os contadores de avaliação dos estabelecimentos
+from entitlements import get_entitlements, cached_entitlements, entitlements_for_write, invalidate_entitlements
+from flow_engine import invalidate_flow
 from datetime import datetime, timedelta
+from sqlalchemy import func, and_, or_
+from sqlalchemy.orm import selectinload
+import csv
+import hashlib
+import io
 import json
+import os
+import time
 
 dashboard = Blueprint('dashboard', __name__)
 
@@ -11,52 +22,45 @@ dashboard = Blueprint('dashboard', __name__)
 def index():
     """Dashboard principal do lojista"""
     # Verificar se o usuário tem uma assinatura ativa
-    subscription = Subscription.query.filter_by(user_id=current_user.id, is_active=True).first()
+    entitlements = get_entitlements(current_user.id)
+    subscription = entitlements.subscription
     
     if not subscription:
         # Redirecionar para página de escolha de plano se não tiver assinatura
         return redirect(url_for('dashboard.choose_plan'))
     
     # Calcular dias restantes do trial
-    days_left = 0
-    trial_banner = False
-    
-    if subscription.is_trial:
-        days_left = (subscription.trial_end - datetime.utcnow()).days
-        if days_left < 0:
-            days_left = 0
-        trial_banner = True
+    days_left = entitlements.trial_days_left()
+    trial_banner = subscription.is_trial
     
     # Buscar estabelecimentos do usuário
     establishments = Establishment.query.filter_by(owner_id=current_user.id).all()
     
-    # Buscar estatísticas para o dashboard
+    # Estatísticas dos últimos 30 dias de todos os estabelecimentos numa única consulta
+    total_orders, total_revenue, total_customers = db.session.query(
+        func.count(Order.id),
+        func.coalesce(func.sum(Order.total_amount), 0),
+        func.count(func.distinct(Order.user_id))
+    ).join(
+        Establishment, Order.establishment_id == Establishment.id
+    ).filter(
+        Establishment.owner_id == current_user.id,
+        Order.created_at >= datetime.utcnow() - timedelta(days=30)
+    ).one()
+    
+    # Avaliação média das avaliações aprovadas, pelos contadores dos estabelecimentos (sem ler as avaliações)
+    avg_rating = ratings.average(
+        sum(establishment.rating_sum or 0 for establishment in establishments),
+        sum(establishment.rating_count or 0 for establishment in establishments)
+    )
+    
     stats = {
-        'total_orders': 0,
-        'total_revenue': 0,
-        'avg_rating': 0,
-        'total_customers': 0
+        'total_orders': total_orders,
+        'total_revenue': total_revenue,
+        'avg_rating': avg_rating or 0,
+        'total_customers': total_customers
     }
     
-    for establishment in establishments:
-        # Contar pedidos dos últimos 30 dias
-        recent_orders = Order.query.filter_by(
-            establishment_id=establishment.id
-        ).filter(
-            Order.created_at >= datetime.utcnow() - timedelta(days=30)
-        ).all()
-        
-        stats['total_orders'] += len(recent_orders)
-        stats['total_revenue'] += sum(order.total_amount for order in recent_orders)
-        
-        # Calcular avaliação média
-        if establishment.reviews:
-            stats['avg_rating'] = sum(review.rating for review in establishment.reviews) / len(establishment.reviews)
-        
-        # Contar clientes únicos
-        unique_customers = set(order.user_id for order in recent_orders)
-        stats['total_customers'] += len(unique_customers)
-    
     return render_template(
         'dashboard/index.html',
         subscription=subscription,
@@ -71,7 +75,7 @@ def index():
 def choose_plan():
     """Página de escolha de plano"""
     # Verificar se o usuário já tem uma assinatura
-    subscription = Subscription.query.filter_by(user_id=current_user.id, is_active=True).first()
+    subscription = get_entitlements(current_user.id).subscription
     
     # Definir os planos disponíveis
     plans = {
@@ -132,7 +136,6 @@ def select_plan(plan_type):
     
     if subscription:
         # Atualizar a assinatura existente
-        old_plan = subscription.plan_type
         subscription.plan_type = plan_mapping[plan_type]
         subscription.updated_at = datetime.utcnow()
         
@@ -168,6 +171,7 @@ def select_plan(plan_type):
     db.session.add(payment)
     
     db.session.commit()
+    invalidate_entitlements(current_user.id)
     
     flash(f'Plano {plan_mapping[plan_type].value} selecionado com sucesso!', 'success')
     return redirect(url_for('dashboard.index'))
@@ -184,21 +188,16 @@ def establishments():
 def new_establishment():
     """Criar novo estabelecimento"""
     if request.method == 'POST':
-        # Verificar limite de estabelecimentos com base no plano
-        subscription = Subscription.query.filter_by(user_id=current_user.id, is_active=True).first()
-        if not subscription:
+        # Verificar limite de estabelecimentos com base no plano (contagem atual, não a do cache)
+        entitlements = entitlements_for_write(current_user.id)
+        if not entitlements.subscription:
             flash('Você precisa escolher um plano para criar estabelecimentos', 'error')
             return redirect(url_for('dashboard.choose_plan'))
         
-        # Contar estabelecimentos existentes
-        establishment_count = Establishment.query.filter_by(owner_id=current_user.id).count()
-        
-        # Verificar limites por plano
-        if subscription.plan_type == PlanType.BASIC and establishment_count >= 1:
-            flash('Seu plano Básico permite apenas 1 estabelecimento', 'error')
-            return redirect(url_for('dashboard.establishments'))
-        elif subscription.plan_type == PlanType.MEDIUM and establishment_count >= 3:
-            flash('Seu plano Médio permite apenas 3 estabelecimentos', 'error')
+        if not entitlements.can_create_establishment:
+            limit = entitlements.limits.establishments
+            flash(f'Seu plano {entitlements.subscription.plan_type.value} permite apenas {limit} '
+                  f'{"estabelecimento" if limit == 1 else "estabelecimentos"}', 'error')
             return redirect(url_for('dashboard.establishments'))
         
         # Criar novo estabelecimento
@@ -227,6 +226,7 @@ def new_establishment():
         
         db.session.add(chatbot_config)
         db.session.commit()
+        invalidate_entitlements(current_user.id)
         
         flash('Estabelecimento criado com sucesso!', 'success')
         return redirect(url_for('dashboard.establishments'))
@@ -264,14 +264,8 @@ def chatbot_editor(establishment_id):
     flows = ChatFlow.query.filter_by(establishment_id=establishment_id).all()
     
     # Verificar limite de fluxos com base no plano
-    subscription = Subscription.query.filter_by(user_id=current_user.id, is_active=True).first()
-    
-    flow_limit = float('inf')  # Ilimitado por padrão (plano Alto)
-    if subscription.plan_type == PlanType.BASIC:
-        flow_limit = 5
-    elif subscription.plan_type == PlanType.MEDIUM:
-        flow_limit = 15
-    
+    entitlements = get_entitlements(current_user.id)
+    flow_limit = entitlements.limits.flows
     can_create_flow = len(flows) < flow_limit
     
     return render_template(
@@ -293,18 +287,13 @@ def new_flow(establishment_id):
         flash('Você não tem permissão para acessar este estabelecimento', 'error')
         return redirect(url_for('dashboard.establishments'))
     
-    # Verificar limite de fluxos com base no plano
-    subscription = Subscription.query.filter_by(user_id=current_user.id, is_active=True).first()
-    flows = ChatFlow.query.filter_by(establishment_id=establishment_id).all()
-    
-    flow_limit = float('inf')  # Ilimitado por padrão (plano Alto)
-    if subscription.plan_type == PlanType.BASIC:
-        flow_limit = 5
-    elif subscription.plan_type == PlanType.MEDIUM:
-        flow_limit = 15
-    
-    if len(flows) >= flow_limit:
-        flash(f'Seu plano permite apenas {flow_limit} fluxos de conversa', 'error')
+    # Verificar limite de fluxos com base no plano; ao criar, com a contagem atual e não a do cache
+    if request.method == 'POST':
+        entitlements = entitlements_for_write(current_user.id)
+    else:
+        entitlements = get_entitlements(current_user.id)
+    if not entitlements.can_create_flow(establishment_id):
+        flash(f'Seu plano permite apenas {entitlements.limits.flows} fluxos de conversa', 'error')
         return redirect(url_for('dashboard.chatbot_editor', establishment_id=establishment_id))
     
     if request.method == 'POST':
@@ -318,6 +307,8 @@ def new_flow(establishment_id):
         
         db.session.add(flow)
         db.session.commit()
+        invalidate_entitlements(current_user.id)
+        invalidate_flow(flow.id)
         
         flash('Fluxo criado com sucesso!', 'success')
         return redirect(url_for('dashboard.chatbot_editor', establishment_id=establishment_id))
@@ -350,6 +341,8 @@ def edit_flow(establishment_id, flow_id):
         flow.updated_at = datetime.utcnow()
         
         db.session.commit()
+        # Só este fluxo é recompilado pelo bot
+        invalidate_flow(flow.id)
         
         flash('Fluxo atualizado com sucesso!', 'success')
         return redirect(url_for('dashboard.chatbot_editor', establishment_id=establishment_id))
@@ -357,6 +350,53 @@ def edit_flow(establishment_id, flow_id):
     # GET: Mostrar formulário de edição
     return render_template('dashboard/edit_flow.html', establishment=establishment, flow=flow)
 
+ORDERS_PAGE_SIZE = 50
+EXPORT_BATCH_SIZE = 500
+EXPORT_COLUMNS = ['id', 'created_at', 'establishment', 'order_status', 'payment_method', 'payment_status',
+                  'delivery_type', 'delivery_fee', 'total_amount', 'currency', 'items']
+
+def parse_date_arg(name):
+    """Lê um parâmetro de data (AAAA-MM-DD) da URL; None se ausente ou inválido"""
+    value = request.args.get(name)
+    try:
+        return datetime.strptime(value, '%Y-%m-%d') if value else None
+    except ValueError:
+        return None
+
+def encode_cursor(order):
+    return f"{order.created_at.isoformat()},{order.id}"
+
+def decode_cursor(cursor):
+    """Converte o cursor 'created_at,id' de volta para a tupla; None se inválido"""
+    try:
+        created_at, order_id = cursor.rsplit(',', 1)
+        return datetime.fromisoformat(created_at), int(order_id)
+    except (AttributeError, ValueError):
+        return None
+
+def filtered_orders_query(establishment_ids):
+    """Pedidos dos estabelecimentos, com os filtros de status, estabelecimento e data da URL"""
+    query = Order.query.filter(Order.establishment_id.in_(establishment_ids))
+    
+    status = request.args.get('status')
+    if status:
+        query = query.filter(Order.order_status == status)
+    
+    establishment_id = request.args.get('establishment_id', type=int)
+    if establishment_id:
+        query = query.filter(Order.establishment_id == establishment_id)
+    
+    date_from = parse_date_arg('date_from')
+    if date_from:
+        query = query.filter(Order.created_at >= date_from)
+    
+    date_to = parse_date_arg('date_to')
+    if date_to:
+        # A data final é inclusiva
+        query = query.filter(Order.created_at < date_to + timedelta(days=1))
+    
+    return query.order_by(Order.created_at.desc(), Order.id.desc())
+
 @dashboard.route('/orders')
 @login_required
 def orders():
@@ -365,10 +405,92 @@ def orders():
     establishments = Establishment.query.filter_by(owner_id=current_user.id).all()
     establishment_ids = [e.id for e in establishments]
     
-    # Buscar pedidos dos estabelecimentos
-    orders = Order.query.filter(Order.establishment_id.in_(establishment_ids)).order_by(Order.created_at.desc()).all()
+    query = filtered_orders_query(establishment_ids).options(
+        selectinload(Order.items).selectinload(OrderItem.product)
+    )
+    
+    # Paginação por cursor (created_at, id): cada página custa o mesmo, seja a primeira ou a milésima
+    cursor = decode_cursor(request.args.get('cursor'))
+    if cursor:
+        created_at, order_id = cursor
+        query = query.filter(or_(
+            Order.created_at < created_at,
+            and_(Order.created_at == created_at, Order.id < order_id)
+        ))
+    
+    # Busca um pedido a mais só para saber se existe próxima página
+    orders = query.limit(ORDERS_PAGE_SIZE + 1).all()
+    next_cursor = None
+    if len(orders) > ORDERS_PAGE_SIZE:
+        orders = orders[:ORDERS_PAGE_SIZE]
+        next_cursor = encode_cursor(orders[-1])
     
-    return render_template('dashboard/orders.html', orders=orders, establishments=establishments)
+    return render_template(
+        'dashboard/orders.html',
+        orders=orders,
+        establishments=establishments,
+        next_cursor=next_cursor,
+        filters={key: request.args.get(key, '') for key in ('status', 'establishment_id', 'date_from', 'date_to')}
+    )
+
+@dashboard.route('/orders/export')
+@login_required
+def export_orders():
+    """Exportar pedidos em CSV ou NDJSON, gerados linha a linha"""
+    export_format = request.args.get('format', 'csv')
+    if export_format not in ('csv', 'ndjson'):
+        return jsonify({'error': 'Formato inválido'}), 400
+    
+    establishments = Establishment.query.filter_by(owner_id=current_user.id).all()
+    establishment_names = {e.id: e.name for e in establishments}
+    
+    # yield_per usa um cursor do lado do servidor: só EXPORT_BATCH_SIZE pedidos em memória de cada vez
+    query = filtered_orders_query(list(establishment_names)).options(
+        selectinload(Order.items).selectinload(OrderItem.product)
+    ).yield_per(EXPORT_BATCH_SIZE)
+    
+    def order_row(order):
+        return {
+            'id': order.id,
+            'created_at': order.created_at.isoformat() if order.created_at else '',
+            'establishment': establishment_names.get(order.establishment_id, ''),
+            'order_status': order.order_status,
+            'payment_method': order.payment_method or '',
+            'payment_status': order.payment_status,
+            'delivery_type': order.delivery_type or '',
+            'delivery_fee': order.delivery_fee or 0.0,
+            'total_amount': order.total_amount,
+            'currency': order.currency,
+            # O produto pode ter sido apagado; um erro aqui cortaria o arquivo já a meio do envio
+            'items': '; '.join(f"{item.quantity}x {item.product.name if item.product else ''}" for item in order.items)
+        }
+    
+    def generate_csv():
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS)
+        writer.writeheader()
+        for order in query:
+            writer.writerow(order_row(order))
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+        yield buffer.getvalue()
+    
+    def generate_ndjson():
+        for order in query:
+            yield json.dumps(order_row(order), ensure_ascii=False) + '\n'
+    
+    if export_format == 'csv':
+        generate, mimetype = generate_csv, 'text/csv'
+    else:
+        generate, mimetype = generate_ndjson, 'application/x-ndjson'
+    
+    filename = f"pedidos_{datetime.utcnow().strftime('%Y%m%d')}.{export_format}"
+    return Response(
+        stream_with_context(generate()),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
 
 @dashboard.route('/orders/<int:id>')
 @login_required
@@ -413,59 +535,74 @@ def update_order_status(id):
 @login_required
 def analytics():
     """Página de análise de dados e métricas"""
-    # Buscar estabelecimentos do usuário
-    establishments = Establishment.query.filter_by(owner_id=current_user.id).all()
-    establishment_ids = [e.id for e in establishments]
-    
     # Definir período de análise (últimos 30 dias por padrão)
-    end_date = datetime.utcnow()
-    start_date = end_date - timedelta(days=30)
-    
-    # Buscar pedidos do período
-    orders = Order.query.filter(
-        Order.establishment_id.in_(establishment_ids),
-        Order.created_at.between(start_date, end_date)
+    days = request.args.get('days', 30, type=int)
+    if days not in (7, 30, 90, 365):
+        days = 30
+    start_day = datetime.utcnow().date() - timedelta(days=days - 1)
+    
+    # Lê o resumo diário já agregado (uma linha por dia), e não os pedidos
+    daily_rows = db.session.query(
+        DailyEstablishmentStats.day,
+        func.sum(DailyEstablishmentStats.order_count),
+        func.sum(DailyEstablishmentStats.revenue)
+    ).join(
+        Establishment, DailyEstablishmentStats.establishment_id == Establishment.id
+    ).filter(
+        Establishment.owner_id == current_user.id,
+        DailyEstablishmentStats.day >= start_day
+    ).group_by(
+        DailyEstablishmentStats.day
+    ).order_by(
+        DailyEstablishmentStats.day
     ).all()
     
-    # Calcular métricas
-    total_orders = len(orders)
-    total_revenue = sum(order.total_amount for order in orders)
-    avg_order_value = total_revenue / total_orders if total_orders > 0 else 0
-    
     # Dados para gráficos
-    daily_revenue = {}
-    daily_orders = {}
+    dates = [day.strftime('%Y-%m-%d') for day, _, _ in daily_rows]
+    orders_data = [int(order_count) for _, order_count, _ in daily_rows]
+    revenue_data = [revenue for _, _, revenue in daily_rows]
     
-    for order in orders:
-        date_str = order.created_at.strftime('%Y-%m-%d')
-        
-        if date_str not in daily_revenue:
-            daily_revenue[date_str] = 0
-            daily_orders[date_str] = 0
-        
-        daily_revenue[date_str] += order.total_amount
-        daily_orders[date_str] += 1
+    # Calcular métricas
+    total_orders = sum(orders_data)
+    total_revenue = sum(revenue_data)
+    avg_order_value = total_revenue / total_orders if total_orders > 0 else 0
     
-    # Ordenar por data
-    dates = sorted(daily_revenue.keys())
-    revenue_data = [daily_revenue[date] for date in dates]
-    orders_data = [daily_orders[date] for date in dates]
+    # Divisão por categoria dos estabelecimentos
+    category_breakdown = db.session.query(
+        Category.name,
+        func.sum(DailyEstablishmentStats.order_count),
+        func.sum(DailyEstablishmentStats.revenue)
+    ).join(
+        Establishment, DailyEstablishmentStats.establishment_id == Establishment.id
+    ).join(
+        Category, DailyEstablishmentStats.category_id == Category.id
+    ).filter(
+        Establishment.owner_id == current_user.id,
+        DailyEstablishmentStats.day >= start_day
+    ).group_by(
+        Category.name
+    ).all()
     
     return render_template(
         'dashboard/analytics.html',
+        days=days,
         total_orders=total_orders,
         total_revenue=total_revenue,
         avg_order_value=avg_order_value,
         dates=dates,
         revenue_data=revenue_data,
-        orders_data=orders_data
+        orders_data=orders_data,
+        category_breakdown=[
+            {'category': name, 'orders': int(order_count), 'revenue': revenue}
+            for name, order_count, revenue in category_breakdown
+        ]
     )
 
 @dashboard.route('/settings')
 @login_required
 def settings():
     """Configurações da conta e assinatura"""
-    subscription = Subscription.query.filter_by(user_id=current_user.id, is_active=True).first()
+    subscription = get_entitlements(current_user.id).subscription
     
     return render_template('dashboard/settings.html', subscription=subscription)
 
@@ -491,6 +628,7 @@ def cancel_subscription():
         subscription.is_active = False
         subscription.updated_at = datetime.utcnow()
         db.session.commit()
+        invalidate_entitlements(current_user.id)
         flash('Assinatura cancelada com sucesso', 'success')
     else:
         flash('Você não possui uma assinatura ativa', 'error')
@@ -503,32 +641,76 @@ def onboarding():
     """Página de onboarding para novos usuários"""
     return render_template('dashboard/onboarding.html')
 
+# Teto do max-age de /api/trial-status: uma mudança de plano aparece no máximo com este atraso
+TRIAL_STATUS_MAX_AGE = int(os.environ.get('TRIAL_STATUS_MAX_AGE', '300'))
+# Canal SSE opcional: cada ligação ocupa uma thread do worker durante até TRIAL_STATUS_STREAM_DURATION segundos
+TRIAL_STATUS_SSE = os.environ.get('TRIAL_STATUS_SSE', '0') == '1'
+TRIAL_STATUS_STREAM_DURATION = int(os.environ.get('TRIAL_STATUS_STREAM_DURATION', '600'))
+TRIAL_STATUS_STREAM_INTERVAL = int(os.environ.get('TRIAL_STATUS_STREAM_INTERVAL', '30'))
+
 @dashboard.route('/api/trial-status')
 @login_required
 def trial_status():
     """API para verificar o status do trial (usado pelo frontend)"""
-    subscription = Subscription.query.filter_by(user_id=current_user.id, is_active=True).first()
+    entitlements = get_entitlements(current_user.id)
+    status = entitlements.trial_status()
+    response = jsonify(status)
+    
+    # O status só muda quando days_left desce ou quando a assinatura é alterada
+    max_age = TRIAL_STATUS_MAX_AGE
+    changes_at = entitlements.trial_status_changes_at()
+    if changes_at:
+        max_age = min(max_age, int((changes_at - datetime.utcnow()).total_seconds()) + 1)
+    
+    subscription = entitlements.subscription
+    if subscription and subscription.updated_at:
+        last_modified = subscription.updated_at
+        if changes_at:
+            last_modified = max(last_modified, changes_at - timedelta(days=1))
+        response.last_modified = last_modified
+    
+    response.set_etag(hashlib.sha1(f"{current_user.id}:{json.dumps(status, sort_keys=True)}".encode('utf-8')).hexdigest())
+    response.cache_control.private = True
+    response.cache_control.max_age = max_age
+    
+    # Responde 304 sem corpo se o navegador já tem esta versão
+    return response.make_conditional(request)
+
+@dashboard.route('/api/trial-status/stream')
+@login_required
+def trial_status_stream():
+    """Envia o status do trial por server-sent events sempre que ele muda"""
+    if not TRIAL_STATUS_SSE:
+        return jsonify({'error': 'SSE desativado'}), 404
+    
+    user_id = current_user.id
+    
+    def events():
+        last_status = None
+        deadline = time.monotonic() + TRIAL_STATUS_STREAM_DURATION
+        while time.monotonic() < deadline:
+            entitlements = cached_entitlements(user_id)
+            # Não segura uma transação aberta enquanto espera
+            db.session.remove()
+            
+            status = entitlements.trial_status()
+            if status != last_status:
+                last_status = status
+                yield f"data: {json.dumps(status)}\n\n"
+            else:
+                yield ": keep-alive\n\n"
+            
+            wait = TRIAL_STATUS_STREAM_INTERVAL
+            changes_at = entitlements.trial_status_changes_at()
+            if changes_at:
+                wait = min(wait, max((changes_at - datetime.utcnow()).total_seconds(), 1))
+            time.sleep(max(min(wait, deadline - time.monotonic()), 0))
+        
+        # O EventSource volta a ligar sozinho após retry milissegundos
+        yield "retry: 1000\n\n"
     
-    if not subscription:
-        return jsonify({
-            'is_trial': False,
-            'days_left': 0,
-            'trial_expired': True
-        })
-    
-    if not subscription.is_trial:
-        return jsonify({
-            'is_trial': False,
-            'days_left': 0,
-            'trial_expired': False
-        })
-    
-    days_left = (subscription.trial_end - datetime.utcnow()).days
-    if days_left < 0:
-        days_left = 0
-    
-    return jsonify({
-        'is_trial': True,
-        'days_left': days_left,
-        'trial_expired': days_left <= 0
-    })
+    return Response(
+        stream_with_context(events()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
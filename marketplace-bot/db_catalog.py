@@ -0,0 +1,197 @@
+import logging
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, joinedload
+
+from catalog_index import MenuIndex
+from catalog_loader import CatalogSnapshot
+from models import Establishment, Product
+from ratings import average
+
+logger = logging.getLogger(__name__)
+
+# Ids por consulta ao carregar vários menus de uma vez (limite de parâmetros do SQLite)
+MENUS_BATCH_SIZE = 500
+
+# Provedores a avisar quando um commit altera estabelecimentos ou produtos
+_providers = []
+
+
+# models.bump_menu_versions e ratings registam em session.info os estabelecimentos alterados
+@event.listens_for(Session, 'after_commit')
+def invalidate_cached_menus(session):
+    changed = session.info.pop('catalog_changed_establishments', None)
+    if changed:
+        for provider in _providers:
+            provider.invalidate(changed)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_menu_changes(session):
+    session.info.pop('catalog_changed_establishments', None)
+
+
+def establishment_record(establishment):
+    """
+    Converte o estabelecimento para o mesmo formato do catálogo JSON
+    """
+    return {
+        'id': establishment.id,
+        'nome': establishment.name,
+        'endereco': establishment.address or '',
+        'horario_funcionamento': establishment.opening_hours or '',
+        'avaliacao_media': round(average(establishment.rating_sum or 0, establishment.rating_count or 0), 1),
+        'latitude': establishment.latitude,
+        'longitude': establishment.longitude,
+        'menu_version': establishment.menu_version or 0
+    }
+
+
+def product_record(product):
+    return {
+        'id': product.id,
+        'nome': product.name,
+        'descricao': product.description or '',
+        'preco': product.price,
+        'categoria': product.internal_category or ''
+    }
+
+
+class DatabaseCatalogProvider:
+    """
+    Catálogo servido pelas tabelas Establishment e Product, com cache de leitura.
+
+    A lista de estabelecimentos ativos vem de uma única consulta e é
+    revalidada no máximo a cada revalidate_interval segundos. O menu de cada
+    estabelecimento é carregado na primeira vez que é pedido (só produtos
+    disponíveis) e fica em cache até o seu menu_version mudar, então uma
+    conversa nunca volta à base de dados por um menu que já foi visto.
+    """
+
+    def __init__(self, app, revalidate_interval=30.0, menu_cache_size=1000):
+        self.app = app
+        self.revalidate_interval = revalidate_interval
+        self.menu_cache_size = menu_cache_size
+        self._menus = OrderedDict()  # id do estabelecimento -> (menu_version, MenuIndex)
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._last_check = 0.0
+        self._stale = True
+        _providers.append(self)
+
+    def current(self):
+        """
+        Retorna o snapshot atual do catálogo
+        """
+        now = time.monotonic()
+        if self._stale or now - self._last_check >= self.revalidate_interval:
+            self._last_check = now
+            self._stale = False
+            try:
+                self._refresh()
+            except Exception as e:
+                # Sem base de dados, continua com o último snapshot conhecido
+                logger.error(f"Erro ao carregar o catálogo da base de dados: {e}")
+                if self._snapshot is None:
+                    raise
+        return self._snapshot
+
+    def _refresh(self):
+        with self.app.app_context():
+            establishments = Establishment.query.options(
+                joinedload(Establishment.category)
+            ).filter(
+                Establishment.is_active.is_(True)
+            ).order_by(Establishment.category_id, Establishment.id).all()
+
+            data = {}
+            for establishment in establishments:
+                data.setdefault(establishment.category.name.lower(), []).append(
+                    establishment_record(establishment)
+                )
+
+        # A versão muda sempre que algum estabelecimento, menu ou avaliação muda
+        signature = repr([
+            (e['id'], e['nome'], e['menu_version'], e['avaliacao_media']) for records in data.values() for e in records
+        ])
+        version = zlib.crc32(signature.encode('utf-8'))
+        if self._snapshot is not None and self._snapshot.version == version:
+            return
+
+        self._snapshot = CatalogSnapshot(data, version, menu_loader=self.menu, menus_loader=self.menus)
+        logger.info(f"Catálogo da base de dados carregado (versão {version})")
+
+    def menu(self, establishment_id):
+        """
+        Retorna o índice do menu do estabelecimento, do cache ou da base de dados
+        """
+        establishment = self._snapshot.index.establishment(establishment_id)
+        menu_version = establishment['menu_version'] if establishment else None
+
+        with self._lock:
+            cached = self._menus.get(establishment_id)
+            if cached is not None and cached[0] == menu_version:
+                self._menus.move_to_end(establishment_id)
+                return cached[1]
+
+        with self.app.app_context():
+            products = Product.query.filter_by(
+                establishment_id=establishment_id, is_available=True
+            ).order_by(Product.id).all()
+            menu = MenuIndex({'id': establishment_id, 'menu': [product_record(p) for p in products]})
+
+        with self._lock:
+            self._menus[establishment_id] = (menu_version, menu)
+            self._menus.move_to_end(establishment_id)
+            while len(self._menus) > self.menu_cache_size:
+                self._menus.popitem(last=False)
+        return menu
+
+    def menus(self, establishment_ids):
+        """
+        Menus de vários estabelecimentos ({id: MenuIndex}); os que não estão
+        em cache vêm de uma única consulta (por lotes de MENUS_BATCH_SIZE ids)
+        """
+        versions = {}
+        for establishment_id in establishment_ids:
+            establishment = self._snapshot.index.establishment(establishment_id)
+            versions[establishment_id] = establishment['menu_version'] if establishment else None
+
+        menus = {}
+        with self._lock:
+            for establishment_id, menu_version in versions.items():
+                cached = self._menus.get(establishment_id)
+                if cached is not None and cached[0] == menu_version:
+                    menus[establishment_id] = cached[1]
+        missing = [establishment_id for establishment_id in versions if establishment_id not in menus]
+
+        for start in range(0, len(missing), MENUS_BATCH_SIZE):
+            batch = missing[start:start + MENUS_BATCH_SIZE]
+            records = {establishment_id: [] for establishment_id in batch}
+            with self.app.app_context():
+                products = Product.query.filter(
+                    Product.establishment_id.in_(batch), Product.is_available.is_(True)
+                ).order_by(Product.establishment_id, Product.id).all()
+                for product in products:
+                    records[product.establishment_id].append(product_record(product))
+            with self._lock:
+                for establishment_id, items in records.items():
+                    menu = menus[establishment_id] = MenuIndex({'id': establishment_id, 'menu': items})
+                    self._menus[establishment_id] = (versions[establishment_id], menu)
+                    self._menus.move_to_end(establishment_id)
+                while len(self._menus) > self.menu_cache_size:
+                    self._menus.popitem(last=False)
+        return menus
+
+    def invalidate(self, establishment_ids):
+        """
+        Descarta os menus alterados e força a revalidação da lista de estabelecimentos
+        """
+        with self._lock:
+            for establishment_id in establishment_ids:
+                self._menus.pop(establishment_id, None)
+        self._stale = True
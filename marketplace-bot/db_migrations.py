@@ -0,0 +1,99 @@
+import logging
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+
+from models import db
+
+logger = logging.getLogger(__name__)
+
+# Guarda as migrações já aplicadas em cada base de dados
+migrations_table = db.Table(
+    'schema_migrations',
+    db.metadata,
+    db.Column('version', db.Integer, primary_key=True),
+    db.Column('name', db.String(100), nullable=False),
+    db.Column('applied_at', db.DateTime, nullable=False)
+)
+
+MIGRATIONS = []
+
+
+def migration(version, name):
+    """
+    Regista uma migração; version define a ordem e nunca deve ser reutilizada
+    """
+    def register(func):
+        MIGRATIONS.append((version, name, func))
+        MIGRATIONS.sort(key=lambda entry: entry[0])
+        return func
+    return register
+
+
+def create_missing_indexes(connection, table):
+    existing = {index['name'] for index in inspect(connection).get_indexes(table.name)}
+    for index in table.indexes:
+        if index.name not in existing:
+            index.create(connection)
+            logger.info(f"Índice {index.name} criado")
+
+
+@migration(1, 'establishment.menu_version')
+def add_menu_version(connection):
+    columns = {column['name'] for column in inspect(connection).get_columns('establishment')}
+    if 'menu_version' not in columns:
+        connection.execute(text('ALTER TABLE establishment ADD COLUMN menu_version INTEGER NOT NULL DEFAULT 0'))
+
+
+@migration(2, 'daily_establishment_stats')
+def add_daily_stats(connection):
+    db.metadata.tables['daily_establishment_stats'].create(connection, checkfirst=True)
+
+
+@migration(3, 'dashboard indexes')
+def add_dashboard_indexes(connection):
+    for name in ('order', 'order_item', 'subscription', 'establishment', 'product', 'chat_flow', 'review'):
+        create_missing_indexes(connection, db.metadata.tables[name])
+
+
+@migration(4, 'establishment.rating_count/rating_sum')
+def add_rating_counters(connection):
+    columns = {column['name'] for column in inspect(connection).get_columns('establishment')}
+    for name in ('rating_count', 'rating_sum'):
+        if name not in columns:
+            connection.execute(text(f'ALTER TABLE establishment ADD COLUMN {name} INTEGER NOT NULL DEFAULT 0'))
+    # Importado aqui: ratings regista os listeners da Review
+    from ratings import repair_ratings
+    repair_ratings(connection)
+
+
+def applied_versions(connection):
+    return {row[0] for row in connection.execute(db.select(migrations_table.c.version))}
+
+
+def upgrade():
+    """
+    Aplica as migrações pendentes, cada uma na sua transação.
+
+    Uma base de dados vazia é criada direto a partir dos modelos e todas as
+    migrações são marcadas como aplicadas. Retorna as versões aplicadas.
+    """
+    engine = db.engine
+    fresh = not inspect(engine).has_table('establishment')
+    if fresh:
+        db.create_all()
+    migrations_table.create(engine, checkfirst=True)
+
+    applied = []
+    for version, name, func in MIGRATIONS:
+        with engine.begin() as connection:
+            if version in applied_versions(connection):
+                continue
+            if not fresh:
+                func(connection)
+            connection.execute(migrations_table.insert().values(
+                version=version, name=name, applied_at=datetime.utcnow()
+            ))
+        applied.append(version)
+        logger.info(f"Migração {version} ({name}) aplicada")
+    return applied
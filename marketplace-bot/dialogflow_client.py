@@ -0,0 +1,221 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+logger = logging.getLogger(__name__)
+
+IntentResult = namedtuple('IntentResult', ['intent', 'confidence', 'fulfillment_text', 'source'])
+
+
+def normalize_query(text):
+    """
+    Normaliza o texto para a chave do cache ('  Oi ' e 'oi' são a mesma frase)
+    """
+    return ' '.join(text.lower().split())
+
+
+class LRUCache:
+    """
+    Cache LRU simples e thread-safe
+    """
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class CircuitBreaker:
+    """
+    Abre depois de N falhas seguidas e deixa passar uma tentativa após reset_timeout
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half_open'
+        return 'open'
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # Meio aberto: deixa passar uma tentativa e volta a abrir até ela terminar
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.warning("Dialogflow indisponível, circuito aberto")
+                self.opened_at = time.monotonic()
+
+
+class KeywordIntentClassifier:
+    """
+    Classificador local usado quando o Dialogflow não responde a tempo
+    """
+
+    # Grupo de palavras-chave -> nome da intenção
+    GROUP_INTENTS = {
+        'greeting': 'greeting',
+        'category_request': 'show_categories',
+        'positive': 'confirm',
+        'negative': 'deny',
+        'delivery': 'delivery',
+        'pickup': 'pickup',
+        'payment_method': 'payment_method',
+        'quantity': 'quantity'
+    }
+
+    def __init__(self, matcher):
+        self.matcher = matcher
+
+    def classify(self, text):
+        text = normalize_query(text)
+        if text.isdigit():
+            return IntentResult('select_option', 1.0, '', 'fallback')
+
+        match = next(iter(self.matcher.find(text)), None)
+        if match is None or match.group not in self.GROUP_INTENTS:
+            return IntentResult('unknown', 0.0, '', 'fallback')
+        return IntentResult(self.GROUP_INTENTS[match.group], 0.5, '', 'fallback')
+
+
+class DialogflowGateway:
+    """
+    Acesso partilhado ao Dialogflow.
+
+    Usa um único SessionsClient (o canal gRPC e a autenticação são criados uma
+    vez), um pool de threads para impor o tempo limite de cada chamada, um
+    circuit breaker e um cache LRU texto normalizado -> intenção. Quando o
+    orçamento de tempo é excedido ou o circuito está aberto, responde com o
+    classificador local.
+    """
+
+    def __init__(self, project_id, language_code, dialogflow_module, fallback,
+                 timeout=1.5, cache_size=1000, max_workers=8, breaker=None):
+        self.project_id = project_id
+        self.language_code = language_code
+        self.timeout = timeout
+        self.fallback = fallback
+        self.cache = LRUCache(cache_size)
+        self.breaker = breaker or CircuitBreaker()
+        self._dialogflow = dialogflow_module
+        self._client = None
+        self._client_lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='dialogflow')
+        # Pool separado para detect_async, que fica à espera de tarefas do _pool
+        self._async_pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='dialogflow-async')
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = self._dialogflow.SessionsClient()
+        return self._client
+
+    def _call(self, session_id, text, language_code):
+        session = self.client.session_path(self.project_id, session_id)
+        text_input = self._dialogflow.types.TextInput(text=text, language_code=language_code)
+        query_input = self._dialogflow.types.QueryInput(text=text_input)
+        response = self.client.detect_intent(session=session, query_input=query_input, timeout=self.timeout)
+
+        query_result = response.query_result
+        return IntentResult(
+            query_result.intent.display_name,
+            query_result.intent_detection_confidence,
+            query_result.fulfillment_text,
+            'dialogflow'
+        )
+
+    def detect(self, session_id, text, language_code=None):
+        """
+        Detecta a intenção dentro do orçamento de tempo; nunca levanta exceções
+        """
+        language_code = language_code or self.language_code
+        key = (language_code, normalize_query(text))
+
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+
+        if not self.breaker.allow():
+            return self.fallback.classify(text)
+
+        future = self._pool.submit(self._call, session_id, text, language_code)
+        try:
+            result = future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            logger.warning("Dialogflow excedeu o tempo limite, usando classificador local")
+            self.breaker.record_failure()
+            return self.fallback.classify(text)
+        except Exception as e:
+            logger.error(f"Erro ao detectar intenção: {e}")
+            self.breaker.record_failure()
+            return self.fallback.classify(text)
+
+        self.breaker.record_success()
+        self.cache.put(key, result)
+        return result
+
+    def detect_async(self, session_id, text, language_code=None):
+        """
+        Versão assíncrona (thread): retorna um Future com o IntentResult
+        """
+        return self._async_pool.submit(self.detect, session_id, text, language_code)
+
+    async def detect_aio(self, session_id, text, language_code=None):
+        """
+        Versão asyncio de detect()
+        """
+        return await asyncio.wrap_future(self.detect_async(session_id, text, language_code))
+
+    def stats(self):
+        return {
+            'breaker': self.breaker.state,
+            'cache_hits': self.cache.hits,
+            'cache_misses': self.cache.misses
+        }
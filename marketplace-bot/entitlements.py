@@ -0,0 +1,180 @@
+import os
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from flask import g
+from sqlalchemy import func
+
+from models import db, Subscription, Payment, Establishment, ChatFlow, PlanType
+
+# Quanto tempo (segundos) um snapshot pode ser reutilizado entre pedidos
+ENTITLEMENTS_TTL = float(os.environ.get('ENTITLEMENTS_TTL', '30'))
+
+PlanLimits = namedtuple('PlanLimits', ['establishments', 'flows'])
+
+PLAN_LIMITS = {
+    PlanType.BASIC: PlanLimits(establishments=1, flows=5),
+    PlanType.MEDIUM: PlanLimits(establishments=3, flows=15),
+    PlanType.HIGH: PlanLimits(establishments=float('inf'), flows=float('inf'))
+}
+
+# Sem assinatura ativa não se cria nada
+NO_PLAN_LIMITS = PlanLimits(establishments=0, flows=0)
+
+
+class SubscriptionSnapshot:
+    """
+    Cópia das colunas da assinatura, segura para partilhar entre pedidos
+    (ao contrário do objeto ORM, que pertence a uma sessão). Os templates
+    usam-na como a Subscription; os pagamentos são consultados só quando pedidos.
+    """
+
+    __slots__ = tuple(column.key for column in Subscription.__table__.columns)
+
+    def __init__(self, subscription):
+        for field in self.__slots__:
+            setattr(self, field, getattr(subscription, field))
+
+    @property
+    def payments(self):
+        return Payment.query.filter_by(subscription_id=self.id).all()
+
+
+class Entitlements:
+    """
+    O que o lojista pode fazer: plano atual, limites e contagens já calculados
+    """
+
+    __slots__ = ('user_id', 'subscription', 'limits', 'establishment_count', 'flow_counts', 'loaded_at')
+
+    def __init__(self, user_id, subscription, establishment_count, flow_counts):
+        self.user_id = user_id
+        self.subscription = subscription
+        self.limits = PLAN_LIMITS[subscription.plan_type] if subscription else NO_PLAN_LIMITS
+        self.establishment_count = establishment_count
+        self.flow_counts = flow_counts  # id do estabelecimento -> número de fluxos
+        self.loaded_at = time.monotonic()
+
+    @property
+    def can_create_establishment(self):
+        return self.establishment_count < self.limits.establishments
+
+    def flow_count(self, establishment_id):
+        return self.flow_counts.get(establishment_id, 0)
+
+    def can_create_flow(self, establishment_id):
+        return self.flow_count(establishment_id) < self.limits.flows
+
+    def trial_days_left(self):
+        """
+        Dias restantes do trial (0 se expirou ou se não está em trial)
+        """
+        if not self.subscription or not self.subscription.is_trial:
+            return 0
+        return max((self.subscription.trial_end - datetime.utcnow()).days, 0)
+
+    def trial_status(self):
+        """
+        Estado do trial no formato de /api/trial-status
+        """
+        if not self.subscription:
+            return {'is_trial': False, 'days_left': 0, 'trial_expired': True}
+        if not self.subscription.is_trial:
+            return {'is_trial': False, 'days_left': 0, 'trial_expired': False}
+        days_left = self.trial_days_left()
+        return {'is_trial': True, 'days_left': days_left, 'trial_expired': days_left <= 0}
+
+    def trial_status_changes_at(self):
+        """
+        Próximo instante em que trial_status() muda sozinho (quando days_left desce),
+        ou None se só muda com uma alteração da assinatura
+        """
+        if not self.subscription or not self.subscription.is_trial:
+            return None
+        now = datetime.utcnow()
+        if self.subscription.trial_end <= now:
+            return None
+        return self.subscription.trial_end - timedelta(days=(self.subscription.trial_end - now).days)
+
+
+_cache = {}  # id do usuário -> Entitlements
+_cache_lock = threading.Lock()
+
+
+def load_entitlements(user_id, for_update=False):
+    """
+    Consulta a assinatura ativa e as contagens de estabelecimentos e fluxos do lojista.
+    Com for_update, a linha da assinatura fica bloqueada até ao fim da transação.
+    """
+    query = Subscription.query.filter_by(user_id=user_id, is_active=True)
+    if for_update:
+        query = query.with_for_update()
+    subscription = query.first()
+
+    # Estabelecimentos e fluxos de cada um numa única consulta agrupada
+    rows = db.session.query(
+        Establishment.id, func.count(ChatFlow.id)
+    ).outerjoin(
+        ChatFlow, ChatFlow.establishment_id == Establishment.id
+    ).filter(
+        Establishment.owner_id == user_id
+    ).group_by(Establishment.id).all()
+
+    return Entitlements(
+        user_id,
+        SubscriptionSnapshot(subscription) if subscription else None,
+        len(rows),
+        dict(rows)
+    )
+
+
+def cached_entitlements(user_id):
+    """
+    Retorna o snapshot partilhado entre pedidos, recarregando-o se passou do TTL
+    """
+    with _cache_lock:
+        entitlements = _cache.get(user_id)
+    if entitlements is None or time.monotonic() - entitlements.loaded_at >= ENTITLEMENTS_TTL:
+        entitlements = load_entitlements(user_id)
+        with _cache_lock:
+            _cache[user_id] = entitlements
+    return entitlements
+
+
+def get_entitlements(user_id):
+    """
+    Retorna os direitos do lojista: do pedido atual, do cache recente ou da base de dados
+    """
+    cached = g.get('entitlements')
+    if cached is not None and cached.user_id == user_id:
+        return cached
+
+    g.entitlements = cached_entitlements(user_id)
+    return g.entitlements
+
+
+def entitlements_for_write(user_id):
+    """
+    Direitos recalculados da base de dados, para impor um limite antes de criar algo.
+
+    O cache é por processo e invalidate_entitlements só limpa o worker atual,
+    então as contagens em cache podem não incluir o que outro worker acabou
+    de criar. A assinatura fica bloqueada até ao commit (no PostgreSQL), o que
+    serializa duas criações simultâneas do mesmo lojista.
+    """
+    entitlements = load_entitlements(user_id, for_update=True)
+    with _cache_lock:
+        _cache[user_id] = entitlements
+    g.entitlements = entitlements
+    return entitlements
+
+
+def invalidate_entitlements(user_id):
+    """
+    Descarta o snapshot do lojista; chamar depois de mudar plano, estabelecimentos ou fluxos
+    """
+    with _cache_lock:
+        _cache.pop(user_id, None)
+    g.pop('entitlements', None)
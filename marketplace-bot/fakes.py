@@ -0,0 +1,106 @@
+import itertools
+import threading
+import time
+from collections import namedtuple
+
+FakeMessage = namedtuple('FakeMessage', ['sid', 'from_', 'to', 'body'])
+
+
+class FakeMessageList:
+    """
+    Imitação de client.messages: guarda as mensagens em vez de as enviar
+    """
+
+    def __init__(self):
+        self.sent = []
+        self._lock = threading.Lock()
+        self._counter = itertools.count(1)
+
+    def create(self, body=None, from_=None, to=None, **kwargs):
+        with self._lock:
+            message = FakeMessage(f"SMfake{next(self._counter):08d}", from_, to, body)
+            self.sent.append(message)
+        return message
+
+    def sent_to(self, to):
+        with self._lock:
+            return [message for message in self.sent if message.to == to]
+
+    def clear(self):
+        with self._lock:
+            self.sent = []
+
+
+class FakeTwilioClient:
+    """
+    Cliente Twilio local para testes e desenvolvimento, sem acesso à rede
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.messages = FakeMessageList()
+
+
+class FakeQueryResult:
+    def __init__(self, intent, confidence, fulfillment_text):
+        self.intent = type('FakeIntent', (), {'display_name': intent})()
+        self.intent_detection_confidence = confidence
+        self.fulfillment_text = fulfillment_text
+
+
+class FakeDetectIntentResponse:
+    def __init__(self, query_result):
+        self.query_result = query_result
+
+
+class FakeSessionsClient:
+    """
+    Imitação de dialogflow.SessionsClient que responde a partir de uma tabela local
+    """
+
+    def __init__(self, server):
+        self.server = server
+
+    def session_path(self, project_id, session_id):
+        return f"projects/{project_id}/agent/sessions/{session_id}"
+
+    def detect_intent(self, session=None, query_input=None, timeout=None):
+        return self.server.detect_intent(session, query_input)
+
+
+class FakeDialogflow:
+    """
+    Substituto do módulo dialogflow para testes offline.
+
+    intents mapeia o texto (em minúsculas) para o nome da intenção; latency e
+    fail permitem simular lentidão e falhas do serviço.
+    """
+
+    TextInput = namedtuple('TextInput', ['text', 'language_code'])
+    QueryInput = namedtuple('QueryInput', ['text'])
+
+    def __init__(self, intents=None, latency=0.0, fail=False):
+        self.intents = intents or {}
+        self.latency = latency
+        self.fail = fail
+        self.calls = 0
+        self.clients_created = 0
+        self.types = self
+        self._lock = threading.Lock()
+
+    def SessionsClient(self):
+        with self._lock:
+            self.clients_created += 1
+        return FakeSessionsClient(self)
+
+    def detect_intent(self, session, query_input):
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.fail:
+            raise RuntimeError("Dialogflow indisponível (simulado)")
+
+        text = query_input.text.text.lower().strip()
+        intent = self.intents.get(text, 'Default Fallback Intent')
+        confidence = 1.0 if text in self.intents else 0.0
+        return FakeDetectIntentResponse(FakeQueryResult(intent, confidence, ''))
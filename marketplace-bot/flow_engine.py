@@ -0,0 +1,224 @@
+"""
+Execução dos fluxos de conversa desenhados pelos lojistas (ChatFlow.flow_data).
+
+Formato de flow_data:
+
+    {
+        "start": "boas_vindas",
+        "nodes": {
+            "boas_vindas": {
+                "message": {"pt": "Olá! Quer ver o menu ou saber o horário?", "en": "..."},
+                "transitions": [
+                    {"keywords": ["menu", "cardápio", "1"], "next": "menu"},
+                    {"keywords": ["horário", "2"], "next": "horario"}
+                ],
+                "default": "boas_vindas"
+            },
+            "horario": {"message": "Abrimos das 10h às 22h.", "transitions": [...]},
+            "menu": {"action": "show_menu"},
+            "fim": {"message": "Até breve!", "action": "end"}
+        }
+    }
+
+message pode ser um texto ou um texto por idioma. action é opcional:
+show_menu passa para o menu do estabelecimento e end termina a conversa.
+Um nó sem ação, sem transições e sem default é final (como end): a
+conversa volta ao início em vez de repetir a mensagem para sempre.
+"""
+import logging
+import threading
+import time
+
+from keyword_matcher import KeywordMatcher
+from models import ChatFlow
+
+logger = logging.getLogger(__name__)
+
+ACTIONS = ('show_menu', 'end')
+
+# Registos a avisar quando um fluxo é alterado no painel
+_registries = []
+
+
+class FlowError(ValueError):
+    """
+    flow_data inválido (nó inicial em falta, transição para um nó inexistente...)
+    """
+
+
+class FlowNode:
+    """
+    Nó compilado: as palavras-chave de todas as transições num único matcher
+    e a tabela grupo -> próximo nó
+    """
+
+    __slots__ = ('id', 'messages', 'action', 'matcher', 'targets', 'default')
+
+    def __init__(self, node_id, messages, action, matcher, targets, default):
+        self.id = node_id
+        self.messages = messages
+        self.action = action
+        self.matcher = matcher
+        self.targets = targets
+        self.default = default
+
+    def message(self, language):
+        return self.messages.get(language) or self.messages.get('pt') or next(iter(self.messages.values()), '')
+
+    def next_node(self, text):
+        """
+        Id do próximo nó para a mensagem: a palavra-chave que aparece primeiro, senão o default
+        """
+        if self.matcher is not None:
+            for match in self.matcher.find(text):
+                return self.targets[match.group]
+        return self.default
+
+
+class CompiledFlow:
+    __slots__ = ('flow_id', 'version', 'start', 'nodes')
+
+    def __init__(self, flow_id, version, start, nodes):
+        self.flow_id = flow_id
+        self.version = version
+        self.start = start
+        self.nodes = nodes
+
+
+def compile_flow(flow_id, version, flow_data):
+    """
+    Valida flow_data e constrói o grafo com os matchers de cada nó
+    """
+    if not isinstance(flow_data, dict) or not isinstance(flow_data.get('nodes'), dict):
+        raise FlowError("flow_data precisa de um objeto 'nodes'")
+    raw_nodes = flow_data['nodes']
+    start = flow_data.get('start')
+    if start not in raw_nodes:
+        raise FlowError(f"Nó inicial {start!r} não existe")
+
+    def check_target(node_id, target):
+        if target is not None and target not in raw_nodes:
+            raise FlowError(f"O nó {node_id!r} aponta para {target!r}, que não existe")
+        return target
+
+    nodes = {}
+    for node_id, raw in raw_nodes.items():
+        if not isinstance(raw, dict):
+            raise FlowError(f"O nó {node_id!r} precisa de ser um objeto")
+        messages = raw.get('message') or {}
+        if isinstance(messages, str):
+            messages = {'pt': messages}
+
+        action = raw.get('action')
+        if action is not None and action not in ACTIONS:
+            raise FlowError(f"Ação desconhecida {action!r} no nó {node_id!r}")
+
+        tables = {}
+        targets = {}
+        for position, transition in enumerate(raw.get('transitions') or []):
+            group = str(position)
+            tables[group] = [keyword.lower() for keyword in transition.get('keywords') or []]
+            targets[group] = check_target(node_id, transition.get('next'))
+
+        default = check_target(node_id, raw.get('default'))
+        if action is None and default is None and not any(target is not None for target in targets.values()):
+            # Sem saída possível: termina o fluxo
+            action = 'end'
+
+        nodes[node_id] = FlowNode(
+            node_id,
+            messages,
+            action,
+            KeywordMatcher(tables) if any(tables.values()) else None,
+            targets,
+            default
+        )
+
+    return CompiledFlow(flow_id, version, start, nodes)
+
+
+def invalidate_flow(flow_id):
+    """
+    Descarta o grafo compilado do fluxo em todos os registos deste processo
+    """
+    for registry in _registries:
+        registry.invalidate(flow_id)
+
+
+class FlowRegistry:
+    """
+    Fluxo ativo de cada estabelecimento, compilado uma única vez.
+
+    O mapa estabelecimento -> (id do fluxo, updated_at) vem de uma consulta
+    leve, revalidada no máximo a cada revalidate_interval segundos. Os grafos
+    ficam em cache por (id, updated_at): um fluxo editado é recompilado na
+    próxima vez que for usado, e os restantes continuam em cache.
+    """
+
+    def __init__(self, app, revalidate_interval=30.0):
+        self.app = app
+        self.revalidate_interval = revalidate_interval
+        self._active = {}    # id do estabelecimento -> (id do fluxo, versão)
+        self._compiled = {}  # id do fluxo -> (versão, CompiledFlow ou None se o flow_data é inválido)
+        self._lock = threading.Lock()
+        self._last_check = 0.0
+        self._stale = True
+        _registries.append(self)
+
+    def _revalidate(self):
+        now = time.monotonic()
+        if not self._stale and now - self._last_check < self.revalidate_interval:
+            return
+        self._last_check = now
+        self._stale = False
+
+        with self.app.app_context():
+            rows = ChatFlow.query.with_entities(
+                ChatFlow.id, ChatFlow.establishment_id, ChatFlow.updated_at
+            ).filter(
+                ChatFlow.is_active.is_(True)
+            ).order_by(ChatFlow.id).all()
+
+        active = {}
+        for flow_id, establishment_id, updated_at in rows:
+            # O fluxo ativo mais antigo é o que conduz a conversa
+            active.setdefault(establishment_id, (flow_id, updated_at.isoformat() if updated_at else ''))
+        self._active = active
+
+    def flow_for(self, establishment_id):
+        """
+        Retorna o fluxo compilado do estabelecimento, ou None se ele não tiver um
+        """
+        try:
+            self._revalidate()
+        except Exception as e:
+            logger.error(f"Erro ao carregar os fluxos de conversa: {e}")
+
+        key = self._active.get(establishment_id)
+        if key is None:
+            return None
+        flow_id, version = key
+
+        with self._lock:
+            cached = self._compiled.get(flow_id)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+
+        with self.app.app_context():
+            flow = ChatFlow.query.get(flow_id)
+            flow_data = flow.flow_data if flow else None
+        try:
+            compiled = compile_flow(flow_id, version, flow_data)
+        except FlowError as e:
+            # Um fluxo inválido não quebra a conversa: o estabelecimento segue com o menu
+            logger.error(f"Fluxo {flow_id} inválido: {e}")
+            compiled = None
+
+        with self._lock:
+            self._compiled[flow_id] = (version, compiled)
+        return compiled
+
+    def invalidate(self, flow_id):
+        with self._lock:
+            self._compiled.pop(flow_id, None)
+        self._stale = True
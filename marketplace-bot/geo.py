@@ -0,0 +1,183 @@
+"""
+Índice espacial dos estabelecimentos (Establishment.latitude/longitude).
+
+Os estabelecimentos ficam em baldes de uma grelha de cell_size graus (a
+mesma ideia das células de geohash). A pesquisa dos mais próximos percorre
+os anéis de células à volta do ponto e para assim que nenhuma célula mais
+distante pode ter um estabelecimento mais perto que os já encontrados, então
+uma mensagem nunca percorre todos os estabelecimentos.
+"""
+import math
+import threading
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """
+    Distância em linha reta (km) entre dois pontos
+    """
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def parse_location(latitude, longitude):
+    """
+    (latitude, longitude) de um pin do WhatsApp, ou None se faltar ou for inválido
+    """
+    try:
+        lat, lon = float(latitude), float(longitude)
+    except (TypeError, ValueError):
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return None
+    return lat, lon
+
+
+def delivery_fee(distance_km, base_fee, fee_per_km, rounding=5):
+    """
+    Taxa de entrega pela distância, arredondada para cima em múltiplos de rounding MT
+    """
+    fee = base_fee + fee_per_km * distance_km
+    return int(math.ceil(fee / rounding) * rounding)
+
+
+class Grid:
+    """
+    Baldes (linha, coluna) -> [(lat, lon, estabelecimento)]
+    """
+
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.max_abs_lat = 0.0
+        self.bounds = None  # (linha mínima, linha máxima, coluna mínima, coluna máxima)
+
+    def cell(self, lat, lon):
+        return int(math.floor(lat / self.cell_size)), int(math.floor(lon / self.cell_size))
+
+    def add(self, lat, lon, establishment):
+        row, col = self.cell(lat, lon)
+        self.cells.setdefault((row, col), []).append((lat, lon, establishment))
+        self.max_abs_lat = max(self.max_abs_lat, abs(lat))
+        if self.bounds is None:
+            self.bounds = (row, row, col, col)
+        else:
+            min_row, max_row, min_col, max_col = self.bounds
+            self.bounds = (min(min_row, row), max(max_row, row), min(min_col, col), max(max_col, col))
+
+    def ring(self, row, col, radius):
+        """
+        Células à distância (Chebyshev) radius da célula (row, col), só as dentro da área ocupada
+        """
+        min_row, max_row, min_col, max_col = self.bounds
+        first_col, last_col = max(col - radius, min_col), min(col + radius, max_col)
+        for r in (row - radius, row + radius) if radius else (row,):
+            if min_row <= r <= max_row:
+                for c in range(first_col, last_col + 1):
+                    yield r, c
+        if radius:
+            for c in (col - radius, col + radius):
+                if min_col <= c <= max_col:
+                    for r in range(max(row - radius + 1, min_row), min(row + radius - 1, max_row) + 1):
+                        yield r, c
+
+    def nearest(self, lat, lon, limit, max_distance_km=None, predicate=None):
+        if not self.cells:
+            return []
+        row, col = self.cell(lat, lon)
+        min_row, max_row, min_col, max_col = self.bounds
+        # Anéis que não tocam a área com estabelecimentos são saltados
+        min_radius = max(0, min_row - row, row - max_row, min_col - col, col - max_col)
+        max_radius = max(abs(row - min_row), abs(row - max_row), abs(col - min_col), abs(col - max_col))
+        # Largura mínima de uma célula em km (as colunas estreitam com a latitude)
+        widest_lat = min(89.0, max(abs(lat), self.max_abs_lat))
+        cell_km = self.cell_size * KM_PER_DEGREE * math.cos(math.radians(widest_lat))
+
+        found = []
+        for radius in range(min_radius, max_radius + 1):
+            for cell in self.ring(row, col, radius):
+                for point_lat, point_lon, establishment in self.cells.get(cell, ()):
+                    distance = haversine_km(lat, lon, point_lat, point_lon)
+                    if max_distance_km is not None and distance > max_distance_km:
+                        continue
+                    if predicate is not None and not predicate(establishment):
+                        continue
+                    found.append((distance, establishment))
+            # Tudo o que está fora deste anel fica a pelo menos radius células do ponto
+            bound = radius * cell_km
+            if max_distance_km is not None and bound > max_distance_km:
+                break
+            if len(found) >= limit and sorted(distance for distance, _ in found)[limit - 1] <= bound:
+                break
+
+        found.sort(key=lambda pair: pair[0])
+        return found[:limit]
+
+
+class GeoIndex:
+    """
+    Grelhas dos estabelecimentos com coordenadas: uma com todos e uma por
+    categoria. São reconstruídas quando a versão do catálogo muda.
+    """
+
+    def __init__(self, cell_size=0.05):
+        self.cell_size = cell_size  # ~5,5 km de latitude por célula
+        self._version = None
+        self._grids = {}
+        self._lock = threading.Lock()
+        self.rebuilds = 0
+        self.queries = 0
+
+    def _grids_for(self, catalog):
+        if catalog.version is not None and catalog.version == self._version:
+            return self._grids
+        with self._lock:
+            if catalog.version is None or catalog.version != self._version:
+                grids = {None: Grid(self.cell_size)}
+                for category in catalog.categories:
+                    grid = grids[category] = Grid(self.cell_size)
+                    for establishment in catalog.establishments(category):
+                        location = parse_location(establishment.get('latitude'), establishment.get('longitude'))
+                        if location is None:
+                            continue
+                        grid.add(location[0], location[1], establishment)
+                        grids[None].add(location[0], location[1], establishment)
+                self._grids = grids
+                self._version = catalog.version
+                self.rebuilds += 1
+            return self._grids
+
+    def nearest(self, catalog, lat, lon, limit=5, category=None, max_distance_km=None, predicate=None):
+        """
+        [(distância em km, estabelecimento)] dos mais próximos, opcionalmente
+        só da categoria e dos que passam no predicate
+        """
+        grid = self._grids_for(catalog).get(category)
+        self.queries += 1
+        if grid is None:
+            return []
+        return grid.nearest(lat, lon, limit, max_distance_km=max_distance_km, predicate=predicate)
+
+    def distance_to(self, catalog, establishment_id, lat, lon):
+        """
+        Distância (km) até ao estabelecimento, ou None se ele não tiver coordenadas
+        """
+        establishment = catalog.establishment(establishment_id)
+        location = parse_location(establishment.get('latitude'), establishment.get('longitude')) if establishment else None
+        if location is None:
+            return None
+        return haversine_km(lat, lon, location[0], location[1])
+
+    def stats(self):
+        grids = self._grids
+        return {
+            'establishments': sum(len(points) for points in grids[None].cells.values()) if None in grids else 0,
+            'cells': len(grids[None].cells) if None in grids else 0,
+            'rebuilds': self.rebuilds,
+            'queries': self.queries
+        }
@@ -0,0 +1,120 @@
+from collections import deque, namedtuple
+
+Match = namedtuple('Match', ['group', 'keyword', 'value', 'start', 'end'])
+
+
+def is_word_char(char):
+    return char.isalnum() or char == '_'
+
+
+class MatchSet:
+    """
+    Resultado de uma passagem do matcher sobre uma mensagem
+    """
+
+    def __init__(self, matches):
+        self.matches = matches
+        self._first_by_group = {}
+        # As ocorrências chegam ordenadas pela posição, então a primeira de
+        # cada grupo é a que aparece mais cedo na mensagem
+        for match in matches:
+            self._first_by_group.setdefault(match.group, match)
+
+    def has(self, group):
+        return group in self._first_by_group
+
+    def first(self, group):
+        """
+        Retorna a primeira ocorrência do grupo na mensagem (ou None)
+        """
+        return self._first_by_group.get(group)
+
+    def value(self, group, default=None):
+        match = self._first_by_group.get(group)
+        return match.value if match else default
+
+    def __iter__(self):
+        return iter(self.matches)
+
+    def __len__(self):
+        return len(self.matches)
+
+
+class KeywordMatcher:
+    """
+    Autómato de Aho-Corasick compilado a partir de tabelas de palavras-chave.
+
+    Uma única passagem sobre a mensagem encontra todas as ocorrências de
+    todas as tabelas. Só são aceites ocorrências de palavras inteiras, para
+    que 'um' não seja encontrado dentro de 'algum' nem 'oi' dentro de 'coisa'.
+    """
+
+    def __init__(self, tables):
+        # tables: {grupo: {palavra: valor}} ou {grupo: [palavras]}
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+        self._patterns = []
+
+        for group, keywords in tables.items():
+            if not isinstance(keywords, dict):
+                keywords = {keyword: keyword for keyword in keywords}
+            for keyword, value in keywords.items():
+                self._add(group, keyword.lower(), value)
+
+        self._build_failure_links()
+
+    def _add(self, group, keyword, value):
+        state = 0
+        for char in keyword:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            state = next_state
+        self._output[state].append(len(self._patterns))
+        self._patterns.append((group, keyword, value))
+
+    def _build_failure_links(self):
+        # Busca em largura: os filhos da raiz falham para a raiz
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def find(self, text):
+        """
+        Percorre o texto uma vez e retorna todas as ocorrências, por posição
+        """
+        text = text.lower()
+        goto, fail, output = self._goto, self._fail, self._output
+        matches = []
+        state = 0
+
+        for index, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for pattern_index in output[state]:
+                group, keyword, value = self._patterns[pattern_index]
+                start = index - len(keyword) + 1
+                end = index + 1
+                # Só aceita palavras inteiras
+                if start > 0 and is_word_char(text[start - 1]) and is_word_char(keyword[0]):
+                    continue
+                if end < len(text) and is_word_char(text[end]) and is_word_char(keyword[-1]):
+                    continue
+                matches.append(Match(group, keyword, value, start, end))
+
+        # Ordena pela posição inicial; em caso de empate, a mais longa primeiro
+        matches.sort(key=lambda match: (match.start, match.start - match.end))
+        return MatchSet(matches)
@@ -0,0 +1,258 @@
+"""
+Teste de carga do /webhook com conversas sintéticas do WhatsApp.
+
+Gera milhares de conversas completas (saudação -> categoria -> estabelecimento
+-> item -> quantidade -> entrega -> pagamento -> comprovativo), cada uma com o
+seu número de telefone, e envia-as como o Twilio envia (form-encoded). As
+escolhas são sorteadas a partir do catálogo JSON, para que todas as mensagens
+sejam válidas.
+
+As etapas correm em ondas: todas as conversas enviam a mensagem de uma etapa,
+com --concurrency pedidos em paralelo, antes de passarem à seguinte. Assim a
+latência (p50/p95/p99), o débito e o crescimento de memória (tracemalloc) de
+cada etapa não se misturam com os das outras.
+
+Por padrão a aplicação corre no próprio processo (app.test_client()), com o
+Twilio e o Dialogflow falsos. Com --url os pedidos vão para um servidor já em
+execução; nesse caso a memória não é medida.
+
+    python load_test.py [--conversations 2000] [--concurrency 50] [--seed 1]
+    python load_test.py --url http://localhost:5000 --conversations 500
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from catalog_loader import CatalogLoader
+
+# Etapas da conversa, pela ordem em que o usuário as percorre
+STAGES = (
+    'greeting', 'categories', 'category', 'establishment', 'item', 'quantity',
+    'more_items', 'delivery_method', 'delivery_details', 'payment_method', 'payment_proof'
+)
+
+ADDRESSES = ['Bairro Central, perto do mercado', 'Sommerschield, Rua 1301', 'Matola, ao lado da escola']
+PICKUP_TIMES = ['18h', '19h30', 'daqui a uma hora']
+
+
+def orderable_establishments(catalog):
+    """
+    Categoria -> estabelecimentos com itens no menu (as discotecas, por exemplo, não vendem pela conversa)
+    """
+    orderable = {}
+    for category in catalog.categories:
+        establishments = [establishment for establishment in catalog.establishments(category)
+                          if catalog.menu(establishment['id']).items]
+        if establishments:
+            orderable[category] = establishments
+    return orderable
+
+
+def build_conversation(catalog, orderable, rng):
+    """
+    Mensagens de uma conversa completa: {etapa: (texto, url da mídia)}
+    """
+    category = rng.choice(list(orderable))
+    establishment = rng.choice(orderable[category])
+    items = catalog.menu(establishment['id']).items
+    delivery = rng.random() < 0.5
+
+    return {
+        'greeting': ('oi', None),
+        'categories': ('categorias', None),
+        'category': (str(catalog.categories.index(category) + 1), None),
+        # Pelo nome: os números da lista mudam quando os estabelecimentos fechados são escondidos
+        'establishment': (establishment['nome'], None),
+        'item': (str(rng.randrange(len(items)) + 1), None),
+        'quantity': (str(rng.randint(1, 3)), None),
+        'more_items': ('não', None),
+        'delivery_method': ('entrega' if delivery else 'buscar', None),
+        'delivery_details': (rng.choice(ADDRESSES) if delivery else rng.choice(PICKUP_TIMES), None),
+        'payment_method': (str(rng.randint(1, 3)), None),
+        'payment_proof': ('', f"https://api.twilio.com/fake/media/{rng.getrandbits(32):08x}.jpg")
+    }
+
+
+def twilio_form(phone_number, text, media_url):
+    form = {'From': phone_number, 'To': 'whatsapp:+14155238886', 'Body': text, 'NumMedia': '0'}
+    if media_url:
+        form.update({'NumMedia': '1', 'MediaUrl0': media_url, 'MediaContentType0': 'image/jpeg'})
+    return form
+
+
+class InProcessTarget:
+    """
+    Envia os pedidos pelo test client do Flask (um cliente por thread)
+    """
+
+    measures_memory = True
+
+    def __init__(self, app, session_store):
+        self.app = app
+        self.session_store = session_store
+        self._local = threading.local()
+
+    def completed(self, phone_numbers):
+        """
+        Quantas conversas chegaram ao fim do pedido
+        """
+        return sum(
+            1 for phone_number in phone_numbers
+            if (self.session_store.get(phone_number) or {}).get('state') == 'order_completed'
+        )
+
+    def post(self, form):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        return client.post('/webhook', data=form).status_code
+
+
+class HttpTarget:
+    """
+    Envia os pedidos para um servidor em execução
+    """
+
+    measures_memory = False
+
+    def __init__(self, url, timeout=30):
+        self.url = url.rstrip('/') + '/webhook'
+        self.timeout = timeout
+
+    def completed(self, phone_numbers):
+        return None  # As sessões ficam no servidor
+
+    def post(self, form):
+        body = urllib.parse.urlencode(form).encode()
+        try:
+            with urllib.request.urlopen(self.url, data=body, timeout=self.timeout) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+
+def percentile(sorted_values, fraction):
+    """
+    Percentil pelo método do posto mais próximo
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(1, round(fraction * len(sorted_values) + 0.5))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def run_stage(target, stage, conversations, concurrency):
+    def send(conversation):
+        phone_number, messages = conversation
+        text, media_url = messages[stage]
+        started = time.perf_counter()
+        status = target.post(twilio_form(phone_number, text, media_url))
+        return (time.perf_counter() - started) * 1000, status
+
+    memory_before = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(send, conversations))
+    elapsed = time.perf_counter() - started
+    memory_after = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+
+    latencies = sorted(latency for latency, _ in results)
+    growth = memory_after - memory_before if memory_before is not None else None
+    return {
+        'stage': stage,
+        'requests': len(results),
+        'errors': sum(1 for _, status in results if status != 200),
+        'throughput_rps': round(len(results) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50), 3),
+        'p95_ms': round(percentile(latencies, 0.95), 3),
+        'p99_ms': round(percentile(latencies, 0.99), 3),
+        'max_ms': round(latencies[-1], 3) if latencies else 0.0,
+        'memory_growth_kb': round(growth / 1024, 1) if growth is not None else None,
+        'memory_per_conversation_b': round(growth / len(results)) if growth is not None and results else None
+    }
+
+
+def print_report(results, total_elapsed, peak_memory, completed, conversations):
+    header = f"{'etapa':<18}{'pedidos':>8}{'erros':>7}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}{'mem KB':>10}{'B/conv':>8}"
+    print(header)
+    print('-' * len(header))
+    for result in results:
+        memory_kb = '-' if result['memory_growth_kb'] is None else f"{result['memory_growth_kb']:.1f}"
+        per_conversation = '-' if result['memory_per_conversation_b'] is None else str(result['memory_per_conversation_b'])
+        print(
+            f"{result['stage']:<18}{result['requests']:>8}{result['errors']:>7}{result['throughput_rps']:>9.1f}"
+            f"{result['p50_ms']:>9.2f}{result['p95_ms']:>9.2f}{result['p99_ms']:>9.2f}{result['max_ms']:>9.2f}"
+            f"{memory_kb:>10}{per_conversation:>8}"
+        )
+    requests = sum(result['requests'] for result in results)
+    print(f"\n{requests} pedidos em {total_elapsed:.2f}s ({requests / total_elapsed:.1f} req/s)")
+    if completed is not None:
+        print(f"Conversas concluídas: {completed}/{conversations}")
+    if peak_memory is not None:
+        print(f"Pico de memória (tracemalloc): {peak_memory / 1024 / 1024:.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--conversations', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--url', help='Servidor em execução (padrão: a aplicação no próprio processo)')
+    parser.add_argument('--no-memory', action='store_true', help='Não mede a memória (tracemalloc atrasa os pedidos)')
+    parser.add_argument('--json', help='Grava os resultados neste arquivo')
+    args = parser.parse_args()
+
+    if args.url:
+        target = HttpTarget(args.url)
+    else:
+        # A aplicação é importada só agora, com o Twilio e o Dialogflow falsos
+        os.environ.setdefault('TWILIO_CLIENT', 'fake')
+        os.environ.setdefault('DIALOGFLOW_CLIENT', 'fake')
+        import app as bot
+        target = InProcessTarget(bot.app, bot.session_store)
+
+    catalog = CatalogLoader(os.environ.get('CATALOG_PATH', 'dados_estabelecimentos.json')).current().index
+    orderable = orderable_establishments(catalog)
+    rng = random.Random(args.seed)
+    conversations = [
+        (f"whatsapp:+25884{number:07d}", build_conversation(catalog, orderable, rng))
+        for number in range(args.conversations)
+    ]
+
+    measure_memory = target.measures_memory and not args.no_memory
+    if measure_memory:
+        tracemalloc.start()
+
+    results = []
+    started = time.perf_counter()
+    for stage in STAGES:
+        results.append(run_stage(target, stage, conversations, args.concurrency))
+    total_elapsed = time.perf_counter() - started
+
+    peak_memory = tracemalloc.get_traced_memory()[1] if measure_memory else None
+    if measure_memory:
+        tracemalloc.stop()
+
+    completed = target.completed([phone_number for phone_number, _ in conversations])
+    print_report(results, total_elapsed, peak_memory, completed, args.conversations)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'conversations': args.conversations, 'concurrency': args.concurrency,
+                       'elapsed_s': round(total_elapsed, 3), 'peak_memory_b': peak_memory,
+                       'completed': completed, 'stages': results}, f, indent=2)
+
+    if any(result['errors'] for result in results) or completed not in (None, args.conversations):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,6 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.orm import Session
 from datetime import datetime, timedelta
 import enum
 
@@ -37,6 +39,10 @@ class Subscription(db.Model):
     
     # Relações
     payments = db.relationship('Payment', backref='subscription', lazy=True)
+    
+    __table_args__ = (
+        db.Index('ix_subscription_user_active', 'user_id', 'is_active'),
+    )
 
 class Payment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -76,8 +82,12 @@ class Establishment(db.Model):
     phone_contact = db.Column(db.String(20))
     opening_hours = db.Column(db.String(200))
     average_rating = db.Column(db.Float, default=0.0)
+    # Avaliações aprovadas, mantidas por ratings.py na mesma transação que altera a Review
+    rating_count = db.Column(db.Integer, default=0, nullable=False)
+    rating_sum = db.Column(db.Integer, default=0, nullable=False)
     logo_url = db.Column(db.String(200))
     is_active = db.Column(db.Boolean, default=True)
+    menu_version = db.Column(db.Integer, default=0, nullable=False)  # Incrementado a cada alteração de produto (cache do catálogo)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -86,6 +96,10 @@ class Establishment(db.Model):
     promotions = db.relationship('Promotion', backref='establishment', lazy=True)
     reviews = db.relationship('Review', backref='establishment', lazy=True)
     orders = db.relationship('Order', backref='establishment', lazy=True)
+    
+    __table_args__ = (
+        db.Index('ix_establishment_owner', 'owner_id'),
+    )
 
 class Product(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -102,6 +116,10 @@ class Product(db.Model):
     
     # Relações
     order_items = db.relationship('OrderItem', backref='product', lazy=True)
+    
+    __table_args__ = (
+        db.Index('ix_product_establishment_available', 'establishment_id', 'is_available'),
+    )
 
 class Promotion(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -124,13 +142,15 @@ class Promotion(db.Model):
     free_product = db.relationship('Product', foreign_keys=[free_product_id])
 
 class Order(db.Model):
+    # active_history: o valor antigo das colunas do resumo diário é carregado mesmo
+    # depois de um commit, para que stats_rollup.py retire a contribuição anterior
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    establishment_id = db.Column(db.Integer, db.ForeignKey('establishment.id'), nullable=False)
-    order_status = db.Column(db.String(50), default="pending_payment")  # pending_payment, payment_received, preparing, ready_for_pickup, out_for_delivery, delivered, cancelled
-    total_amount = db.Column(db.Float, nullable=False)
+    establishment_id = db.column_property(db.Column(db.Integer, db.ForeignKey('establishment.id'), nullable=False), active_history=True)
+    order_status = db.column_property(db.Column(db.String(50), default="pending_payment"), active_history=True)  # pending_payment, payment_received, preparing, ready_for_pickup, out_for_delivery, delivered, cancelled
+    total_amount = db.column_property(db.Column(db.Float, nullable=False), active_history=True)
     currency = db.Column(db.String(3), default="MZN")
-    delivery_type = db.Column(db.String(20))  # delivery, pickup
+    delivery_type = db.column_property(db.Column(db.String(20)), active_history=True)  # delivery, pickup
     delivery_address = db.Column(db.String(200))
     delivery_neighborhood = db.Column(db.String(100))
     delivery_reference_point = db.Column(db.String(200))
@@ -141,12 +161,16 @@ class Order(db.Model):
     payment_status = db.Column(db.String(20), default="pending")  # pending, paid, failed
     payment_proof_url = db.Column(db.String(200))
     notes_from_user = db.Column(db.Text)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.column_property(db.Column(db.DateTime, default=datetime.utcnow), active_history=True)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     # Relações
     items = db.relationship('OrderItem', backref='order', lazy=True)
     reviews = db.relationship('Review', backref='order', lazy=True)
+    
+    __table_args__ = (
+        db.Index('ix_order_establishment_created', 'establishment_id', 'created_at'),
+    )
 
 class OrderItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -156,17 +180,44 @@ class OrderItem(db.Model):
     price_at_time_of_order = db.Column(db.Float, nullable=False)
     subtotal = db.Column(db.Float, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_order_item_order', 'order_id'),
+    )
+
+class DailyEstablishmentStats(db.Model):
+    """Resumo diário de vendas por estabelecimento, mantido incrementalmente (ver stats_rollup.py)"""
+    id = db.Column(db.Integer, primary_key=True)
+    establishment_id = db.Column(db.Integer, db.ForeignKey('establishment.id'), nullable=False)
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id'))  # Copiado do estabelecimento para agrupar por categoria
+    day = db.Column(db.Date, nullable=False)
+    order_count = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0.0)
+    cancelled_count = db.Column(db.Integer, nullable=False, default=0)
+    cancelled_revenue = db.Column(db.Float, nullable=False, default=0.0)
+    delivery_count = db.Column(db.Integer, nullable=False, default=0)
+    pickup_count = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        db.UniqueConstraint('establishment_id', 'day', name='uq_daily_stats_establishment_day'),
+    )
 
 class Review(db.Model):
+    # active_history: ratings.py precisa do valor antigo para corrigir os contadores do estabelecimento
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    establishment_id = db.Column(db.Integer, db.ForeignKey('establishment.id'), nullable=False)
+    establishment_id = db.column_property(db.Column(db.Integer, db.ForeignKey('establishment.id'), nullable=False), active_history=True)
     order_id = db.Column(db.Integer, db.ForeignKey('order.id'))
-    rating = db.Column(db.Integer, nullable=False)  # 1 a 5 estrelas
+    rating = db.column_property(db.Column(db.Integer, nullable=False), active_history=True)  # 1 a 5 estrelas
     comment = db.Column(db.Text)
-    review_status = db.Column(db.String(20), default="approved")  # pending_approval, approved, rejected
+    review_status = db.column_property(db.Column(db.String(20), default="approved"), active_history=True)  # pending_approval, approved, rejected
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_review_establishment', 'establishment_id'),
+    )
 
 class ChatbotConfig(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -193,3 +244,23 @@ class ChatFlow(db.Model):
     
     # Relação
     establishment = db.relationship('Establishment', backref='chat_flows')
+    
+    __table_args__ = (
+        db.Index('ix_chat_flow_establishment', 'establishment_id'),
+    )
+
+@event.listens_for(Session, 'before_flush')
+def bump_menu_versions(session, flush_context, instances):
+    """
+    Incrementa Establishment.menu_version na mesma transação que altera um produto,
+    para que os caches do catálogo do bot saibam que o menu mudou
+    """
+    changed = session.info.setdefault('catalog_changed_establishments', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Product) and obj.establishment_id is not None:
+            establishment = session.get(Establishment, obj.establishment_id)
+            if establishment is not None:
+                establishment.menu_version = (establishment.menu_version or 0) + 1
+            changed.add(obj.establishment_id)
+        elif isinstance(obj, Establishment) and obj.id is not None:
+            changed.add(obj.id)
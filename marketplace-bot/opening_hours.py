@@ -0,0 +1,183 @@
+"""
+Horários de funcionamento compilados a partir do texto livre do catálogo.
+
+Formatos aceites em horario_funcionamento / Establishment.opening_hours:
+
+    "18:00 - 23:00"
+    "19:00 - 00:00"                  (fecha à meia-noite)
+    "11:00 - 15:00, 18:00 - 22:00"   (vários períodos)
+    "22:00 - 04:00 (Sex, Sáb)"       (só nesses dias; atravessa a meia-noite)
+    "20:00 - 02:00 (Qui-Dom)"
+    "24h" / "fechado"
+
+Cada horário vira uma lista ordenada de intervalos em minutos da semana
+(0 = segunda-feira 00:00). Um período que termina depois da meia-noite
+pertence ao dia em que abre. Um texto que não se consegue interpretar
+fica sem horário (None) e o estabelecimento é tratado como aberto.
+"""
+import bisect
+import re
+import threading
+import time
+import unicodedata
+from datetime import datetime
+
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:  # Python < 3.9
+    ZoneInfo = None
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+
+DAYS = {
+    'seg': 0, 'segunda': 0, 'mon': 0, 'monday': 0,
+    'ter': 1, 'terca': 1, 'tue': 1, 'tuesday': 1,
+    'qua': 2, 'quarta': 2, 'wed': 2, 'wednesday': 2,
+    'qui': 3, 'quinta': 3, 'thu': 3, 'thursday': 3,
+    'sex': 4, 'sexta': 4, 'fri': 4, 'friday': 4,
+    'sab': 5, 'sabado': 5, 'sat': 5, 'saturday': 5,
+    'dom': 6, 'domingo': 6, 'sun': 6, 'sunday': 6
+}
+
+RANGE_RE = re.compile(r'(\d{1,2})\s*[:h]\s*(\d{2})?\s*(?:-|–|as|a|to)\s*(\d{1,2})\s*[:h]?\s*(\d{2})?')
+DAYS_RE = re.compile(r'\(([^)]*)\)')
+DAY_RANGE_RE = re.compile(r'([a-z]+)\s*(?:-|a|to)\s*([a-z]+)')
+ALWAYS_OPEN_RE = re.compile(r'\b24\s*h(oras)?\b|\b24/7\b')
+CLOSED_RE = re.compile(r'\bfechado\b|\bclosed\b')
+
+
+def fold(text):
+    decomposed = unicodedata.normalize('NFKD', text.lower())
+    return ''.join(char for char in decomposed if not unicodedata.combining(char))
+
+
+def parse_days(text):
+    """
+    Dias da semana (0-6) de um texto como 'Sex, Sáb' ou 'Qui-Dom'; None se não houver nenhum
+    """
+    days = set()
+    for part in text.split(','):
+        part = part.strip().rstrip('.')
+        day_range = DAY_RANGE_RE.fullmatch(part)
+        if day_range and day_range.group(1) in DAYS and day_range.group(2) in DAYS:
+            first, last = DAYS[day_range.group(1)], DAYS[day_range.group(2)]
+            day = first
+            while True:
+                days.add(day)
+                if day == last:
+                    break
+                day = (day + 1) % 7
+        elif part in DAYS:
+            days.add(DAYS[part])
+    return days or None
+
+
+class Schedule:
+    """
+    Intervalos [início, fim) em minutos da semana, ordenados e sem sobreposição
+    """
+
+    __slots__ = ('starts', 'ends')
+
+    def __init__(self, intervals):
+        merged = []
+        for start, end in sorted(intervals):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        self.starts = [start for start, _ in merged]
+        self.ends = [end for _, end in merged]
+
+    def is_open(self, minute_of_week):
+        index = bisect.bisect_right(self.starts, minute_of_week) - 1
+        return index >= 0 and minute_of_week < self.ends[index]
+
+
+def compile_hours(text):
+    """
+    Schedule do texto livre, ou None se ele não puder ser interpretado
+    """
+    if not text:
+        return None
+    folded = fold(text)
+    if CLOSED_RE.search(folded):
+        return Schedule([])
+    if ALWAYS_OPEN_RE.search(folded):
+        return Schedule([(0, MINUTES_PER_WEEK)])
+
+    days_match = DAYS_RE.search(folded)
+    days = parse_days(days_match.group(1)) if days_match else None
+    if days is None:
+        days = range(7)
+
+    daily = []
+    for match in RANGE_RE.finditer(DAYS_RE.sub(' ', folded)):
+        start_hour, start_minute, end_hour, end_minute = match.groups()
+        start = int(start_hour) * 60 + int(start_minute or 0)
+        end = int(end_hour) * 60 + int(end_minute or 0)
+        if start > MINUTES_PER_DAY or end > MINUTES_PER_DAY:
+            continue
+        if end <= start:
+            end += MINUTES_PER_DAY  # Atravessa a meia-noite
+        daily.append((start, end))
+    if not daily:
+        return None
+
+    intervals = []
+    for day in days:
+        for start, end in daily:
+            start, end = day * MINUTES_PER_DAY + start, day * MINUTES_PER_DAY + end
+            if end > MINUTES_PER_WEEK:
+                # Domingo à noite até segunda de madrugada
+                intervals.append((start, MINUTES_PER_WEEK))
+                intervals.append((0, end - MINUTES_PER_WEEK))
+            else:
+                intervals.append((start, end))
+    return Schedule(intervals)
+
+
+class OpenNow:
+    """
+    Conjunto dos estabelecimentos abertos no minuto atual.
+
+    É calculado uma vez por minuto (e por versão do catálogo) a partir dos
+    horários já compilados; as mensagens só consultam o conjunto.
+    """
+
+    def __init__(self, timezone_name='Africa/Maputo', clock=time.time):
+        self.timezone = ZoneInfo(timezone_name) if ZoneInfo is not None else None
+        self.clock = clock
+        self._key = None
+        self._open_ids = frozenset()
+        self._lock = threading.Lock()
+        self.refreshes = 0
+
+    def minute_of_week(self):
+        now = datetime.fromtimestamp(self.clock(), self.timezone)
+        return now.weekday() * MINUTES_PER_DAY + now.hour * 60 + now.minute
+
+    def open_ids(self, catalog):
+        minute = self.minute_of_week()
+        key = (catalog.version, minute)
+        if key == self._key:
+            return self._open_ids
+        with self._lock:
+            if key != self._key:
+                open_ids = set()
+                for category in catalog.categories:
+                    for establishment in catalog.establishments(category):
+                        schedule = catalog.schedule(establishment['id'])
+                        if schedule is None or schedule.is_open(minute):
+                            open_ids.add(establishment['id'])
+                self._open_ids = frozenset(open_ids)
+                self._key = key
+                self.refreshes += 1
+            return self._open_ids
+
+    def is_open(self, catalog, establishment_id):
+        return establishment_id in self.open_ids(catalog)
+
+    def stats(self):
+        return {'open': len(self._open_ids), 'refreshes': self.refreshes}
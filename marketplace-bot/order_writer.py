@@ -0,0 +1,175 @@
+import logging
+import queue
+import threading
+import time
+from collections import namedtuple
+
+from models import db, User, Order, OrderItem
+
+logger = logging.getLogger(__name__)
+
+PendingOrder = namedtuple('PendingOrder', [
+    'phone_number', 'establishment_id', 'lines', 'delivery_type', 'delivery_address',
+    'delivery_time_preference', 'delivery_fee', 'payment_method', 'payment_proof_url', 'total_amount'
+])
+
+# Uma linha do pedido: (id do produto, quantidade, preço unitário)
+PendingLine = namedtuple('PendingLine', ['product_id', 'quantity', 'unit_price'])
+
+
+def customer_phone(phone_number):
+    """
+    Telefone guardado no usuário: sem o prefixo 'whatsapp:' do Twilio
+    """
+    return phone_number.split(':', 1)[-1]
+
+
+class OrderWriter:
+    """
+    Grava os pedidos do bot em Order/OrderItem numa thread à parte.
+
+    submit() só coloca o pedido na fila, então o webhook nunca espera por um
+    commit. A thread junta os pedidos e grava-os numa única transação a cada
+    batch_size pedidos ou a cada flush_interval segundos, o que vier primeiro.
+    """
+
+    def __init__(self, app, batch_size=50, flush_interval=0.2, max_queue=10000):
+        self.app = app
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.written = 0
+        self.failed = 0
+        self.rejected = 0
+        self.batches = 0
+        self._thread = threading.Thread(target=self._run, name='order-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, order):
+        try:
+            self._queue.put_nowait(order)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            logger.error(f"Fila de pedidos cheia: pedido de {order.phone_number} não gravado")
+            return False
+        with self._lock:
+            self.submitted += 1
+        return True
+
+    def _run(self):
+        while True:
+            order = self._queue.get()
+            if order is None:
+                return
+            batch = [order]
+            deadline = time.monotonic() + self.flush_interval
+            stop = False
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    order = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if order is None:
+                    stop = True
+                    break
+                batch.append(order)
+
+            self._write_batch(batch)
+            if stop:
+                return
+
+    def _write_batch(self, batch):
+        with self.app.app_context():
+            try:
+                self._insert(batch)
+                db.session.commit()
+                written, failed = len(batch), 0
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Erro ao gravar {len(batch)} pedidos juntos, a gravar um a um: {e}")
+                # Isola o pedido com problema sem perder os restantes do lote
+                written, failed = 0, 0
+                for order in batch:
+                    try:
+                        self._insert([order])
+                        db.session.commit()
+                        written += 1
+                    except Exception as e:
+                        db.session.rollback()
+                        failed += 1
+                        logger.error(f"Pedido de {order.phone_number} não gravado: {e}")
+            finally:
+                db.session.remove()
+
+        with self._lock:
+            self.batches += 1
+            self.written += written
+            self.failed += failed
+
+    def _insert(self, batch):
+        customers = self._customers({customer_phone(order.phone_number) for order in batch})
+        for order in batch:
+            record = Order(
+                user_id=customers[customer_phone(order.phone_number)].id,
+                establishment_id=order.establishment_id,
+                total_amount=order.total_amount,
+                delivery_type=order.delivery_type,
+                delivery_address=order.delivery_address,
+                delivery_contact_phone=customer_phone(order.phone_number),
+                delivery_time_preference=order.delivery_time_preference,
+                delivery_fee=order.delivery_fee,
+                payment_method=order.payment_method,
+                payment_proof_url=order.payment_proof_url
+            )
+            for line in order.lines:
+                record.items.append(OrderItem(
+                    product_id=line.product_id,
+                    quantity=line.quantity,
+                    price_at_time_of_order=line.unit_price,
+                    subtotal=line.unit_price * line.quantity
+                ))
+            db.session.add(record)
+
+    def _customers(self, phones):
+        """
+        Usuários dos clientes pelo telefone, criando os que ainda não existem
+        """
+        customers = {user.phone: user for user in User.query.filter(User.phone.in_(phones))}
+        for phone in phones - customers.keys():
+            # Cliente do WhatsApp: sem e-mail real e sem senha utilizável no painel
+            customers[phone] = User(
+                name=phone,
+                email=f"{phone.lstrip('+')}@whatsapp.invalid",
+                password_hash='!',
+                phone=phone
+            )
+            db.session.add(customers[phone])
+        db.session.flush()
+        return customers
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending': self._queue.qsize(),
+                'submitted': self.submitted,
+                'written': self.written,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'batches': self.batches
+            }
+
+    def shutdown(self, timeout=None):
+        """
+        Grava o que ainda está na fila e para a thread
+        """
+        self._queue.put(None)
+        self._thread.join(timeout)
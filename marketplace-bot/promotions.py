@@ -0,0 +1,325 @@
+"""
+Preço da sacola com as promoções ativas de cada estabelecimento.
+
+Tipos de Promotion e como são aplicados:
+
+    percentage_discount  discount_value % sobre o produto exigido (required_product_id)
+                         ou, sem produto exigido, sobre o subtotal do estabelecimento
+    fixed_discount       discount_value MT sobre o produto exigido ou sobre o subtotal
+    buy_x_get_y_free     a cada discount_value unidades do produto exigido, uma unidade
+                         do free_product_id (o mesmo produto, se não for indicado) é grátis
+    free_item            uma unidade do free_product_id de oferta (descontada, se já
+                         estiver na sacola; senão, acrescentada como brinde)
+
+minimum_order_value vale sobre o subtotal do estabelecimento. Das promoções
+sem produto exigido (sobre o pedido todo) só a de maior desconto é
+aplicada; as de produto somam-se, até ao subtotal.
+"""
+import logging
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import Promotion
+
+logger = logging.getLogger(__name__)
+
+PROMOTION_TYPES = ('percentage_discount', 'fixed_discount', 'buy_x_get_y_free', 'free_item')
+
+# Motores a avisar quando um commit altera promoções
+_engines = []
+
+
+@event.listens_for(Session, 'after_flush')
+def track_promotion_changes(session, flush_context):
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(instance, Promotion):
+            session.info['promotions_changed'] = True
+            return
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_promotions(session):
+    if session.info.pop('promotions_changed', False):
+        for engine in _engines:
+            engine.invalidate()
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_promotion_changes(session):
+    session.info.pop('promotions_changed', None)
+
+
+class ActivePromotion:
+    """
+    Cópia de uma Promotion, independente da sessão do SQLAlchemy
+    """
+
+    __slots__ = ('id', 'establishment_id', 'title', 'kind', 'value', 'required_product_id',
+                 'free_product_id', 'minimum_order_value', 'start_date', 'end_date')
+
+    def __init__(self, promotion):
+        self.id = promotion.id
+        self.establishment_id = promotion.establishment_id
+        self.title = promotion.title
+        self.kind = promotion.promotion_type
+        self.value = promotion.discount_value or 0.0
+        self.required_product_id = promotion.required_product_id
+        self.free_product_id = promotion.free_product_id
+        self.minimum_order_value = promotion.minimum_order_value or 0.0
+        self.start_date = promotion.start_date
+        self.end_date = promotion.end_date
+
+
+class EstablishmentPricing:
+    __slots__ = ('discount', 'discounts', 'gifts')
+
+    def __init__(self, discount=0.0, discounts=(), gifts=()):
+        self.discount = discount
+        self.discounts = discounts  # [(título, valor)]
+        self.gifts = gifts          # [(id do produto, quantidade)]
+
+
+NO_DISCOUNT = EstablishmentPricing()
+
+
+class Pricing:
+    """
+    Preço da sacola: subtotal, descontos por promoção e brindes
+    """
+
+    __slots__ = ('subtotal', 'discount', 'discounts', 'gifts', 'by_establishment')
+
+    def __init__(self, subtotal, by_establishment=None):
+        self.subtotal = subtotal
+        self.by_establishment = by_establishment or {}
+        self.discount = round(sum(pricing.discount for pricing in self.by_establishment.values()), 2)
+        self.discounts = [
+            (establishment_id, title, amount)
+            for establishment_id, pricing in self.by_establishment.items()
+            for title, amount in pricing.discounts
+        ]
+        self.gifts = [
+            (establishment_id, product_id, quantity)
+            for establishment_id, pricing in self.by_establishment.items()
+            for product_id, quantity in pricing.gifts
+        ]
+
+    @property
+    def total(self):
+        return self.subtotal - self.discount if self.discount else self.subtotal
+
+    def establishment_discount(self, establishment_id):
+        return self.by_establishment.get(establishment_id, NO_DISCOUNT).discount
+
+
+class PromotionBook:
+    """
+    Promoções ativas de um estabelecimento: as do pedido todo e as indexadas pelo produto exigido
+    """
+
+    __slots__ = ('order_level', 'by_product')
+
+    def __init__(self, promotions):
+        self.order_level = []
+        self.by_product = {}
+        for promotion in promotions:
+            if promotion.required_product_id is None:
+                self.order_level.append(promotion)
+            else:
+                self.by_product.setdefault(promotion.required_product_id, []).append(promotion)
+
+    def evaluate(self, lines, subtotal, price_of):
+        """
+        Descontos e brindes para as linhas do estabelecimento (item_id -> CartLine)
+        """
+        discounts = []
+        gifts = []
+        product_discount = 0.0
+
+        for product_id, line in lines.items():
+            for promotion in self.by_product.get(product_id, ()):
+                if subtotal < promotion.minimum_order_value:
+                    continue
+                if promotion.kind == 'percentage_discount':
+                    amount = line.subtotal * promotion.value / 100
+                elif promotion.kind == 'fixed_discount':
+                    amount = min(promotion.value, line.subtotal)
+                elif promotion.kind == 'buy_x_get_y_free':
+                    amount = self._buy_x_get_y(promotion, line, lines)
+                elif promotion.kind == 'free_item':
+                    amount = self._free_item(promotion, lines, gifts, price_of)
+                else:
+                    continue
+                if amount > 0:
+                    discounts.append((promotion.title, round(amount, 2)))
+                    product_discount += amount
+
+        best = None
+        for promotion in self.order_level:
+            if subtotal < promotion.minimum_order_value:
+                continue
+            if promotion.kind == 'free_item':
+                amount = self._free_item(promotion, lines, gifts, price_of)
+                if amount > 0:
+                    discounts.append((promotion.title, round(amount, 2)))
+                    product_discount += amount
+                continue
+            if promotion.kind == 'percentage_discount':
+                amount = subtotal * promotion.value / 100
+            elif promotion.kind == 'fixed_discount':
+                amount = promotion.value
+            else:
+                continue
+            if amount > 0 and (best is None or amount > best[1]):
+                best = (promotion.title, amount)
+
+        discount = product_discount
+        if best is not None:
+            discounts.append((best[0], round(best[1], 2)))
+            discount += best[1]
+        if not discounts and not gifts:
+            return NO_DISCOUNT
+        return EstablishmentPricing(round(min(discount, subtotal), 2), discounts, gifts)
+
+    @staticmethod
+    def _buy_x_get_y(promotion, line, lines):
+        required = max(1, int(promotion.value or 1))
+        free_product_id = promotion.free_product_id or promotion.required_product_id
+        if free_product_id == promotion.required_product_id:
+            return (line.quantity // (required + 1)) * line.unit_price
+        free_line = lines.get(free_product_id)
+        if free_line is None:
+            return 0.0
+        return min(line.quantity // required, free_line.quantity) * free_line.unit_price
+
+    @staticmethod
+    def _free_item(promotion, lines, gifts, price_of):
+        if promotion.free_product_id is None:
+            return 0.0
+        free_line = lines.get(promotion.free_product_id)
+        if free_line is not None:
+            return free_line.unit_price
+        if price_of(promotion.free_product_id) is not None:
+            gifts.append((promotion.free_product_id, 1))
+        return 0.0
+
+
+class PromotionEngine:
+    """
+    Promoções ativas por estabelecimento, carregadas numa única consulta.
+
+    As promoções ainda não terminadas ficam em memória; o conjunto ativo
+    (PromotionBook por estabelecimento) só é recalculado quando passa o
+    próximo start_date ou end_date, sem voltar à base de dados. A consulta
+    é repetida quando um commit altera promoções ou, no máximo, a cada
+    revalidate_interval segundos (alterações feitas por outros processos).
+    """
+
+    def __init__(self, app, revalidate_interval=30.0, clock=datetime.utcnow):
+        self.app = app
+        self.revalidate_interval = revalidate_interval
+        self.clock = clock
+        self._promotions = []
+        self._books = {}
+        self._next_boundary = None
+        self._last_load = 0.0
+        self._stale = True
+        self._lock = threading.Lock()
+        self.generation = 0
+        self.loads = 0
+        self.rebuilds = 0
+        _engines.append(self)
+
+    def _load(self, now):
+        with self.app.app_context():
+            rows = Promotion.query.filter(
+                Promotion.is_active.is_(True),
+                Promotion.end_date > now,
+                Promotion.promotion_type.in_(PROMOTION_TYPES)
+            ).all()
+            self._promotions = [ActivePromotion(promotion) for promotion in rows]
+        self.loads += 1
+
+    def _rebuild(self, now):
+        active = {}
+        next_boundary = None
+        for promotion in self._promotions:
+            if promotion.start_date <= now < promotion.end_date:
+                active.setdefault(promotion.establishment_id, []).append(promotion)
+            for boundary in (promotion.start_date, promotion.end_date):
+                if boundary > now and (next_boundary is None or boundary < next_boundary):
+                    next_boundary = boundary
+        self._books = {establishment_id: PromotionBook(promotions) for establishment_id, promotions in active.items()}
+        self._next_boundary = next_boundary
+        self.generation += 1
+        self.rebuilds += 1
+
+    def _refresh(self):
+        now = self.clock()
+        monotonic = time.monotonic()
+        reload = self._stale or monotonic - self._last_load >= self.revalidate_interval
+        if not reload and (self._next_boundary is None or now < self._next_boundary):
+            return
+        with self._lock:
+            if self._stale or time.monotonic() - self._last_load >= self.revalidate_interval:
+                self._stale = False
+                self._last_load = time.monotonic()
+                try:
+                    self._load(now)
+                except Exception as e:
+                    # Sem base de dados, continua com as promoções já carregadas
+                    logger.error(f"Erro ao carregar as promoções: {e}")
+                self._rebuild(now)
+            elif self._next_boundary is not None and now >= self._next_boundary:
+                self._rebuild(now)
+
+    def book(self, establishment_id):
+        self._refresh()
+        return self._books.get(establishment_id)
+
+    def price(self, cart, catalog):
+        """
+        Preço da sacola; o resultado de cada estabelecimento fica na sacola
+        até uma das suas linhas mudar ou as promoções ativas mudarem
+        """
+        self._refresh()
+        generation = self.generation
+        lines_by_establishment = {}
+        for line in cart:
+            lines_by_establishment.setdefault(line.establishment_id, {})[line.item_id] = line
+
+        by_establishment = {}
+        for establishment_id, lines in lines_by_establishment.items():
+            cached = cart.priced.get(establishment_id)
+            if cached is not None and cached[0] == generation:
+                by_establishment[establishment_id] = cached[1]
+                continue
+            book = self._books.get(establishment_id)
+            if book is None:
+                pricing = NO_DISCOUNT
+            else:
+                def price_of(product_id, establishment_id=establishment_id):
+                    item = catalog.menu(establishment_id).item(product_id)
+                    return item['preco'] if item else None
+                pricing = book.evaluate(lines, cart.establishment_subtotals[establishment_id], price_of)
+            cart.priced[establishment_id] = (generation, pricing)
+            by_establishment[establishment_id] = pricing
+        return Pricing(cart.subtotal, by_establishment)
+
+    def invalidate(self):
+        self._stale = True
+
+    def stats(self):
+        return {
+            'loaded': len(self._promotions),
+            'establishments': len(self._books),
+            'active': sum(len(book.order_level) + sum(len(p) for p in book.by_product.values())
+                          for book in self._books.values()),
+            'next_boundary': self._next_boundary.isoformat() if self._next_boundary else None,
+            'loads': self.loads,
+            'rebuilds': self.rebuilds
+        }
@@ -0,0 +1,132 @@
+import logging
+
+from sqlalchemy import event, func, inspect, select, update
+
+from models import db, Establishment, Review
+from stats_rollup import previous_value
+
+logger = logging.getLogger(__name__)
+
+establishment_table = Establishment.__table__
+
+# Só as avaliações aprovadas contam para a média do estabelecimento
+COUNTED_STATUS = 'approved'
+
+
+def average(rating_sum, rating_count):
+    return rating_sum / rating_count if rating_count else 0.0
+
+
+def apply_rating_delta(connection, establishment_id, count, total):
+    """
+    Soma count avaliações com total estrelas aos contadores do estabelecimento,
+    num único UPDATE atômico (a média é recalculada a partir dos novos valores)
+    """
+    if not count and not total:
+        return
+    new_count = establishment_table.c.rating_count + count
+    new_sum = establishment_table.c.rating_sum + total
+    connection.execute(
+        update(establishment_table).where(
+            establishment_table.c.id == establishment_id
+        ).values(
+            rating_count=new_count,
+            rating_sum=new_sum,
+            average_rating=db.case(
+                (new_count > 0, db.cast(new_sum, db.Float) / new_count),
+                else_=0.0
+            )
+        )
+    )
+
+
+def mark_catalog_changed(review, *establishment_ids):
+    """
+    Avisa o catálogo do bot (db_catalog) de que a avaliação destes estabelecimentos mudou
+    """
+    session = inspect(review).session
+    if session is not None:
+        session.info.setdefault('catalog_changed_establishments', set()).update(establishment_ids)
+
+
+@event.listens_for(Review, 'after_insert')
+def count_review_created(mapper, connection, review):
+    if review.review_status == COUNTED_STATUS:
+        apply_rating_delta(connection, review.establishment_id, 1, review.rating)
+        mark_catalog_changed(review, review.establishment_id)
+
+
+@event.listens_for(Review, 'after_update')
+def count_review_updated(mapper, connection, review):
+    state = inspect(review)
+    tracked = ('rating', 'review_status', 'establishment_id')
+    if not any(state.attrs[attribute].history.has_changes() for attribute in tracked):
+        return
+
+    # Retira a contribuição antiga e soma a nova (cobre aprovação, rejeição e mudança de nota)
+    old_establishment_id = previous_value(state, 'establishment_id')
+    if previous_value(state, 'review_status') == COUNTED_STATUS:
+        apply_rating_delta(connection, old_establishment_id, -1, -previous_value(state, 'rating'))
+        mark_catalog_changed(review, old_establishment_id)
+    count_review_created(mapper, connection, review)
+
+
+@event.listens_for(Review, 'after_delete')
+def count_review_deleted(mapper, connection, review):
+    if review.review_status == COUNTED_STATUS:
+        apply_rating_delta(connection, review.establishment_id, -1, -review.rating)
+        mark_catalog_changed(review, review.establishment_id)
+
+
+def repair_ratings(connection):
+    """
+    Recalcula rating_count/rating_sum/average_rating de todos os estabelecimentos a partir
+    das avaliações aprovadas, numa consulta agrupada. Retorna quantos estavam diferentes.
+    """
+    review_table = Review.__table__
+    totals = {
+        establishment_id: (count, total)
+        for establishment_id, count, total in connection.execute(
+            select(
+                review_table.c.establishment_id,
+                func.count(review_table.c.id),
+                func.coalesce(func.sum(review_table.c.rating), 0)
+            ).where(
+                review_table.c.review_status == COUNTED_STATUS
+            ).group_by(review_table.c.establishment_id)
+        )
+    }
+
+    rows = []
+    for establishment_id, count, total, average_rating in connection.execute(
+        select(
+            establishment_table.c.id,
+            establishment_table.c.rating_count,
+            establishment_table.c.rating_sum,
+            establishment_table.c.average_rating
+        )
+    ):
+        expected_count, expected_sum = totals.get(establishment_id, (0, 0))
+        expected_average = average(expected_sum, expected_count)
+        if (count, total) != (expected_count, expected_sum) or average_rating is None \
+                or abs(average_rating - expected_average) > 1e-9:
+            rows.append({
+                'target_id': establishment_id,
+                'rating_count': expected_count,
+                'rating_sum': expected_sum,
+                'average_rating': expected_average
+            })
+
+    if rows:
+        connection.execute(
+            update(establishment_table).where(
+                establishment_table.c.id == db.bindparam('target_id')
+            ).values(
+                rating_count=db.bindparam('rating_count'),
+                rating_sum=db.bindparam('rating_sum'),
+                average_rating=db.bindparam('average_rating')
+            ),
+            rows
+        )
+    logger.info(f"Avaliações recalculadas: {len(rows)} estabelecimentos corrigidos")
+    return len(rows)
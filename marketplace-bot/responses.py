@@ -0,0 +1,189 @@
+import threading
+from collections import OrderedDict
+
+# Textos das respostas por idioma; os campos entre chaves são preenchidos com str.format
+TEMPLATES = {
+    'categories_header': {
+        'pt': "Temos uma variedade de opções para si! As nossas categorias principais são:\n\n",
+        'en': "We have a variety of options for you! Our main categories are:\n\n"
+    },
+    'categories_footer': {
+        'pt': "\nEm qual delas está interessado(a)?",
+        'en': "\nWhich one are you interested in?"
+    },
+    'establishments_header': {
+        'pt': "Ótimo! Aqui estão os estabelecimentos disponíveis na categoria {category}:\n\n",
+        'en': "Great! Here are the available establishments in the {category} category:\n\n"
+    },
+    'establishments_footer': {
+        'pt': "\nQual deles gostaria de explorar?",
+        'en': "\nWhich one would you like to explore?"
+    },
+    'menu_header': {
+        'pt': "Excelente escolha! Aqui está o menu/catálogo de {name}:\n\n",
+        'en': "Excellent choice! Here's the menu/catalog from {name}:\n\n"
+    },
+    'menu_details': {
+        'pt': "\nLocalização: {address}\nHorário de funcionamento: {hours}\nAvaliação: ⭐ {rating}\n\n",
+        'en': "\nLocation: {address}\nOpening hours: {hours}\nRating: ⭐ {rating}\n\n"
+    },
+    'menu_footer': {
+        'pt': "O que gostaria de pedir?",
+        'en': "What would you like to order?"
+    },
+    'menu_again_header': {
+        'pt': "Claro! Aqui está novamente o menu/catálogo de {name}:\n\n",
+        'en': "Sure! Here's the menu/catalog from {name} again:\n\n"
+    },
+    'menu_again_footer': {
+        'pt': "O que mais gostaria de pedir?",
+        'en': "What else would you like to order?"
+    }
+}
+
+CATEGORY_EMOJIS = {
+    'pizzarias': "🍔",
+    'restaurantes': "🍔",
+    'brechos': "🛍️",
+    'boutiques': "🛍️",
+    'eletronicos': "🛍️",
+    'ferragens': "🛍️",
+    'discotecas': "🎵"
+}
+
+
+def template(name, language):
+    texts = TEMPLATES[name]
+    return texts.get(language) or texts['en']
+
+
+def item_name(catalog, establishment_id, item_id):
+    """
+    Nome do item no catálogo atual (o id, se o item já não existir)
+    """
+    establishment = catalog.establishment(establishment_id)
+    item = catalog.menu(establishment_id).item(item_id) if establishment else None
+    return item['nome'] if item else f"#{item_id}"
+
+
+def cart_lines(cart, catalog):
+    """
+    Linhas da sacola ('• 2x Pizza - 500 MT'), cada uma terminada em quebra de linha
+    """
+    return ''.join(
+        f"• {line.quantity}x {item_name(catalog, line.establishment_id, line.item_id)} - {line.subtotal} MT\n"
+        for line in cart
+    )
+
+
+def promotion_lines(pricing, catalog, language='pt'):
+    """
+    Descontos e brindes das promoções ('🎁 Pizza em dobro - -250.0 MT'); vazio sem promoções
+    """
+    free = 'oferta' if language == 'pt' else 'free'
+    lines = ''.join(f"🎁 {title} - -{amount} MT\n" for _, title, amount in pricing.discounts)
+    lines += ''.join(
+        f"🎁 {quantity}x {item_name(catalog, establishment_id, product_id)} ({free}) - 0 MT\n"
+        for establishment_id, product_id, quantity in pricing.gifts
+    )
+    return lines
+
+
+class ResponseRenderer:
+    """
+    Respostas do catálogo pré-renderizadas por idioma.
+
+    A lista de categorias, as listas de estabelecimentos e os menus só
+    dependem do catálogo, então ficam em cache pela versão do snapshot: um
+    recarregamento muda a versão e as entradas antigas deixam de ser usadas
+    (e saem do cache assim que a nova versão aparece).
+    """
+
+    def __init__(self, cache_size=2000):
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _cached(self, catalog, key, build):
+        cache_key = (catalog.version,) + key
+        with self._lock:
+            if catalog.version != self._version:
+                # Catálogo recarregado: nada do snapshot anterior volta a ser usado
+                self._cache.clear()
+                self._version = catalog.version
+            text = self._cache.get(cache_key)
+            if text is not None:
+                self._cache.move_to_end(cache_key)
+                self.hits += 1
+                return text
+            self.misses += 1
+
+        text = build()
+        with self._lock:
+            if catalog.version == self._version:
+                self._cache[cache_key] = text
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return text
+
+    def categories(self, catalog, language):
+        def build():
+            lines = [
+                f"{CATEGORY_EMOJIS.get(category, '📦')} {position}. {category.capitalize()}\n"
+                for position, category in enumerate(catalog.categories, 1)
+            ]
+            return ''.join([template('categories_header', language)] + lines + [template('categories_footer', language)])
+        return self._cached(catalog, ('categories', language), build)
+
+    def establishments(self, catalog, category, language, listed_ids=None):
+        """
+        Lista dos estabelecimentos da categoria; listed_ids restringe a lista (ex.: só os abertos)
+        """
+        def build():
+            establishments = catalog.establishments(category)
+            if listed_ids is not None:
+                establishments = [catalog.establishment(establishment_id) for establishment_id in listed_ids]
+            lines = [
+                f"{position}. {establishment['nome']} - ⭐ {establishment['avaliacao_media']}\n"
+                for position, establishment in enumerate(establishments, 1)
+            ]
+            header = template('establishments_header', language).format(category=category.capitalize())
+            return ''.join([header] + lines + [template('establishments_footer', language)])
+        listed_key = tuple(listed_ids) if listed_ids is not None else None
+        return self._cached(catalog, ('establishments', category, language, listed_key), build)
+
+    def _menu_items(self, catalog, establishment_id):
+        return ''.join(
+            f"{position}. {item['nome']} - {item['preco']} MT\n   {item['descricao']}\n\n"
+            for position, item in enumerate(catalog.menu(establishment_id).items, 1)
+        )
+
+    def menu(self, catalog, establishment, language, again=False):
+        """
+        Menu completo do estabelecimento; again=True é a versão curta de quando o usuário quer mais itens
+        """
+        def build():
+            if again:
+                return ''.join([
+                    template('menu_again_header', language).format(name=establishment['nome']),
+                    self._menu_items(catalog, establishment['id']),
+                    template('menu_again_footer', language)
+                ])
+            return ''.join([
+                template('menu_header', language).format(name=establishment['nome']),
+                self._menu_items(catalog, establishment['id']),
+                template('menu_details', language).format(
+                    address=establishment['endereco'],
+                    hours=establishment['horario_funcionamento'],
+                    rating=establishment['avaliacao_media']
+                ),
+                template('menu_footer', language)
+            ])
+        return self._cached(catalog, ('menu', establishment['id'], language, again), build)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._cache), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,287 @@
+"""
+Pesquisa de produtos em todo o marketplace a partir de uma mensagem livre.
+
+Cada item é indexado pelo nome (com peso maior) e pela descrição, depois de
+remover acentos e plurais simples. A pontuação é BM25; as palavras da
+pesquisa que não existem no vocabulário são trocadas pelas mais parecidas,
+encontradas por trigramas ('calabreza' -> 'calabresa', 'queijo' ->
+'queijos'), com o peso reduzido pela semelhança.
+
+O índice é dividido em segmentos, um por estabelecimento. Quando o catálogo
+muda, só os segmentos cujo menu mudou são reconstruídos, com os menus
+carregados de uma só vez.
+"""
+import heapq
+import math
+import threading
+import time
+import unicodedata
+from collections import Counter, namedtuple
+
+from catalog_index import TOKEN_RE, stem
+
+# Repetições do nome do item no documento (o nome pesa mais que a descrição)
+NAME_WEIGHT = 2
+
+# Semelhança mínima (Dice dos trigramas) para trocar uma palavra desconhecida
+MIN_SIMILARITY = 0.5
+
+# Palavras desconhecidas são trocadas, no máximo, por estas alternativas
+MAX_EXPANSIONS = 3
+
+# Resultados com menos que esta fração da melhor pontuação são descartados
+MIN_RELATIVE_SCORE = 0.3
+
+# Palavras ignoradas na pesquisa ('quero uma pizza de frango' -> 'pizza frango')
+STOP_WORDS = frozenset([
+    'a', 'o', 'as', 'os', 'um', 'uma', 'uns', 'umas', 'de', 'da', 'do', 'das', 'dos',
+    'e', 'em', 'no', 'na', 'com', 'para', 'pra', 'por', 'que', 'quero', 'queria',
+    'gostaria', 'tem', 'tens', 'ha', 'me', 'ver', 'algum', 'alguma',
+    'i', 'an', 'the', 'of', 'with', 'and', 'for', 'want', 'like', 'some', 'any', 'have', 'you'
+])
+
+# coverage: fração das palavras da pesquisa encontradas no item; name_coverage: só no nome
+SearchHit = namedtuple('SearchHit', ['establishment_id', 'item_id', 'score', 'coverage', 'name_coverage'])
+
+
+def fold(text):
+    """
+    Minúsculas e sem acentos ('Calabresa Média' -> 'calabresa media')
+    """
+    decomposed = unicodedata.normalize('NFKD', text.lower())
+    return ''.join(char for char in decomposed if not unicodedata.combining(char))
+
+
+def search_tokens(text):
+    return [stem(token) for token in TOKEN_RE.findall(fold(text))]
+
+
+def trigrams(term):
+    padded = f" {term} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def menu_signature(establishment):
+    """
+    O que identifica o conteúdo do menu: o menu_version no catálogo da base
+    de dados, os nomes e descrições dos itens no catálogo JSON
+    """
+    if 'menu_version' in establishment:
+        return establishment['menu_version']
+    items = establishment.get('menu') or establishment.get('produtos') or []
+    return tuple((item.get('nome'), item.get('descricao')) for item in items)
+
+
+class Segment:
+    """
+    Itens de um estabelecimento: ids, comprimentos, termos do nome e postings termo -> [(posição, frequência)]
+    """
+
+    __slots__ = ('signature', 'item_ids', 'lengths', 'name_terms', 'postings')
+
+    def __init__(self, signature, menu):
+        self.signature = signature
+        self.item_ids = list(menu.item_ids)
+        self.lengths = []
+        self.name_terms = []
+        self.postings = {}
+        for position, item in enumerate(menu.items):
+            name_tokens = search_tokens(item['nome'])
+            self.name_terms.append(frozenset(name_tokens))
+            tokens = name_tokens * NAME_WEIGHT + search_tokens(item.get('descricao') or '')
+            self.lengths.append(len(tokens))
+            for term, frequency in Counter(tokens).items():
+                self.postings.setdefault(term, []).append((position, frequency))
+
+
+class SearchIndex:
+    """
+    Índice BM25 dos itens do catálogo, com tolerância a erros de digitação.
+
+    Segue o catálogo atual: search() compara a versão do catálogo e, se ela
+    mudou, reconstrói só os segmentos dos estabelecimentos cujo menu mudou
+    (e retira os que desapareceram).
+    """
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self._segments = {}    # id do estabelecimento -> Segment
+        self._postings = {}    # termo -> {id do estabelecimento: [(posição, frequência)]}
+        self._df = Counter()   # termo -> número de itens que o contêm
+        self._trigrams = {}    # trigrama -> termos do vocabulário
+        self._doc_count = 0
+        self._total_length = 0
+        self._version = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self.refreshes = 0
+        self.segments_rebuilt = 0
+        self.queries = 0
+        self.total_ms = 0.0
+
+    def _add_segment(self, establishment_id, segment):
+        self._segments[establishment_id] = segment
+        for term, postings in segment.postings.items():
+            by_establishment = self._postings.get(term)
+            if by_establishment is None:
+                by_establishment = self._postings[term] = {}
+                for gram in trigrams(term):
+                    self._trigrams.setdefault(gram, set()).add(term)
+            by_establishment[establishment_id] = postings
+            self._df[term] += len(postings)
+        self._doc_count += len(segment.lengths)
+        self._total_length += sum(segment.lengths)
+
+    def _remove_segment(self, establishment_id):
+        segment = self._segments.pop(establishment_id)
+        for term, postings in segment.postings.items():
+            by_establishment = self._postings[term]
+            del by_establishment[establishment_id]
+            self._df[term] -= len(postings)
+            if not by_establishment:
+                del self._postings[term]
+                del self._df[term]
+                for gram in trigrams(term):
+                    terms = self._trigrams[gram]
+                    terms.discard(term)
+                    if not terms:
+                        del self._trigrams[gram]
+        self._doc_count -= len(segment.lengths)
+        self._total_length -= sum(segment.lengths)
+
+    def refresh(self, catalog):
+        """
+        Atualiza o índice para o catálogo indicado, se a versão dele mudou.
+
+        Os menus alterados vêm de uma única carga (catalog.menus) e os
+        segmentos são construídos fora do lock das pesquisas; só a troca é
+        feita com o lock. Enquanto outra thread atualiza, as pesquisas usam
+        o índice anterior em vez de esperar (exceto na primeira vez).
+        """
+        if catalog.version is not None and catalog.version == self._version:
+            return
+        if not self._refresh_lock.acquire(blocking=self._version is None):
+            return
+        try:
+            if catalog.version is not None and catalog.version == self._version:
+                return
+            # Só esta thread altera os segmentos, então podem ser lidos sem o lock
+            seen = set()
+            changed = {}
+            for category in catalog.categories:
+                for establishment in catalog.establishments(category):
+                    establishment_id = establishment['id']
+                    seen.add(establishment_id)
+                    signature = menu_signature(establishment)
+                    segment = self._segments.get(establishment_id)
+                    if segment is None or segment.signature != signature:
+                        changed[establishment_id] = signature
+            removed = self._segments.keys() - seen
+
+            menus = catalog.menus(list(changed)) if changed else {}
+            segments = {
+                establishment_id: Segment(signature, menus[establishment_id])
+                for establishment_id, signature in changed.items()
+            }
+
+            with self._lock:
+                for establishment_id in removed | (segments.keys() & self._segments.keys()):
+                    self._remove_segment(establishment_id)
+                for establishment_id, segment in segments.items():
+                    self._add_segment(establishment_id, segment)
+                self.segments_rebuilt += len(segments)
+                self._version = catalog.version
+                self.refreshes += 1
+        finally:
+            self._refresh_lock.release()
+
+    def _expand(self, token):
+        """
+        Termos do vocabulário usados para a palavra: ela mesma ou as mais parecidas, com a semelhança
+        """
+        if token in self._postings:
+            return [(token, 1.0)]
+        if len(token) < 3:
+            return []
+        grams = trigrams(token)
+        shared = Counter()
+        for gram in grams:
+            for term in self._trigrams.get(gram, ()):
+                shared[term] += 1
+        candidates = []
+        for term, count in shared.items():
+            similarity = 2 * count / (len(grams) + len(trigrams(term)))
+            if term.startswith(token):
+                # Palavra incompleta ('marg' -> 'margherita')
+                similarity = max(similarity, 0.8)
+            if similarity >= MIN_SIMILARITY:
+                candidates.append((term, similarity))
+        return heapq.nlargest(MAX_EXPANSIONS, candidates, key=lambda candidate: candidate[1])
+
+    def search(self, catalog, query, limit=5, establishment_id=None):
+        """
+        Itens mais relevantes para a pesquisa, do melhor para o pior.
+        Com establishment_id, pesquisa só no menu desse estabelecimento.
+        """
+        started = time.perf_counter()
+        self.refresh(catalog)
+        tokens = list(dict.fromkeys(token for token in search_tokens(query) if token not in STOP_WORDS))
+
+        with self._lock:
+            scores = Counter()
+            matched = Counter()       # (estabelecimento, posição) -> palavras encontradas
+            name_matched = Counter()  # ... e encontradas no nome do item
+            if tokens and self._doc_count:
+                average_length = self._total_length / self._doc_count
+                for token in tokens:
+                    # Cada palavra conta uma vez por item, pela melhor das suas alternativas
+                    best = {}
+                    for term, similarity in self._expand(token):
+                        df = self._df[term]
+                        idf = math.log(1 + (self._doc_count - df + 0.5) / (df + 0.5))
+                        by_establishment = self._postings[term]
+                        if establishment_id is not None:
+                            postings = by_establishment.get(establishment_id)
+                            by_establishment = {establishment_id: postings} if postings else {}
+                        for est_id, postings in by_establishment.items():
+                            lengths = self._segments[est_id].lengths
+                            for position, frequency in postings:
+                                norm = self.k1 * (1 - self.b + self.b * lengths[position] / average_length)
+                                score = similarity * idf * frequency * (self.k1 + 1) / (frequency + norm)
+                                key = (est_id, position)
+                                if score > best.get(key, (0.0, None))[0]:
+                                    best[key] = (score, term)
+                    for key, (score, term) in best.items():
+                        scores[key] += score
+                        matched[key] += 1
+                        if term in self._segments[key[0]].name_terms[key[1]]:
+                            name_matched[key] += 1
+
+            hits = []
+            top = scores.most_common(limit)
+            if top:
+                threshold = top[0][1] * MIN_RELATIVE_SCORE
+                hits = [
+                    SearchHit(
+                        est_id, self._segments[est_id].item_ids[position], round(score, 4),
+                        matched[(est_id, position)] / len(tokens), name_matched[(est_id, position)] / len(tokens)
+                    )
+                    for (est_id, position), score in top
+                    if score >= threshold
+                ]
+            self.queries += 1
+            self.total_ms += (time.perf_counter() - started) * 1000
+        return hits
+
+    def stats(self):
+        with self._lock:
+            return {
+                'establishments': len(self._segments),
+                'items': self._doc_count,
+                'terms': len(self._postings),
+                'refreshes': self.refreshes,
+                'segments_rebuilt': self.segments_rebuilt,
+                'queries': self.queries,
+                'avg_ms': round(self.total_ms / self.queries, 3) if self.queries else 0.0
+            }
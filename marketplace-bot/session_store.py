@@ -0,0 +1,264 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Chave da sessão com a versão lida do armazenamento (só no SQLite)
+VERSION_KEY = '_version'
+
+
+class SessionConflict(Exception):
+    """
+    A sessão foi gravada por outro worker depois de ser lida
+    """
+
+
+def encode_session_value(value):
+    """
+    Hook do json.dumps para objetos da sessão que sabem gravar-se de forma compacta
+    """
+    to_compact = getattr(value, 'to_compact', None)
+    if to_compact is None:
+        raise TypeError(f"{type(value).__name__} não é serializável na sessão")
+    return to_compact()
+
+
+class SessionStore:
+    """
+    Interface comum para os armazenamentos de sessões de conversa.
+
+    As sessões são dicionários simples (serializáveis em JSON) indexados
+    pelo número de telefone do usuário. Valores com to_compact() (como a
+    sacola) são gravados na sua forma compacta.
+    """
+
+    def __init__(self, ttl_seconds):
+        self.ttl_seconds = ttl_seconds
+
+    def get(self, phone_number):
+        """
+        Retorna a sessão do usuário ou None se não existir / tiver expirado
+        """
+        raise NotImplementedError
+
+    def save(self, phone_number, session):
+        """
+        Grava a sessão do usuário e renova o seu prazo de expiração.
+        Levanta SessionConflict se outro processo gravou a sessão depois
+        do get (o chamador lê de novo e volta a aplicar a mensagem).
+        """
+        raise NotImplementedError
+
+    def delete(self, phone_number):
+        """
+        Remove a sessão do usuário
+        """
+        raise NotImplementedError
+
+    def purge_expired(self):
+        """
+        Remove todas as sessões expiradas e retorna quantas foram removidas
+        """
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+
+class MemorySessionStore(SessionStore):
+    """
+    Armazenamento em memória com despejo LRU e expiração por inatividade.
+
+    Só serve para um único processo: cada worker do gunicorn teria a sua
+    própria cópia das sessões.
+    """
+
+    def __init__(self, ttl_seconds, max_sessions=10000, purge_interval=300):
+        super().__init__(ttl_seconds)
+        self.max_sessions = max_sessions
+        self.purge_interval = purge_interval
+        self._sessions = OrderedDict()  # telefone -> (expira_em, sessão)
+        self._lock = threading.Lock()
+        self._last_purge = time.monotonic()
+
+    def get(self, phone_number):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._sessions.get(phone_number)
+            if entry is None:
+                return None
+            expires_at, session = entry
+            if expires_at <= now:
+                del self._sessions[phone_number]
+                return None
+            self._sessions.move_to_end(phone_number)
+            return session
+
+    def save(self, phone_number, session):
+        now = time.monotonic()
+        with self._lock:
+            self._sessions[phone_number] = (now + self.ttl_seconds, session)
+            self._sessions.move_to_end(phone_number)
+            # Despeja as sessões menos usadas recentemente quando passa do limite
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+        # Limpeza periódica dos carrinhos abandonados
+        if now - self._last_purge >= self.purge_interval:
+            self._last_purge = now
+            self.purge_expired()
+
+    def delete(self, phone_number):
+        with self._lock:
+            self._sessions.pop(phone_number, None)
+
+    def purge_expired(self):
+        now = time.monotonic()
+        removed = 0
+        with self._lock:
+            # A ordem é de uso e não de expiração, então percorremos tudo
+            for phone_number in [p for p, (exp, _) in self._sessions.items() if exp <= now]:
+                del self._sessions[phone_number]
+                removed += 1
+        return removed
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Armazenamento partilhado em SQLite (modo WAL), para que vários workers
+    do gunicorn na mesma máquina vejam as mesmas conversas.
+
+    O ShardedExecutor só serializa as mensagens dentro de um processo, então
+    cada linha tem uma versão: get a guarda em session[VERSION_KEY] e save
+    só grava se ela não mudou (compare-and-swap), senão levanta
+    SessionConflict em vez de perder a alteração do outro worker.
+    """
+
+    def __init__(self, path, ttl_seconds, purge_interval=300):
+        super().__init__(ttl_seconds)
+        self.path = path
+        self.purge_interval = purge_interval
+        self._local = threading.local()
+        self._last_purge = 0.0
+
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS chat_sessions ("
+            " phone_number TEXT PRIMARY KEY,"
+            " data TEXT NOT NULL,"
+            " expires_at REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS ix_chat_sessions_expires_at ON chat_sessions (expires_at)"
+        )
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(chat_sessions)")}
+        if 'version' not in columns:
+            conn.execute("ALTER TABLE chat_sessions ADD COLUMN version TEXT")
+        conn.commit()
+
+    def _connection(self):
+        # sqlite3 não permite partilhar conexões entre threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, phone_number):
+        row = self._connection().execute(
+            "SELECT data, version FROM chat_sessions WHERE phone_number = ? AND expires_at > ?",
+            (phone_number, time.time())
+        ).fetchone()
+        if row is None:
+            return None
+        session = json.loads(row[0])
+        session[VERSION_KEY] = row[1]
+        return session
+
+    def save(self, phone_number, session):
+        now = time.time()
+        conn = self._connection()
+        read = VERSION_KEY in session
+        expected = session.pop(VERSION_KEY, None)
+        version = uuid.uuid4().hex
+        try:
+            data = json.dumps(session, ensure_ascii=False, separators=(',', ':'), default=encode_session_value)
+            if read:
+                cursor = conn.execute(
+                    "UPDATE chat_sessions SET data = ?, expires_at = ?, version = ?"
+                    " WHERE phone_number = ? AND version IS ?",
+                    (data, now + self.ttl_seconds, version, phone_number, expected)
+                )
+            else:
+                # Sessão nova: só substitui uma linha que já tenha expirado
+                cursor = conn.execute(
+                    "INSERT INTO chat_sessions (phone_number, data, expires_at, version) VALUES (?, ?, ?, ?)"
+                    " ON CONFLICT (phone_number) DO UPDATE SET"
+                    " data = excluded.data, expires_at = excluded.expires_at, version = excluded.version"
+                    " WHERE chat_sessions.expires_at <= ?",
+                    (phone_number, data, now + self.ttl_seconds, version, now)
+                )
+            conn.commit()
+        except BaseException:
+            if read:
+                session[VERSION_KEY] = expected
+            raise
+        if cursor.rowcount == 0:
+            if read:
+                session[VERSION_KEY] = expected
+            raise SessionConflict(phone_number)
+        session[VERSION_KEY] = version
+
+        # Limpeza periódica, feita pelo próprio worker que grava
+        if now - self._last_purge >= self.purge_interval:
+            self._last_purge = now
+            self.purge_expired()
+
+    def delete(self, phone_number):
+        conn = self._connection()
+        conn.execute("DELETE FROM chat_sessions WHERE phone_number = ?", (phone_number,))
+        conn.commit()
+
+    def purge_expired(self):
+        conn = self._connection()
+        cursor = conn.execute("DELETE FROM chat_sessions WHERE expires_at <= ?", (time.time(),))
+        conn.commit()
+        if cursor.rowcount:
+            logger.info(f"{cursor.rowcount} sessões expiradas removidas")
+        return cursor.rowcount
+
+    def __len__(self):
+        row = self._connection().execute(
+            "SELECT COUNT(*) FROM chat_sessions WHERE expires_at > ?", (time.time(),)
+        ).fetchone()
+        return row[0]
+
+
+def create_session_store():
+    """
+    Cria o armazenamento de sessões configurado pelas variáveis de ambiente
+    """
+    backend = os.environ.get('SESSION_STORE', 'memory')
+    ttl_seconds = int(os.environ.get('SESSION_TTL_SECONDS', 6 * 60 * 60))
+
+    if backend == 'sqlite':
+        path = os.environ.get('SESSION_DB_PATH', 'chat_sessions.db')
+        return SQLiteSessionStore(path, ttl_seconds)
+
+    if backend != 'memory':
+        logger.warning(f"Backend de sessões desconhecido '{backend}', usando memória")
+
+    max_sessions = int(os.environ.get('SESSION_MAX_ENTRIES', 10000))
+    return MemorySessionStore(ttl_seconds, max_sessions=max_sessions)
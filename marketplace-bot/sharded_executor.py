@@ -0,0 +1,148 @@
+import logging
+import queue
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+
+class ShardQueueFull(Exception):
+    """
+    A fila do shard está cheia (backpressure): a tarefa foi rejeitada
+    """
+
+
+class Shard:
+    """
+    Uma thread com fila limitada; executa as suas tarefas estritamente em ordem
+    """
+
+    def __init__(self, index, max_queue):
+        self.index = index
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.total_run = 0.0
+        self.thread = None
+
+    def stats(self):
+        return {
+            'shard': self.index,
+            'depth': self.queue.qsize(),
+            'max_depth': self.max_depth,
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'avg_wait_ms': round(self.total_wait * 1000 / self.completed, 3) if self.completed else 0.0,
+            'avg_run_ms': round(self.total_run * 1000 / self.completed, 3) if self.completed else 0.0
+        }
+
+
+class ShardedExecutor:
+    """
+    Executor que distribui as tarefas por N shards segundo uma chave.
+
+    Todas as tarefas com a mesma chave (o telefone do usuário) caem no mesmo
+    shard e são executadas uma de cada vez, pela ordem de submissão; chaves
+    diferentes correm em paralelo nos outros shards.
+    """
+
+    def __init__(self, shards=8, max_queue=100, submit_timeout=0.5):
+        self.submit_timeout = submit_timeout
+        self._shards = [Shard(i, max_queue) for i in range(shards)]
+        self._lock = threading.Lock()
+        self._started = False
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            for shard in self._shards:
+                shard.thread = threading.Thread(
+                    target=self._run, args=(shard,), name=f"shard-{shard.index}", daemon=True
+                )
+                shard.thread.start()
+            self._started = True
+
+    def shard_for(self, key):
+        # crc32 é estável entre processos, ao contrário de hash()
+        return self._shards[zlib.crc32(key.encode('utf-8')) % len(self._shards)]
+
+    def submit(self, key, fn, *args, **kwargs):
+        """
+        Agenda fn(*args, **kwargs) no shard da chave e retorna um Future.
+
+        Levanta ShardQueueFull se a fila do shard continuar cheia depois de
+        submit_timeout segundos.
+        """
+        # Inicia as threads no primeiro uso (e não no import, por causa do fork do gunicorn)
+        if not self._started:
+            self.start()
+
+        shard = self.shard_for(key)
+        future = Future()
+        # Conta antes de enfileirar para que pending() nunca fique negativo
+        with shard.lock:
+            shard.submitted += 1
+        try:
+            shard.queue.put((future, fn, args, kwargs, time.perf_counter()), timeout=self.submit_timeout)
+        except queue.Full:
+            with shard.lock:
+                shard.submitted -= 1
+                shard.rejected += 1
+            logger.warning(f"Fila do shard {shard.index} cheia; tarefa rejeitada")
+            raise ShardQueueFull(f"shard {shard.index}")
+
+        with shard.lock:
+            shard.max_depth = max(shard.max_depth, shard.queue.qsize())
+        return future
+
+    def pending(self):
+        """
+        Número de tarefas ainda não concluídas em todos os shards
+        """
+        return sum(shard.submitted - shard.completed - shard.failed for shard in self._shards)
+
+    def stats(self):
+        return [shard.stats() for shard in self._shards]
+
+    def shutdown(self, timeout=None):
+        if not self._started:
+            return
+        for shard in self._shards:
+            shard.queue.put(None)
+        for shard in self._shards:
+            shard.thread.join(timeout)
+        self._started = False
+
+    def _run(self, shard):
+        while True:
+            task = shard.queue.get()
+            if task is None:
+                return
+
+            future, fn, args, kwargs, enqueued_at = task
+            if not future.set_running_or_notify_cancel():
+                shard.completed += 1
+                continue
+
+            started_at = time.perf_counter()
+            shard.total_wait += started_at - enqueued_at
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                shard.failed += 1
+                future.set_exception(e)
+            else:
+                shard.completed += 1
+                future.set_result(result)
+            finally:
+                shard.total_run += time.perf_counter() - started_at
@@ -0,0 +1,198 @@
+import logging
+from datetime import date, datetime
+
+from sqlalchemy import event, func, inspect, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import db, DailyEstablishmentStats, Establishment, Order
+
+logger = logging.getLogger(__name__)
+
+stats_table = DailyEstablishmentStats.__table__
+
+COUNTER_COLUMNS = (
+    'order_count', 'revenue', 'cancelled_count', 'cancelled_revenue', 'delivery_count', 'pickup_count'
+)
+
+
+def order_deltas(order_status, total_amount, delivery_type, sign=1):
+    """
+    Contribuição de um pedido para a linha diária do seu estabelecimento
+    """
+    cancelled = order_status == 'cancelled'
+    return {
+        'order_count': sign,
+        'revenue': sign * (total_amount or 0.0),
+        'cancelled_count': sign if cancelled else 0,
+        'cancelled_revenue': sign * (total_amount or 0.0) if cancelled else 0.0,
+        'delivery_count': sign if delivery_type == 'delivery' else 0,
+        'pickup_count': sign if delivery_type == 'pickup' else 0
+    }
+
+
+def apply_deltas(connection, establishment_id, day, deltas):
+    """
+    Soma os deltas à linha (estabelecimento, dia), criando-a se não existir
+    """
+    deltas = {column: value for column, value in deltas.items() if value}
+    if not deltas:
+        return
+
+    now = datetime.utcnow()
+    dialect = connection.dialect.name
+
+    if dialect in ('postgresql', 'sqlite'):
+        # Upsert atômico, seguro com vários workers a gravar o mesmo dia
+        insert = (postgresql if dialect == 'postgresql' else sqlite).insert(stats_table)
+        category_id = select(Establishment.category_id).where(
+            Establishment.id == establishment_id
+        ).scalar_subquery()
+        statement = insert.values(
+            establishment_id=establishment_id,
+            category_id=category_id,
+            day=day,
+            updated_at=now,
+            **{column: deltas.get(column, 0) for column in COUNTER_COLUMNS}
+        ).on_conflict_do_update(
+            index_elements=['establishment_id', 'day'],
+            set_=dict(
+                updated_at=now,
+                **{column: stats_table.c[column] + value for column, value in deltas.items()}
+            )
+        )
+        connection.execute(statement)
+        return
+
+    # Outros bancos: atualiza e, se a linha ainda não existir, insere
+    result = connection.execute(
+        update(stats_table).where(
+            stats_table.c.establishment_id == establishment_id,
+            stats_table.c.day == day
+        ).values(
+            updated_at=now,
+            **{column: stats_table.c[column] + value for column, value in deltas.items()}
+        )
+    )
+    if result.rowcount == 0:
+        category_id = connection.execute(
+            select(Establishment.category_id).where(Establishment.id == establishment_id)
+        ).scalar()
+        connection.execute(stats_table.insert().values(
+            establishment_id=establishment_id,
+            category_id=category_id,
+            day=day,
+            updated_at=now,
+            **{column: deltas.get(column, 0) for column in COUNTER_COLUMNS}
+        ))
+
+
+def previous_value(state, attribute):
+    """
+    Valor do atributo antes da alteração que está a ser gravada.
+
+    O atributo precisa de active_history (ver Order e Review em models.py):
+    sem ela, um objeto expirado pelo commit não guarda o valor substituído
+    e o histórico só tem o novo.
+    """
+    history = state.attrs[attribute].history
+    if history.deleted:
+        return history.deleted[0]
+    return state.attrs[attribute].value
+
+
+@event.listens_for(Order, 'after_insert')
+def rollup_order_created(mapper, connection, order):
+    created_at = order.created_at or datetime.utcnow()
+    apply_deltas(
+        connection,
+        order.establishment_id,
+        created_at.date(),
+        order_deltas(order.order_status, order.total_amount, order.delivery_type)
+    )
+
+
+@event.listens_for(Order, 'after_update')
+def rollup_order_updated(mapper, connection, order):
+    state = inspect(order)
+    tracked = ('order_status', 'total_amount', 'delivery_type', 'establishment_id', 'created_at')
+    if not any(state.attrs[attribute].history.has_changes() for attribute in tracked):
+        return
+
+    # Retira a contribuição antiga e soma a nova (cobre mudança de status, valor ou dia)
+    old_created_at = previous_value(state, 'created_at') or order.created_at
+    apply_deltas(
+        connection,
+        previous_value(state, 'establishment_id'),
+        old_created_at.date(),
+        order_deltas(
+            previous_value(state, 'order_status'),
+            previous_value(state, 'total_amount'),
+            previous_value(state, 'delivery_type'),
+            sign=-1
+        )
+    )
+    rollup_order_created(mapper, connection, order)
+
+
+@event.listens_for(Order, 'after_delete')
+def rollup_order_deleted(mapper, connection, order):
+    apply_deltas(
+        connection,
+        order.establishment_id,
+        order.created_at.date(),
+        order_deltas(order.order_status, order.total_amount, order.delivery_type, sign=-1)
+    )
+
+
+def rebuild_daily_stats(start_day=None):
+    """
+    Recalcula o resumo diário a partir da tabela de pedidos (desde start_day, ou tudo)
+    """
+    day_column = func.date(Order.created_at)
+    cancelled = Order.order_status == 'cancelled'
+
+    query = db.session.query(
+        Order.establishment_id,
+        Establishment.category_id,
+        day_column,
+        func.count(Order.id),
+        func.coalesce(func.sum(Order.total_amount), 0.0),
+        func.sum(db.case((cancelled, 1), else_=0)),
+        func.coalesce(func.sum(db.case((cancelled, Order.total_amount), else_=0.0)), 0.0),
+        func.sum(db.case((Order.delivery_type == 'delivery', 1), else_=0)),
+        func.sum(db.case((Order.delivery_type == 'pickup', 1), else_=0))
+    ).join(
+        Establishment, Order.establishment_id == Establishment.id
+    ).group_by(
+        Order.establishment_id, Establishment.category_id, day_column
+    )
+
+    delete = stats_table.delete()
+    if start_day is not None:
+        query = query.filter(Order.created_at >= datetime.combine(start_day, datetime.min.time()))
+        delete = delete.where(stats_table.c.day >= start_day)
+
+    rows = []
+    now = datetime.utcnow()
+    for establishment_id, category_id, day, count, revenue, cancelled_count, cancelled_revenue, \
+            delivery_count, pickup_count in query:
+        rows.append({
+            'establishment_id': establishment_id,
+            'category_id': category_id,
+            # No SQLite, date() retorna texto
+            'day': date.fromisoformat(day) if isinstance(day, str) else day,
+            'order_count': count,
+            'revenue': revenue,
+            'cancelled_count': cancelled_count,
+            'cancelled_revenue': cancelled_revenue,
+            'delivery_count': delivery_count,
+            'pickup_count': pickup_count,
+            'updated_at': now
+        })
+
+    db.session.execute(delete)
+    if rows:
+        db.session.execute(stats_table.insert(), rows)
+    db.session.commit()
+    logger.info(f"Resumo diário reconstruído: {len(rows)} linhas")
+    return len(rows)
@@ -0,0 +1,94 @@
+import os
+import sys
+
+import pytest
+from flask import Flask
+
+# Os módulos do bot ficam na pasta acima e são importados pelo nome
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BOT_DIR)
+
+# Twilio e Dialogflow locais (fakes.py), catálogo JSON do repositório e todos os estabelecimentos abertos
+os.environ.setdefault('TWILIO_CLIENT', 'fake')
+os.environ.setdefault('DIALOGFLOW_CLIENT', 'fake')
+os.environ.setdefault('CATALOG_PATH', os.path.join(BOT_DIR, 'dados_estabelecimentos.json'))
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+os.environ.setdefault('HIDE_CLOSED_ESTABLISHMENTS', '0')
+
+from models import db  # noqa: E402
+
+
+@pytest.fixture
+def db_app(tmp_path):
+    """
+    Aplicação Flask com uma base de dados SQLite vazia, criada pelos modelos
+    """
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{tmp_path / 'test.db'}"
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.engine.dispose()
+
+
+@pytest.fixture
+def establishment(db_app):
+    """
+    Um lojista com um estabelecimento, na base de dados do db_app
+    """
+    from models import Category, Establishment, User
+
+    owner = User(name='Lojista', email='lojista@example.com', password_hash='!')
+    category = Category(name='Restaurantes')
+    establishment = Establishment(owner=owner, category=category, name='Tasca do Zé')
+    db.session.add(establishment)
+    db.session.commit()
+    return establishment
+
+
+@pytest.fixture
+def rendered(monkeypatch):
+    """
+    Os templates do painel não fazem parte deste repositório: regista o
+    template e o contexto de cada render_template em vez de o renderizar
+    """
+    import dashboard_routes
+
+    calls = []
+
+    def render_template(template, **context):
+        calls.append((template, context))
+        return template
+
+    monkeypatch.setattr(dashboard_routes, 'render_template', render_template)
+    return calls
+
+
+@pytest.fixture
+def dashboard_client(db_app, establishment, rendered):
+    """
+    Cliente do painel com a sessão do lojista do fixture establishment já iniciada
+    """
+    from flask_login import LoginManager, UserMixin
+
+    import dashboard_routes
+    import entitlements
+
+    class Merchant(UserMixin):
+        def __init__(self, user_id):
+            self.id = user_id
+
+    db_app.config.update(SECRET_KEY='test', TESTING=True)
+    login_manager = LoginManager(db_app)
+    login_manager.user_loader(lambda user_id: Merchant(int(user_id)))
+    db_app.register_blueprint(dashboard_routes.dashboard, url_prefix='/dashboard')
+    # O cache dos direitos é global ao processo e os ids repetem-se entre testes
+    entitlements._cache.clear()
+
+    client = db_app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(establishment.owner_id)
+    return client
@@ -0,0 +1,69 @@
+from cart import Cart
+
+
+def test_add_keeps_subtotals():
+    cart = Cart()
+    cart.add(1, '1:1', 250.0, 2)
+    cart.add(2, '2:1', 100.0, 1)
+    cart.add(1, '1:2', 50.0, 3)
+
+    assert cart.subtotal == 750.0
+    assert cart.establishment_subtotals == {1: 650.0, 2: 100.0}
+    assert len(cart) == 3
+
+
+def test_add_existing_item_sums_quantity():
+    cart = Cart()
+    cart.add(1, '1:1', 250.0, 1)
+    line = cart.add(1, '1:1', 250.0, 2)
+
+    assert len(cart) == 1
+    assert line.quantity == 3
+    assert line.subtotal == cart.subtotal == 750.0
+
+
+def test_add_existing_item_keeps_line_price():
+    cart = Cart()
+    cart.add(1, '1:1', 250.0, 1)
+    # O catálogo mudou o preço entre as duas mensagens
+    line = cart.add(1, '1:1', 300.0, 2)
+
+    assert line.unit_price == 250.0
+    assert cart.subtotal == sum(line.subtotal for line in cart) == 750.0
+    assert cart.establishment_subtotals[1] == 750.0
+
+
+def test_add_discards_priced_of_the_establishment():
+    cart = Cart()
+    cart.add(1, '1:1', 250.0, 1)
+    cart.add(2, '2:1', 100.0, 1)
+    cart.priced = {1: (1, 'preço 1'), 2: (1, 'preço 2')}
+
+    cart.add(1, '1:1', 250.0, 1)
+
+    assert cart.priced == {2: (1, 'preço 2')}
+
+
+def test_clear():
+    cart = Cart()
+    cart.add(1, '1:1', 250.0, 1)
+    cart.priced[1] = (1, 'preço')
+    cart.clear()
+
+    assert not cart
+    assert cart.subtotal == 0
+    assert cart.establishment_subtotals == {}
+    assert cart.priced == {}
+
+
+def test_compact_round_trip():
+    cart = Cart()
+    cart.add(1, '1:1', 250.0, 2)
+    cart.add(2, 17, 99.5, 1)
+
+    restored = Cart.from_compact(cart.to_compact())
+
+    assert restored.to_compact() == [[1, '1:1', 250.0, 2], [2, 17, 99.5, 1]]
+    assert restored.subtotal == cart.subtotal
+    assert restored.establishment_subtotals == cart.establishment_subtotals
+    assert not Cart.from_compact(None)
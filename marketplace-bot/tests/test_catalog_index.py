@@ -0,0 +1,92 @@
+from catalog_index import CatalogIndex, MenuIndex, parse_position, stem, tokenize
+
+DATA = {
+    'pizzarias': [
+        {'id': 1, 'nome': 'Pizza Boa', 'horario_funcionamento': '18:00 - 23:00', 'menu': [
+            {'nome': 'Margherita', 'preco': 250.0},
+            {'nome': 'Quatro Queijos', 'preco': 300.0},
+            {'nome': 'Queijo', 'preco': 200.0}
+        ]},
+        {'id': 2, 'nome': 'Forno a Lenha', 'horario_funcionamento': 'texto livre', 'menu': []}
+    ],
+    'lojas de roupa': [
+        {'id': 3, 'nome': 'Moda Maputo', 'produtos': [{'id': 30, 'nome': 'Camisa', 'preco': 500.0}]}
+    ]
+}
+
+
+def test_tokenize_and_stem():
+    assert stem('pizzarias') == 'pizzaria'
+    assert stem('gas') == 'gas'
+    assert tokenize('Quero 2 Pizzas, por favor!') == ['quero', '2', 'pizza', 'por', 'favor']
+
+
+def test_parse_position():
+    assert parse_position(' 2 ', 3) == 2
+    assert parse_position('0', 3) is None
+    assert parse_position('4', 3) is None
+    assert parse_position('dois', 3) is None
+
+
+def test_menu_resolve_by_name_and_number():
+    menu = MenuIndex(DATA['pizzarias'][0])
+
+    assert menu.resolve('quero a quatro queijos') == '1:2'
+    assert menu.resolve('margherita por favor') == '1:1'
+    assert menu.resolve('3') == '1:3'
+    assert menu.resolve('9') is None
+    assert menu.resolve('calzone') is None
+    assert menu.item('1:2')['preco'] == 300.0
+
+
+def test_menu_uses_item_ids_and_products():
+    menu = MenuIndex(DATA['lojas de roupa'][0])
+
+    assert menu.item_ids == [30]
+    assert menu.resolve('camisas') == 30
+
+
+def test_resolve_category():
+    catalog = CatalogIndex(DATA)
+
+    assert catalog.resolve_category('quero uma pizzaria') == 'pizzarias'
+    assert catalog.resolve_category('lojas de roupa') == 'lojas de roupa'
+    assert catalog.resolve_category('2') == 'lojas de roupa'
+    assert catalog.resolve_category('farmácia') is None
+
+
+def test_resolve_establishment():
+    catalog = CatalogIndex(DATA)
+
+    assert catalog.resolve_establishment('pizzarias', 'forno a lenha')['id'] == 2
+    assert catalog.resolve_establishment('pizzarias', '1')['id'] == 1
+    # Lista filtrada: o número refere-se à ordem mostrada
+    assert catalog.resolve_establishment('pizzarias', '1', listed_ids=[2])['id'] == 2
+    assert catalog.resolve_establishment('pizzarias', '2', listed_ids=[2]) is None
+
+
+def test_lookups_and_schedules():
+    catalog = CatalogIndex(DATA, version=7)
+
+    assert catalog.version == 7
+    assert catalog.establishment(3)['nome'] == 'Moda Maputo'
+    assert catalog.category_of(3) == 'lojas de roupa'
+    assert catalog.schedule(1).is_open(19 * 60)
+    assert catalog.schedule(2) is None
+    assert catalog.menu(1).resolve('margherita') == '1:1'
+    assert set(catalog.menus([1, 3])) == {1, 3}
+
+
+def test_menu_loaders():
+    loaded = []
+
+    def menu_loader(establishment_id):
+        loaded.append(establishment_id)
+        return MenuIndex(catalog.establishment(establishment_id))
+
+    catalog = CatalogIndex(DATA, menu_loader=menu_loader)
+    assert catalog.menus([1, 3])[3].item(30)['nome'] == 'Camisa'
+    assert loaded == [1, 3]
+
+    catalog = CatalogIndex(DATA, menu_loader=menu_loader, menus_loader=lambda ids: {'lote': list(ids)})
+    assert catalog.menus([1, 2]) == {'lote': [1, 2]}
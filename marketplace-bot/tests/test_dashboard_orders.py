@@ -0,0 +1,111 @@
+import csv
+import io
+import json
+from datetime import datetime
+
+import pytest
+
+import dashboard_routes
+from models import Order, OrderItem, Product, db
+
+DAY_1 = datetime(2024, 3, 1, 10)
+DAY_2 = datetime(2024, 3, 2, 10)
+DAY_3 = datetime(2024, 3, 3, 10)
+
+
+@pytest.fixture
+def orders(establishment):
+    """
+    Sete pedidos; três deles com o mesmo created_at
+    """
+    product = Product(establishment_id=establishment.id, name='Bitoque', price=300.0)
+    created = [DAY_1, DAY_2, DAY_2, DAY_2, DAY_3, DAY_3.replace(hour=12), DAY_3.replace(hour=14)]
+    orders = []
+    for created_at in created:
+        order = Order(user_id=establishment.owner_id, establishment_id=establishment.id, total_amount=300.0,
+                      order_status='delivered', delivery_type='pickup', created_at=created_at)
+        order.items.append(OrderItem(product=product, quantity=1, price_at_time_of_order=300.0, subtotal=300.0))
+        orders.append(order)
+    db.session.add_all(orders)
+    db.session.commit()
+    return orders
+
+
+def newest_first(orders):
+    return [order.id for order in sorted(orders, key=lambda order: (order.created_at, order.id), reverse=True)]
+
+
+def list_pages(client, rendered, **args):
+    ids, cursor = [], None
+    while True:
+        query = dict(args, cursor=cursor) if cursor else args
+        assert client.get('/dashboard/orders', query_string=query).status_code == 200
+        template, context = rendered[-1]
+        assert template == 'dashboard/orders.html'
+        ids.append([order.id for order in context['orders']])
+        cursor = context['next_cursor']
+        if cursor is None:
+            return ids
+
+
+def test_cursor_round_trip(orders):
+    order = orders[2]
+
+    assert dashboard_routes.decode_cursor(dashboard_routes.encode_cursor(order)) == (order.created_at, order.id)
+    assert dashboard_routes.decode_cursor('inválido') is None
+    assert dashboard_routes.decode_cursor(None) is None
+
+
+def test_pages_cover_every_order_once(dashboard_client, rendered, orders, monkeypatch):
+    monkeypatch.setattr(dashboard_routes, 'ORDERS_PAGE_SIZE', 2)
+
+    pages = list_pages(dashboard_client, rendered)
+
+    assert [len(page) for page in pages] == [2, 2, 2, 1]
+    # Os empates em created_at são desfeitos pelo id, sem repetir nem saltar pedidos
+    assert sum(pages, []) == newest_first(orders)
+
+
+def test_date_filter_is_inclusive(dashboard_client, rendered, orders, monkeypatch):
+    monkeypatch.setattr(dashboard_routes, 'ORDERS_PAGE_SIZE', 2)
+
+    pages = list_pages(dashboard_client, rendered, date_from='2024-03-02', date_to='2024-03-02')
+
+    assert sum(pages, []) == newest_first(orders[1:4])
+
+
+def test_only_own_orders(dashboard_client, rendered, orders):
+    db.session.add(Order(user_id=99, establishment_id=999, total_amount=1.0, created_at=DAY_1))
+    db.session.commit()
+
+    assert sum(list_pages(dashboard_client, rendered), []) == newest_first(orders)
+
+
+def test_export_csv(dashboard_client, orders):
+    response = dashboard_client.get('/dashboard/orders/export', query_string={'date_from': '2024-03-03'})
+
+    assert response.mimetype == 'text/csv'
+    assert 'attachment; filename=pedidos_' in response.headers['Content-Disposition']
+    rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+    assert [int(row['id']) for row in rows] == newest_first(orders[4:])
+    assert rows[0]['establishment'] == 'Tasca do Zé'
+    assert rows[0]['items'] == '1x Bitoque'
+
+
+def test_export_ndjson_with_deleted_product(dashboard_client, orders):
+    # O produto foi apagado mas os itens dos pedidos ficaram
+    product = orders[0].items[0].product
+    OrderItem.query.update({'product_id': 12345})
+    db.session.delete(product)
+    db.session.commit()
+
+    response = dashboard_client.get('/dashboard/orders/export', query_string={'format': 'ndjson'})
+
+    assert response.mimetype == 'application/x-ndjson'
+    rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert [row['id'] for row in rows] == newest_first(orders)
+    assert {row['items'] for row in rows} == {'1x '}
+
+
+def test_export_rejects_unknown_format(dashboard_client, orders):
+    assert dashboard_client.get('/dashboard/orders/export', query_string={'format': 'xml'}).status_code == 400
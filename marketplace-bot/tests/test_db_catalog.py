@@ -0,0 +1,119 @@
+import pytest
+from sqlalchemy import event
+
+import db_catalog
+from db_catalog import DatabaseCatalogProvider
+from models import Category, Establishment, Product, db
+
+
+@pytest.fixture
+def provider(db_app, establishment):
+    db.session.add_all([
+        Product(establishment_id=establishment.id, name='Bitoque', price=300.0),
+        Product(establishment_id=establishment.id, name='Prego', price=150.0),
+        Product(establishment_id=establishment.id, name='Francesinha', price=450.0, is_available=False)
+    ])
+    db.session.add(Establishment(owner_id=establishment.owner_id, category_id=establishment.category_id,
+                                 name='Fechada', is_active=False))
+    db.session.commit()
+    # Só recarrega quando um commit avisa (sem revalidação por tempo durante o teste)
+    provider = DatabaseCatalogProvider(db_app, revalidate_interval=3600)
+    yield provider
+    db_catalog._providers.remove(provider)
+
+
+@pytest.fixture
+def queries(db_app):
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', count)
+    yield statements
+    event.remove(db.engine, 'before_cursor_execute', count)
+
+
+def test_snapshot_has_only_active_establishments(provider, establishment):
+    catalog = provider.current().index
+
+    assert catalog.categories == ['restaurantes']
+    assert [record['nome'] for record in catalog.establishments('restaurantes')] == ['Tasca do Zé']
+    assert catalog.resolve_category('restaurantes') == 'restaurantes'
+
+
+def test_menu_has_only_available_products(provider, establishment):
+    menu = provider.current().index.menu(establishment.id)
+
+    assert [item['nome'] for item in menu.items] == ['Bitoque', 'Prego']
+    assert menu.item(menu.resolve('prego'))['preco'] == 150.0
+
+
+def test_menu_is_cached(provider, establishment, queries):
+    catalog = provider.current().index
+    catalog.menu(establishment.id)
+    queries.clear()
+
+    assert provider.current().index.menu(establishment.id) is catalog.menu(establishment.id)
+    assert queries == []
+
+
+def test_product_change_bumps_menu_version(provider, establishment):
+    catalog = provider.current()
+    menu = catalog.index.menu(establishment.id)
+    version = establishment.menu_version
+
+    db.session.add(Product(establishment_id=establishment.id, name='Caldo Verde', price=120.0))
+    db.session.commit()
+
+    assert establishment.menu_version == version + 1
+    updated = provider.current()
+    assert updated.version != catalog.version
+    assert updated.index.establishment(establishment.id)['menu_version'] == version + 1
+    assert updated.index.menu(establishment.id) is not menu
+    assert [item['nome'] for item in updated.index.menu(establishment.id).items] == ['Bitoque', 'Prego', 'Caldo Verde']
+
+
+def test_unavailable_product_leaves_menu(provider, establishment):
+    provider.current().index.menu(establishment.id)
+
+    Product.query.filter_by(name='Prego').one().is_available = False
+    db.session.commit()
+
+    assert [item['nome'] for item in provider.current().index.menu(establishment.id).items] == ['Bitoque']
+
+
+def test_deactivated_establishment_leaves_catalog(provider, establishment):
+    version = provider.current().version
+    other = Establishment(owner_id=establishment.owner_id, category=Category(name='Bares'), name='Bar')
+    db.session.add(other)
+    db.session.commit()
+    provider.invalidate([])
+    assert provider.current().index.categories == ['restaurantes', 'bares']
+
+    other.is_active = False
+    db.session.commit()
+    provider.invalidate([])
+
+    assert provider.current().index.categories == ['restaurantes']
+    assert provider.current().version == version
+
+
+def test_menus_loads_missing_menus_in_one_query(provider, establishment, queries, monkeypatch):
+    monkeypatch.setattr(db_catalog, 'MENUS_BATCH_SIZE', 2)
+    others = [Establishment(owner_id=establishment.owner_id, category_id=establishment.category_id, name=f"Loja {i}")
+              for i in range(3)]
+    db.session.add_all(others)
+    db.session.commit()
+    other_ids = [other.id for other in others]
+    catalog = provider.current().index
+    cached = catalog.menu(establishment.id)
+    queries.clear()
+
+    menus = catalog.menus([establishment.id] + other_ids)
+
+    # Três menus em falta, em lotes de dois
+    assert len(queries) == 2
+    assert menus[establishment.id] is cached
+    assert all(menus[other_id].items == [] for other_id in other_ids)
+    assert catalog.menu(other_ids[0]) is menus[other_ids[0]]
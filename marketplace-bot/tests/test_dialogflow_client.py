@@ -0,0 +1,48 @@
+from dialogflow_client import CircuitBreaker, DialogflowGateway, KeywordIntentClassifier
+from fakes import FakeDialogflow
+from keyword_matcher import KeywordMatcher
+
+FALLBACK = KeywordIntentClassifier(KeywordMatcher({'greeting': ['oi'], 'positive': ['sim']}))
+
+
+def gateway(dialogflow, **kwargs):
+    return DialogflowGateway('projeto', 'pt-BR', dialogflow, FALLBACK, **kwargs)
+
+
+def test_detect_uses_dialogflow_and_caches_normalized_text():
+    dialogflow = FakeDialogflow({'quero pizza': 'order_food'})
+    intents = gateway(dialogflow)
+
+    assert intents.detect('s1', 'Quero pizza') == ('order_food', 1.0, '', 'dialogflow')
+    assert intents.detect('s2', '  quero   PIZZA ').intent == 'order_food'
+    assert dialogflow.calls == 1
+    assert dialogflow.clients_created == 1
+
+
+def test_timeout_answers_with_local_classifier():
+    intents = gateway(FakeDialogflow({'oi': 'welcome'}, latency=0.5), timeout=0.05)
+
+    result = intents.detect('s1', 'oi')
+
+    assert (result.intent, result.source) == ('greeting', 'fallback')
+
+
+def test_breaker_opens_after_failures():
+    dialogflow = FakeDialogflow(fail=True)
+    intents = gateway(dialogflow, breaker=CircuitBreaker(failure_threshold=2, reset_timeout=60))
+
+    for text in ['sim', '3', 'nada']:
+        intents.detect('s1', text)
+
+    assert dialogflow.calls == 2
+    assert intents.breaker.state == 'open'
+    assert intents.detect('s1', '3').intent == 'select_option'
+    assert intents.detect('s1', 'nada').intent == 'unknown'
+    # As respostas locais não ficam no cache
+    assert intents.cache.hits == 0
+
+
+def test_detect_async():
+    intents = gateway(FakeDialogflow({'oi': 'welcome'}))
+
+    assert intents.detect_async('s1', 'oi').result(timeout=5).intent == 'welcome'
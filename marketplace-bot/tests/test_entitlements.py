@@ -0,0 +1,102 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import entitlements
+from models import ChatFlow, Establishment, Payment, PlanType, Subscription, db
+
+
+@pytest.fixture
+def subscription(establishment):
+    subscription = Subscription(user_id=establishment.owner_id, plan_type=PlanType.BASIC, is_trial=False)
+    db.session.add(subscription)
+    db.session.commit()
+    return subscription
+
+
+def test_counts_and_limits(subscription, establishment):
+    db.session.add_all([ChatFlow(establishment_id=establishment.id, name=f"Fluxo {i}", flow_data={})
+                        for i in range(5)])
+    db.session.commit()
+
+    loaded = entitlements.load_entitlements(establishment.owner_id)
+
+    assert loaded.establishment_count == 1
+    assert not loaded.can_create_establishment
+    assert loaded.flow_count(establishment.id) == 5
+    assert not loaded.can_create_flow(establishment.id)
+
+
+def test_no_subscription_allows_nothing(establishment):
+    loaded = entitlements.load_entitlements(establishment.owner_id)
+
+    assert loaded.subscription is None
+    assert not loaded.can_create_establishment
+    assert loaded.trial_status() == {'is_trial': False, 'days_left': 0, 'trial_expired': True}
+
+
+def test_snapshot_has_every_subscription_field(subscription):
+    db.session.add(Payment(subscription_id=subscription.id, amount=500.0))
+    db.session.commit()
+
+    snapshot = entitlements.SubscriptionSnapshot(subscription)
+
+    for column in Subscription.__table__.columns:
+        assert getattr(snapshot, column.key) == getattr(subscription, column.key)
+    assert snapshot.created_at is not None
+    assert [payment.amount for payment in snapshot.payments] == [500.0]
+
+
+def test_trial_days_left(subscription):
+    subscription.is_trial = True
+    subscription.trial_end = datetime.utcnow() + timedelta(days=3, hours=1)
+    db.session.commit()
+
+    loaded = entitlements.load_entitlements(subscription.user_id)
+
+    assert loaded.trial_status() == {'is_trial': True, 'days_left': 3, 'trial_expired': False}
+
+
+def test_establishment_limit_ignores_stale_cache(dashboard_client, subscription, establishment):
+    # O cache deste worker diz que ainda não há estabelecimentos...
+    entitlements._cache[establishment.owner_id] = entitlements.Entitlements(
+        establishment.owner_id, entitlements.SubscriptionSnapshot(subscription), 0, {}
+    )
+
+    # ...mas outro worker já criou o único permitido pelo plano básico
+    response = dashboard_client.post('/dashboard/establishments/new', data={
+        'name': 'Segunda loja', 'category_id': establishment.category_id
+    })
+
+    assert response.status_code == 302
+    assert Establishment.query.filter_by(owner_id=establishment.owner_id).count() == 1
+
+
+def test_flow_limit_ignores_stale_cache(dashboard_client, subscription, establishment):
+    db.session.add_all([ChatFlow(establishment_id=establishment.id, name=f"Fluxo {i}", flow_data={})
+                        for i in range(5)])
+    db.session.commit()
+    entitlements._cache[establishment.owner_id] = entitlements.Entitlements(
+        establishment.owner_id, entitlements.SubscriptionSnapshot(subscription), 1, {}
+    )
+
+    response = dashboard_client.post(f"/dashboard/chatbot-editor/{establishment.id}/flow/new", data={
+        'name': 'Sexto fluxo', 'flow_data': '{}'
+    })
+
+    assert response.status_code == 302
+    assert ChatFlow.query.filter_by(establishment_id=establishment.id).count() == 5
+
+
+def test_create_within_limit(dashboard_client, subscription, establishment):
+    subscription.plan_type = PlanType.MEDIUM
+    db.session.commit()
+
+    response = dashboard_client.post('/dashboard/establishments/new', data={
+        'name': 'Segunda loja', 'category_id': establishment.category_id
+    })
+
+    assert response.status_code == 302
+    assert Establishment.query.filter_by(owner_id=establishment.owner_id).count() == 2
+    # O snapshot guardado no cache já inclui a nova loja
+    assert entitlements.cached_entitlements(establishment.owner_id).establishment_count == 2
@@ -0,0 +1,129 @@
+import json
+
+import pytest
+
+import flow_engine
+from flow_engine import FlowError, FlowRegistry, compile_flow
+from models import ChatFlow, PlanType, Subscription, db
+
+FLOW = {
+    'start': 'boas_vindas',
+    'nodes': {
+        'boas_vindas': {
+            'message': {'pt': 'Olá! Quer ver o menu ou saber o horário?', 'en': 'Hi! Menu or opening hours?'},
+            'transitions': [
+                {'keywords': ['menu', 'Cardápio', '1'], 'next': 'menu'},
+                {'keywords': ['horário', '2'], 'next': 'horario'}
+            ],
+            'default': 'boas_vindas'
+        },
+        'horario': {'message': 'Abrimos das 10h às 22h.', 'transitions': [{'keywords': ['obrigado'], 'next': 'fim'}]},
+        'menu': {'action': 'show_menu'},
+        'fim': {'message': 'Até breve!', 'action': 'end'},
+        'beco': {'message': 'Sem saída', 'transitions': [{'keywords': ['voltar']}]}
+    }
+}
+
+
+def test_compile_graph():
+    flow = compile_flow(1, 'v1', FLOW)
+    start = flow.nodes[flow.start]
+
+    assert start.message('en') == 'Hi! Menu or opening hours?'
+    assert start.message('fr') == start.message('pt')
+    assert flow.nodes['horario'].message('en') == 'Abrimos das 10h às 22h.'
+    assert start.next_node('quero ver o CARDÁPIO') == 'menu'
+    # A palavra-chave que aparece primeiro decide
+    assert start.next_node('2 ou 1?') == 'horario'
+    assert start.next_node('hum') == 'boas_vindas'
+    assert flow.nodes['horario'].next_node('hum') is None
+    assert flow.nodes['menu'].action == 'show_menu'
+
+
+def test_node_without_way_out_ends_flow():
+    flow = compile_flow(1, 'v1', FLOW)
+
+    assert flow.nodes['beco'].action == 'end'
+    assert flow.nodes['fim'].action == 'end'
+    # Tem uma transição com destino: não é final
+    assert flow.nodes['horario'].action is None
+
+
+@pytest.mark.parametrize('flow_data', [
+    None,
+    {'start': 'a'},
+    {'start': 'x', 'nodes': {'a': {}}},
+    {'start': 'a', 'nodes': {'a': {'default': 'b'}}},
+    {'start': 'a', 'nodes': {'a': {'transitions': [{'keywords': ['b'], 'next': 'b'}]}}},
+    {'start': 'a', 'nodes': {'a': {'action': 'dançar'}}},
+    {'start': 'a', 'nodes': {'a': 'texto'}},
+])
+def test_invalid_flows(flow_data):
+    with pytest.raises(FlowError):
+        compile_flow(1, 'v1', flow_data)
+
+
+@pytest.fixture
+def registry(db_app):
+    registry = FlowRegistry(db_app, revalidate_interval=3600)
+    yield registry
+    flow_engine._registries.remove(registry)
+
+
+def add_flow(establishment, flow_data, **fields):
+    flow = ChatFlow(establishment_id=establishment.id, name='Fluxo', flow_data=flow_data, **fields)
+    db.session.add(flow)
+    db.session.commit()
+    return flow
+
+
+def test_registry_compiles_once(registry, establishment):
+    add_flow(establishment, FLOW)
+
+    flow = registry.flow_for(establishment.id)
+
+    assert flow.start == 'boas_vindas'
+    assert registry.flow_for(establishment.id) is flow
+    assert registry.flow_for(999) is None
+
+
+def test_registry_uses_oldest_active_flow(registry, establishment):
+    add_flow(establishment, {'start': 'a', 'nodes': {'a': {'message': 'inativo'}}}, is_active=False)
+    first = add_flow(establishment, FLOW)
+    add_flow(establishment, {'start': 'a', 'nodes': {'a': {'message': 'segundo'}}})
+
+    assert registry.flow_for(establishment.id).flow_id == first.id
+
+
+def test_invalid_flow_falls_back_to_menu(registry, establishment):
+    add_flow(establishment, {'start': 'nenhum', 'nodes': {}})
+
+    assert registry.flow_for(establishment.id) is None
+
+
+@pytest.fixture
+def merchant_client(dashboard_client, establishment):
+    db.session.add(Subscription(user_id=establishment.owner_id, plan_type=PlanType.HIGH))
+    db.session.commit()
+    return dashboard_client
+
+
+def test_dashboard_create_invalidates_registry(merchant_client, registry, establishment):
+    assert registry.flow_for(establishment.id) is None
+
+    merchant_client.post(f"/dashboard/chatbot-editor/{establishment.id}/flow/new",
+                         data={'name': 'Boas-vindas', 'flow_data': json.dumps(FLOW)})
+
+    assert registry.flow_for(establishment.id).start == 'boas_vindas'
+
+
+def test_dashboard_edit_invalidates_registry(merchant_client, registry, establishment):
+    flow = add_flow(establishment, FLOW)
+    assert registry.flow_for(establishment.id).nodes['fim'].message('pt') == 'Até breve!'
+
+    edited = json.loads(json.dumps(FLOW))
+    edited['nodes']['fim']['message'] = 'Volte sempre!'
+    merchant_client.post(f"/dashboard/chatbot-editor/{establishment.id}/flow/{flow.id}",
+                         data={'name': 'Fluxo', 'flow_data': json.dumps(edited)})
+
+    assert registry.flow_for(establishment.id).nodes['fim'].message('pt') == 'Volte sempre!'
@@ -0,0 +1,107 @@
+import random
+
+import pytest
+
+from catalog_index import CatalogIndex
+from geo import GeoIndex, delivery_fee, haversine_km, parse_location
+
+
+def make_catalog(version=1, count=300, seed=7):
+    rng = random.Random(seed)
+    data = {'restaurantes': [], 'farmácias': []}
+    for establishment_id in range(1, count + 1):
+        category = 'restaurantes' if establishment_id % 3 else 'farmácias'
+        establishment = {'id': establishment_id, 'nome': f"Estabelecimento {establishment_id}"}
+        if establishment_id % 10:
+            # À volta de Maputo; um em cada dez fica sem coordenadas
+            establishment['latitude'] = -25.97 + rng.uniform(-0.4, 0.4)
+            establishment['longitude'] = 32.57 + rng.uniform(-0.4, 0.4)
+        data[category].append(establishment)
+    return CatalogIndex(data, version=version)
+
+
+def brute_force(catalog, lat, lon, limit, category=None, max_distance_km=None, predicate=None):
+    found = []
+    for name in [category] if category else catalog.categories:
+        for establishment in catalog.establishments(name):
+            location = parse_location(establishment.get('latitude'), establishment.get('longitude'))
+            if location is None or (predicate is not None and not predicate(establishment)):
+                continue
+            distance = haversine_km(lat, lon, *location)
+            if max_distance_km is None or distance <= max_distance_km:
+                found.append((distance, establishment['id']))
+    return sorted(found)[:limit]
+
+
+def test_haversine():
+    assert haversine_km(-25.97, 32.57, -25.97, 32.57) == 0
+    # Um grau de latitude tem ~111,2 km
+    assert haversine_km(0, 0, 1, 0) == pytest.approx(111.19, abs=0.01)
+    # Maputo - Matola
+    assert haversine_km(-25.9692, 32.5732, -25.9622, 32.4589) == pytest.approx(11.45, abs=0.1)
+
+
+@pytest.mark.parametrize('latitude, longitude, expected', [
+    ('-25.97', '32.57', (-25.97, 32.57)),
+    (None, '32.57', None),
+    ('abc', '32.57', None),
+    ('91', '0', None),
+    ('0', '-181', None),
+])
+def test_parse_location(latitude, longitude, expected):
+    assert parse_location(latitude, longitude) == expected
+
+
+def test_delivery_fee_rounds_up():
+    assert delivery_fee(0, 50, 10) == 50
+    assert delivery_fee(2.01, 50, 10) == 75
+    assert delivery_fee(2.5, 50, 10) == 75
+    assert delivery_fee(3.7, 50, 10, rounding=10) == 90
+
+
+@pytest.mark.parametrize('lat, lon', [(-25.97, 32.57), (-25.6, 32.9), (-27.0, 31.0), (-26.3, 32.2)])
+def test_nearest_matches_brute_force(lat, lon):
+    catalog = make_catalog()
+    index = GeoIndex()
+
+    nearest = index.nearest(catalog, lat, lon, limit=5)
+
+    assert [(distance, establishment['id']) for distance, establishment in nearest] == \
+        brute_force(catalog, lat, lon, 5)
+
+
+def test_nearest_with_category_distance_and_predicate():
+    catalog = make_catalog()
+    index = GeoIndex()
+
+    def even(establishment):
+        return establishment['id'] % 2 == 0
+
+    nearest = index.nearest(catalog, -25.97, 32.57, limit=10, category='farmácias',
+                            max_distance_km=15, predicate=even)
+
+    assert nearest
+    assert [(distance, establishment['id']) for distance, establishment in nearest] == \
+        brute_force(catalog, -25.97, 32.57, 10, 'farmácias', 15, even)
+    assert index.nearest(catalog, -25.97, 32.57, category='bancos') == []
+
+
+def test_grids_rebuilt_only_when_version_changes():
+    index = GeoIndex()
+    index.nearest(make_catalog(version=1), -25.97, 32.57)
+    index.nearest(make_catalog(version=1), -25.97, 32.57)
+    assert index.rebuilds == 1
+
+    index.nearest(make_catalog(version=2), -25.97, 32.57)
+    assert index.rebuilds == 2
+    assert index.stats()['establishments'] == 270
+
+
+def test_distance_to():
+    catalog = make_catalog()
+    index = GeoIndex()
+    establishment = catalog.establishment(1)
+
+    assert index.distance_to(catalog, 1, establishment['latitude'], establishment['longitude']) == 0
+    assert index.distance_to(catalog, 10, -25.97, 32.57) is None
+    assert index.distance_to(catalog, 999, -25.97, 32.57) is None
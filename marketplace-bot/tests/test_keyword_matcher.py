@@ -0,0 +1,39 @@
+from keyword_matcher import KeywordMatcher
+
+TABLES = {
+    'greeting': ['oi', 'olá', 'bom dia'],
+    'quantity': {'um': 1, 'uma': 1, 'dois': 2, 'duas': 2},
+    'positive': ['sim', 'pode ser']
+}
+
+
+def test_only_whole_words():
+    matcher = KeywordMatcher(TABLES)
+
+    assert not matcher.find('alguma coisa').has('quantity')
+    assert not matcher.find('alguma coisa').has('greeting')
+    assert not matcher.find('simples').has('positive')
+    assert matcher.find('oi, tudo bem?').has('greeting')
+
+
+def test_values_and_phrases():
+    matches = KeywordMatcher(TABLES).find('Bom dia! Quero DUAS pizzas, pode ser?')
+
+    assert matches.first('greeting').keyword == 'bom dia'
+    assert matches.value('quantity') == 2
+    assert matches.has('positive')
+    assert matches.value('missing', 'padrão') == 'padrão'
+
+
+def test_first_occurrence_by_position():
+    matches = KeywordMatcher(TABLES).find('dois ou um')
+
+    assert [match.value for match in matches] == [2, 1]
+    assert matches.value('quantity') == 2
+    assert (matches.first('quantity').start, matches.first('quantity').end) == (0, 4)
+
+
+def test_longest_match_first_at_same_position():
+    matches = KeywordMatcher({'a': ['pode'], 'b': ['pode ser']}).find('pode ser')
+
+    assert [match.keyword for match in matches] == ['pode ser', 'pode']
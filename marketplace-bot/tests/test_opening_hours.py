@@ -0,0 +1,102 @@
+from datetime import datetime
+
+import pytest
+
+from catalog_index import CatalogIndex
+from opening_hours import MINUTES_PER_DAY, MINUTES_PER_WEEK, OpenNow, compile_hours, parse_days
+
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:  # Python < 3.9
+    ZoneInfo = None
+
+MON, TUE, WED, THU, FRI, SAT, SUN = range(7)
+
+
+def at(day, hour, minute=0):
+    return day * MINUTES_PER_DAY + hour * 60 + minute
+
+
+def test_parse_days():
+    assert parse_days('sex, sab') == {FRI, SAT}
+    assert parse_days('qui-dom') == {THU, FRI, SAT, SUN}
+    assert parse_days('sab-seg') == {SAT, SUN, MON}
+    assert parse_days('feriados') is None
+
+
+def test_daily_range():
+    schedule = compile_hours('18:00 - 23:00')
+
+    assert schedule.is_open(at(MON, 18))
+    assert schedule.is_open(at(SUN, 22, 59))
+    assert not schedule.is_open(at(MON, 23))
+    assert not schedule.is_open(at(THU, 17, 59))
+
+
+def test_closes_at_midnight():
+    schedule = compile_hours('19:00 - 00:00')
+
+    assert schedule.is_open(at(MON, 23, 59))
+    assert not schedule.is_open(at(TUE, 0))
+
+
+def test_several_periods():
+    schedule = compile_hours('11:00 - 15:00, 18:00 - 22:00')
+
+    assert schedule.is_open(at(THU, 12))
+    assert not schedule.is_open(at(THU, 16))
+    assert schedule.is_open(at(THU, 21))
+
+
+def test_overnight_on_listed_days():
+    schedule = compile_hours('22:00 - 04:00 (Sex, Sáb)')
+
+    assert schedule.is_open(at(FRI, 23))
+    assert schedule.is_open(at(SAT, 3))
+    assert schedule.is_open(at(SUN, 3))  # Sábado à noite
+    assert not schedule.is_open(at(THU, 23))
+    assert not schedule.is_open(at(SUN, 23))
+
+
+def test_sunday_night_wraps_to_monday():
+    schedule = compile_hours('20:00 - 02:00 (Qui-Dom)')
+
+    assert schedule.is_open(at(SUN, 23))
+    assert schedule.is_open(at(MON, 1))
+    assert not schedule.is_open(at(MON, 2))
+    assert not schedule.is_open(at(MON, 21))
+
+
+@pytest.mark.parametrize('text, minute, expected', [
+    ('24h', at(WED, 4), True),
+    ('Aberto 24 horas', MINUTES_PER_WEEK - 1, True),
+    ('Fechado para obras', at(FRI, 12), False),
+])
+def test_always_open_and_closed(text, minute, expected):
+    assert compile_hours(text).is_open(minute) is expected
+
+
+@pytest.mark.parametrize('text', [None, '', 'ligue antes', '25:00 - 26:00'])
+def test_unknown_text_has_no_schedule(text):
+    assert compile_hours(text) is None
+
+
+@pytest.mark.skipif(ZoneInfo is None, reason='zoneinfo indisponível')
+def test_open_now_uses_bot_timezone():
+    catalog = CatalogIndex({'bares': [
+        {'id': 1, 'nome': 'Bar da Noite', 'horario_funcionamento': '22:00 - 04:00 (Sex, Sáb)'},
+        {'id': 2, 'nome': 'Café', 'horario_funcionamento': '08:00 - 18:00'},
+        {'id': 3, 'nome': 'Sem Horário', 'horario_funcionamento': 'consulte'}
+    ]}, version=1)
+    # Sexta-feira, 5 de janeiro de 2024, 23:30 em Maputo (21:30 UTC)
+    now = datetime(2024, 1, 5, 23, 30, tzinfo=ZoneInfo('Africa/Maputo')).timestamp()
+    open_now = OpenNow('Africa/Maputo', clock=lambda: now)
+
+    assert open_now.open_ids(catalog) == {1, 3}
+    assert not open_now.is_open(catalog, 2)
+    # Mesmo minuto e mesma versão do catálogo: o conjunto não é recalculado
+    assert open_now.refreshes == 1
+
+    now += 12 * 3600
+    assert open_now.open_ids(catalog) == {2, 3}
+    assert open_now.refreshes == 2
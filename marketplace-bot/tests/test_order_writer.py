@@ -0,0 +1,80 @@
+import pytest
+
+from cart import Cart
+from models import Order, User, db
+from order_writer import OrderWriter, PendingLine, PendingOrder, customer_phone
+
+
+def pending(phone_number, establishment_id, **fields):
+    values = dict(
+        phone_number=phone_number, establishment_id=establishment_id,
+        lines=[PendingLine(1, 2, 25.0), PendingLine(2, 1, 30.0)],
+        delivery_type='delivery', delivery_address='Rua 1', delivery_time_preference=None,
+        delivery_fee=80, payment_method='mpesa', payment_proof_url=None, total_amount=160.0
+    )
+    values.update(fields)
+    return PendingOrder(**values)
+
+
+@pytest.fixture
+def writer(db_app):
+    writer = OrderWriter(db_app, batch_size=10, flush_interval=0.05)
+    yield writer
+    writer.shutdown(timeout=5)
+
+
+def test_customer_phone():
+    assert customer_phone('whatsapp:+258841234567') == '+258841234567'
+    assert customer_phone('+258841234567') == '+258841234567'
+
+
+def test_batch_insert_creates_customers_once(writer, establishment):
+    db.session.add(User(name='Ana', email='ana@example.com', password_hash='x', phone='+258840000001'))
+    db.session.commit()
+
+    for phone_number in ['whatsapp:+258840000001', 'whatsapp:+258840000002', 'whatsapp:+258840000002']:
+        assert writer.submit(pending(phone_number, establishment.id))
+    writer.shutdown(timeout=5)
+
+    assert writer.stats()['written'] == 3
+    assert writer.stats()['batches'] == 1
+    customers = {user.phone: user for user in User.query.filter(User.phone.isnot(None))}
+    assert set(customers) == {'+258840000001', '+258840000002'}
+    assert customers['+258840000001'].name == 'Ana'
+    assert customers['+258840000002'].email == '258840000002@whatsapp.invalid'
+
+    order = Order.query.filter_by(user_id=customers['+258840000002'].id).first()
+    assert order.delivery_contact_phone == '+258840000002'
+    assert order.order_status == 'pending_payment'
+    assert [(item.product_id, item.quantity, item.subtotal) for item in order.items] == [(1, 2, 50.0), (2, 1, 30.0)]
+
+
+def test_failed_batch_is_written_one_by_one(writer, establishment):
+    writer.submit(pending('whatsapp:+258840000001', establishment.id))
+    # Sem estabelecimento: viola o NOT NULL e faz falhar o lote inteiro
+    writer.submit(pending('whatsapp:+258840000002', None))
+    writer.submit(pending('whatsapp:+258840000003', establishment.id))
+    writer.shutdown(timeout=5)
+
+    assert writer.stats()['written'] == 2
+    assert writer.stats()['failed'] == 1
+    assert Order.query.count() == 2
+
+
+def test_pickup_time_fits_order_column(writer, establishment):
+    import app as bot
+
+    cart = Cart()
+    cart.add(1, '1:1', 25.0, 2)
+    session = {'cart': cart, 'delivery_method': 'pickup', 'payment_method': 'emola',
+               'pickup_time': 'lá para as 18h30, depois de sair do trabalho, se der ' * 3}
+
+    orders = bot.pending_orders(session, 'whatsapp:+258840000001', None)
+
+    assert len(orders[0].delivery_time_preference) == Order.delivery_time_preference.type.length == 50
+    assert orders[0].delivery_fee == 0
+    assert orders[0].total_amount == 50.0
+
+    writer.submit(orders[0]._replace(establishment_id=establishment.id, lines=[PendingLine(1, 2, 25.0)]))
+    writer.shutdown(timeout=5)
+    assert Order.query.one().delivery_time_preference == orders[0].delivery_time_preference
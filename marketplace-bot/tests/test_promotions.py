@@ -0,0 +1,172 @@
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+from cart import Cart, CartLine
+from catalog_index import CatalogIndex
+from models import Promotion, db
+from promotions import NO_DISCOUNT, ActivePromotion, PromotionBook, PromotionEngine, _engines
+
+START = datetime(2024, 1, 1)
+END = datetime(2024, 2, 1)
+PRICES = {10: 200.0, 11: 50.0, 12: 30.0}
+
+
+def promotion(kind, value=None, required=None, free=None, minimum=None, title=None, id=1):
+    return ActivePromotion(SimpleNamespace(
+        id=id, establishment_id=1, title=title or kind, promotion_type=kind, discount_value=value,
+        required_product_id=required, free_product_id=free, minimum_order_value=minimum,
+        start_date=START, end_date=END
+    ))
+
+
+def evaluate(promotions, quantities):
+    lines = {product_id: CartLine(1, product_id, PRICES[product_id], quantity)
+             for product_id, quantity in quantities.items()}
+    subtotal = sum(line.subtotal for line in lines.values())
+    return PromotionBook(promotions).evaluate(lines, subtotal, PRICES.get)
+
+
+def test_percentage_on_product():
+    pricing = evaluate([promotion('percentage_discount', 10, required=10)], {10: 2, 11: 1})
+
+    assert pricing.discount == 40.0
+    assert pricing.discounts == [('percentage_discount', 40.0)]
+
+
+def test_fixed_discount_capped_at_line():
+    assert evaluate([promotion('fixed_discount', 80, required=11)], {11: 1}).discount == 50.0
+
+
+def test_buy_x_get_same_product_free():
+    # Leve 3, pague 2: em 7 unidades, 2 são grátis
+    assert evaluate([promotion('buy_x_get_y_free', 2, required=10)], {10: 7}).discount == 400.0
+
+
+def test_buy_x_get_other_product_free():
+    buy_two_get_drink = promotion('buy_x_get_y_free', 2, required=10, free=12)
+
+    assert evaluate([buy_two_get_drink], {10: 4, 12: 1}).discount == 30.0
+    assert evaluate([buy_two_get_drink], {10: 4, 12: 3}).discount == 60.0
+    assert evaluate([buy_two_get_drink], {10: 4}) is NO_DISCOUNT
+
+
+def test_free_item_discounted_or_added_as_gift():
+    free_drink = promotion('free_item', required=10, free=12)
+
+    in_cart = evaluate([free_drink], {10: 1, 12: 2})
+    assert in_cart.discount == 30.0
+    assert in_cart.gifts == []
+
+    gift = evaluate([free_drink], {10: 1})
+    assert gift.discount == 0
+    assert gift.gifts == [(12, 1)]
+
+
+def test_minimum_order_value():
+    ten_percent = promotion('percentage_discount', 10, minimum=500)
+
+    assert evaluate([ten_percent], {10: 2}) is NO_DISCOUNT
+    assert evaluate([ten_percent], {10: 3}).discount == 60.0
+
+
+def test_only_best_order_level_promotion():
+    pricing = evaluate([
+        promotion('percentage_discount', 10, title='10%'),
+        promotion('fixed_discount', 50, title='50 MT'),
+        promotion('fixed_discount', 20, required=11, title='Batata')
+    ], {10: 2, 11: 1})
+
+    assert pricing.discounts == [('Batata', 20.0), ('50 MT', 50.0)]
+    assert pricing.discount == 70.0
+
+
+def test_discount_capped_at_subtotal():
+    pricing = evaluate([promotion('fixed_discount', 500), promotion('fixed_discount', 40, required=11)], {11: 1})
+
+    assert pricing.discount == 50.0
+
+
+class FakeClock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def engine(db_app):
+    clock = FakeClock(datetime(2024, 1, 10, 12))
+    engine = PromotionEngine(db_app, revalidate_interval=3600, clock=clock)
+    yield engine
+    _engines.remove(engine)
+
+
+def add_promotion(**fields):
+    values = dict(establishment_id=1, title='Promoção', promotion_type='percentage_discount',
+                  discount_value=10, start_date=START, end_date=END, is_active=True)
+    values.update(fields)
+    db.session.add(Promotion(**values))
+    db.session.commit()
+
+
+def menu_catalog():
+    return CatalogIndex({'restaurantes': [{'id': 1, 'nome': 'Tasca', 'menu': [
+        {'id': product_id, 'nome': f"Produto {product_id}", 'preco': price} for product_id, price in PRICES.items()
+    ]}]})
+
+
+def test_engine_loads_once_and_reuses_cart_pricing(engine):
+    add_promotion(title='10%')
+    cart = Cart()
+    cart.add(1, 10, 200.0, 2)
+    catalog = menu_catalog()
+
+    assert engine.price(cart, catalog).total == 360.0
+    priced = cart.priced[1]
+    assert engine.price(cart, catalog).discount == 40.0
+    assert cart.priced[1] is priced
+    assert engine.loads == 1
+
+    cart.add(1, 11, 50.0, 1)
+    assert engine.price(cart, catalog).discount == 45.0
+
+
+def test_engine_rebuilds_at_boundary_without_reloading(engine):
+    add_promotion(title='Almoço', promotion_type='fixed_discount', discount_value=25,
+                  start_date=datetime(2024, 1, 10, 13), end_date=datetime(2024, 1, 10, 15))
+    cart = Cart()
+    cart.add(1, 10, 200.0, 1)
+    catalog = menu_catalog()
+
+    assert engine.price(cart, catalog).discount == 0
+    engine.clock.now = datetime(2024, 1, 10, 13)
+    assert engine.price(cart, catalog).discount == 25.0
+    engine.clock.now = datetime(2024, 1, 10, 15)
+    assert engine.price(cart, catalog).discount == 0
+    assert engine.loads == 1
+    assert engine.rebuilds == 3
+
+
+def test_engine_reloads_after_commit(engine):
+    cart = Cart()
+    cart.add(1, 10, 200.0, 1)
+    catalog = menu_catalog()
+    assert engine.price(cart, catalog).discount == 0
+
+    add_promotion(title='Brinde', promotion_type='free_item', required_product_id=10, free_product_id=12)
+    pricing = engine.price(cart, catalog)
+
+    assert engine.loads == 2
+    assert pricing.gifts == [(1, 12, 1)]
+
+
+def test_engine_ignores_inactive_and_ended(engine):
+    add_promotion(is_active=False)
+    add_promotion(end_date=datetime(2024, 1, 5))
+    add_promotion(promotion_type='desconhecida')
+
+    assert engine.book(1) is None
+    assert engine.stats()['loaded'] == 0
@@ -0,0 +1,134 @@
+"""
+As consultas do dashboard devem usar índices.
+
+Cria uma base de dados SQLite pelas migrações, preenche-a com dados
+sintéticos e corre EXPLAIN QUERY PLAN em cada consulta: nenhuma pode
+percorrer uma tabela inteira (SCAN sem índice).
+"""
+import random
+from datetime import datetime, timedelta
+
+import pytest
+from flask import Flask
+from sqlalchemy import func
+
+from models import db, User, Subscription, Category, Establishment, Product, Order, OrderItem, Review, ChatFlow
+import db_migrations
+
+ESTABLISHMENT_COUNT = 200
+ORDER_COUNT = 20000
+
+OWNER_ID = 1
+
+
+def seed(establishment_count, order_count):
+    """
+    Insere os dados em massa (sem ORM) para o seed ser rápido
+    """
+    now = datetime.utcnow()
+    users = [{'id': i, 'name': f'user {i}', 'email': f'user{i}@example.com', 'password_hash': '!'}
+             for i in range(1, establishment_count + 1)]
+    db.session.execute(User.__table__.insert(), users)
+    db.session.execute(Subscription.__table__.insert(), [
+        {'user_id': user['id'], 'plan_type': 'HIGH', 'is_active': i % 5 != 0}
+        for i, user in enumerate(users)
+    ])
+    db.session.execute(Category.__table__.insert(), [{'id': i, 'name': f'categoria {i}'} for i in range(1, 11)])
+    db.session.execute(Establishment.__table__.insert(), [
+        {'id': i, 'owner_id': (i - 1) // 3 + 1, 'category_id': i % 10 + 1, 'name': f'loja {i}', 'menu_version': 0}
+        for i in range(1, establishment_count + 1)
+    ])
+    db.session.execute(Product.__table__.insert(), [
+        {'id': i, 'establishment_id': i % establishment_count + 1, 'name': f'produto {i}', 'price': 100.0,
+         'is_available': i % 7 != 0}
+        for i in range(1, establishment_count * 10 + 1)
+    ])
+    db.session.execute(Order.__table__.insert(), [
+        {'id': i, 'user_id': random.randint(1, establishment_count), 'establishment_id': random.randint(1, establishment_count),
+         'total_amount': 250.0, 'order_status': 'delivered', 'created_at': now - timedelta(minutes=i)}
+        for i in range(1, order_count + 1)
+    ])
+    db.session.execute(OrderItem.__table__.insert(), [
+        {'order_id': i, 'product_id': i % (establishment_count * 10) + 1, 'quantity': 1,
+         'price_at_time_of_order': 250.0, 'subtotal': 250.0}
+        for i in range(1, order_count + 1)
+    ])
+    db.session.execute(Review.__table__.insert(), [
+        {'user_id': 1, 'establishment_id': i % establishment_count + 1, 'rating': i % 5 + 1}
+        for i in range(order_count // 10)
+    ])
+    db.session.execute(ChatFlow.__table__.insert(), [
+        {'establishment_id': i % establishment_count + 1, 'name': f'fluxo {i}', 'flow_data': '{}'}
+        for i in range(establishment_count * 3)
+    ])
+    db.session.commit()
+    db.session.execute(db.text('ANALYZE'))
+
+
+def dashboard_queries():
+    """
+    As consultas quentes do dashboard, tal como dashboard_routes.py as monta
+    """
+    since = datetime.utcnow() - timedelta(days=30)
+    establishment_ids = [1, 2, 3]
+    return {
+        'assinatura ativa': Subscription.query.filter_by(user_id=OWNER_ID, is_active=True),
+        'estabelecimentos do lojista': Establishment.query.filter_by(owner_id=OWNER_ID),
+        'estatísticas de 30 dias': db.session.query(
+            func.count(Order.id), func.sum(Order.total_amount), func.count(func.distinct(Order.user_id))
+        ).join(Establishment, Order.establishment_id == Establishment.id).filter(
+            Establishment.owner_id == OWNER_ID, Order.created_at >= since
+        ),
+        'lista de pedidos': Order.query.filter(
+            Order.establishment_id.in_(establishment_ids)
+        ).order_by(Order.created_at.desc(), Order.id.desc()).limit(51),
+        'itens dos pedidos': OrderItem.query.filter(OrderItem.order_id.in_([1, 2, 3])),
+        'fluxos do estabelecimento': ChatFlow.query.filter_by(establishment_id=1),
+        'avaliações do estabelecimento': Review.query.filter_by(establishment_id=1),
+        'menu do bot': Product.query.filter_by(establishment_id=1, is_available=True).order_by(Product.id),
+    }
+
+
+def full_scans(query):
+    """
+    Retorna as linhas do plano que percorrem uma tabela sem índice
+    """
+    statement = query.statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True})
+    plan = db.session.execute(db.text(f'EXPLAIN QUERY PLAN {statement}')).fetchall()
+    return [row[-1] for row in plan if row[-1].startswith('SCAN') and 'INDEX' not in row[-1]]
+
+
+@pytest.fixture(scope='module')
+def seeded_app(tmp_path_factory):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{tmp_path_factory.mktemp('plans') / 'plans.db'}"
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    with app.app_context():
+        db_migrations.upgrade()
+        random.seed(1)
+        seed(ESTABLISHMENT_COUNT, ORDER_COUNT)
+        yield app
+        db.session.remove()
+        db.engine.dispose()
+
+
+QUERY_NAMES = [
+    'assinatura ativa',
+    'estabelecimentos do lojista',
+    'estatísticas de 30 dias',
+    'lista de pedidos',
+    'itens dos pedidos',
+    'fluxos do estabelecimento',
+    'avaliações do estabelecimento',
+    'menu do bot',
+]
+
+
+def test_every_dashboard_query_is_checked(seeded_app):
+    assert sorted(dashboard_queries()) == sorted(QUERY_NAMES)
+
+
+@pytest.mark.parametrize('name', QUERY_NAMES)
+def test_dashboard_query_uses_index(seeded_app, name):
+    assert full_scans(dashboard_queries()[name]) == []
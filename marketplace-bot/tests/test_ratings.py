@@ -0,0 +1,92 @@
+import pytest
+
+import ratings
+from models import Category, Establishment, Review, db
+
+
+def counters(establishment_id):
+    db.session.expire_all()
+    establishment = db.session.get(Establishment, establishment_id)
+    return establishment.rating_count, establishment.rating_sum, establishment.average_rating
+
+
+@pytest.fixture
+def review(establishment):
+    review = Review(user_id=establishment.owner_id, establishment_id=establishment.id, rating=4)
+    db.session.add(review)
+    db.session.commit()
+    return review
+
+
+def test_insert_counts_only_approved(establishment):
+    db.session.add_all([
+        Review(user_id=establishment.owner_id, establishment_id=establishment.id, rating=4),
+        Review(user_id=establishment.owner_id, establishment_id=establishment.id, rating=5),
+        Review(user_id=establishment.owner_id, establishment_id=establishment.id, rating=1,
+               review_status='pending_approval')
+    ])
+    db.session.commit()
+
+    assert counters(establishment.id) == (2, 9, 4.5)
+
+
+def test_update_after_commit(review):
+    # O commit expirou a avaliação: a nota antiga tem de vir da base de dados
+    review.rating = 2
+    db.session.commit()
+    assert counters(review.establishment_id) == (1, 2, 2.0)
+
+    review.review_status = 'rejected'
+    db.session.commit()
+    assert counters(review.establishment_id) == (0, 0, 0.0)
+
+    review.review_status = 'approved'
+    db.session.commit()
+    assert counters(review.establishment_id) == (1, 2, 2.0)
+
+
+def test_delete_after_commit(review):
+    establishment_id = review.establishment_id
+    db.session.add(Review(user_id=review.user_id, establishment_id=establishment_id, rating=2))
+    db.session.commit()
+
+    db.session.delete(review)
+    db.session.commit()
+
+    assert counters(establishment_id) == (1, 2, 2.0)
+
+
+def test_move_to_another_establishment(review, establishment):
+    other = Establishment(owner_id=establishment.owner_id, category=Category(name='Bares'), name='Bar')
+    db.session.add(other)
+    db.session.commit()
+
+    review.establishment_id = other.id
+    db.session.commit()
+
+    assert counters(establishment.id) == (0, 0, 0.0)
+    assert counters(other.id) == (1, 4, 4.0)
+
+
+def test_changes_mark_catalog(review):
+    review.rating = 5
+    db.session.flush()
+
+    assert review.establishment_id in db.session.info['catalog_changed_establishments']
+    db.session.commit()
+
+
+def test_repair_ratings(review, establishment):
+    db.session.add(Review(user_id=review.user_id, establishment_id=establishment.id, rating=5))
+    db.session.commit()
+    assert counters(establishment.id) == (2, 9, 4.5)
+
+    with db.engine.begin() as connection:
+        assert ratings.repair_ratings(connection) == 0
+        # Só a média está errada (p.ex. editada à mão)
+        connection.execute(Establishment.__table__.update().values(average_rating=1.0))
+        assert ratings.repair_ratings(connection) == 1
+        connection.execute(Establishment.__table__.update().values(rating_count=7, rating_sum=3))
+        assert ratings.repair_ratings(connection) == 1
+
+    assert counters(establishment.id) == (2, 9, 4.5)
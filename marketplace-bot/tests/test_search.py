@@ -0,0 +1,140 @@
+from catalog_index import CatalogIndex
+from search import SearchIndex, fold, search_tokens, trigrams
+
+
+def catalog_data(pizza_menu=None):
+    return {
+        'pizzarias': [
+            {'id': 1, 'nome': 'Pizza Boa', 'menu': pizza_menu or [
+                {'nome': 'Calabresa', 'preco': 280.0, 'descricao': 'Molho, mozzarella e calabresa'},
+                {'nome': 'Margherita', 'preco': 250.0, 'descricao': 'Tomate, mozzarella e manjericão'},
+                {'nome': 'Frango com Catupiry', 'preco': 300.0, 'descricao': 'Frango desfiado'}
+            ]},
+            {'id': 2, 'nome': 'Forno a Lenha', 'menu': [
+                {'nome': 'Pão de Alho', 'preco': 90.0, 'descricao': 'Pão, alho e manteiga'},
+                {'nome': 'Pizza de Frango', 'preco': 320.0, 'descricao': 'Frango e milho'}
+            ]}
+        ],
+        'cafés': [
+            {'id': 3, 'nome': 'Café Central', 'menu': [
+                {'nome': 'Pastel de Nata', 'preco': 60.0, 'descricao': 'Massa folhada e creme'},
+                {'nome': 'Galão', 'preco': 70.0, 'descricao': 'Café com leite'}
+            ]}
+        ]
+    }
+
+
+class SpyCatalog(CatalogIndex):
+    """
+    Catálogo que regista os menus pedidos pelo índice
+    """
+
+    def __init__(self, data, version):
+        super().__init__(data, version=version)
+        self.loaded = []
+
+    def menus(self, establishment_ids):
+        self.loaded.append(sorted(establishment_ids))
+        return super().menus(establishment_ids)
+
+
+def test_tokens_and_trigrams():
+    assert fold('Galão Médio') == 'galao medio'
+    assert search_tokens('Pastéis de Nata') == ['pastei', 'de', 'nata']
+    assert trigrams('pao') == {' pa', 'pao', 'ao '}
+
+
+def test_accent_insensitive_bm25():
+    index = SearchIndex()
+    catalog = CatalogIndex(catalog_data(), version=1)
+
+    hits = index.search(catalog, 'quero um GALAO')
+
+    assert [(hit.establishment_id, hit.item_id) for hit in hits] == [(3, '3:2')]
+    assert hits[0].coverage == hits[0].name_coverage == 1.0
+    assert index.search(catalog, 'pão de alho')[0].item_id == '2:1'
+
+
+def test_name_weighs_more_than_description():
+    hits = SearchIndex().search(CatalogIndex(catalog_data(), version=1), 'frango')
+
+    # 'Frango' no nome ganha de 'Frango' só na descrição
+    assert {hit.item_id for hit in hits[:2]} == {'1:3', '2:2'}
+    assert all(hit.name_coverage == 1.0 for hit in hits[:2])
+
+
+def test_establishment_filter():
+    hits = SearchIndex().search(CatalogIndex(catalog_data(), version=1), 'frango', establishment_id=2)
+
+    assert [hit.item_id for hit in hits] == ['2:2']
+
+
+def test_trigram_fuzzy_fallback():
+    index = SearchIndex()
+    catalog = CatalogIndex(catalog_data(), version=1)
+
+    assert index.search(catalog, 'calabreza')[0].item_id == '1:1'
+    # Palavra incompleta
+    assert index.search(catalog, 'marg')[0].item_id == '1:2'
+    assert index.search(catalog, 'xyzw') == []
+    assert index.search(catalog, 'quero uma') == []
+
+
+def test_partial_coverage():
+    hit = SearchIndex().search(CatalogIndex(catalog_data(), version=1), 'margherita sem manjericão')[0]
+
+    assert hit.item_id == '1:2'
+    assert 0 < hit.name_coverage < hit.coverage < 1
+
+
+def test_incremental_rebuild():
+    index = SearchIndex()
+    first = SpyCatalog(catalog_data(), version=1)
+    index.search(first, 'pizza')
+    assert first.loaded == [[1, 2, 3]]
+    assert index.stats()['segments_rebuilt'] == 3
+
+    # Mesma versão: nada é reconstruído
+    index.search(first, 'calabresa')
+    assert first.loaded == [[1, 2, 3]]
+
+    # Só o menu da Pizza Boa mudou
+    second = SpyCatalog(catalog_data([{'nome': 'Quatro Queijos', 'preco': 330.0}]), version=2)
+    assert index.search(second, 'quatro queijos')[0].item_id == '1:1'
+    assert index.search(second, 'calabresa') == []
+    assert second.loaded == [[1]]
+    assert index.stats()['segments_rebuilt'] == 4
+
+
+def test_removed_establishment_leaves_index():
+    index = SearchIndex()
+    index.search(CatalogIndex(catalog_data(), version=1), 'nata')
+
+    data = catalog_data()
+    del data['cafés']
+    catalog = CatalogIndex(data, version=2)
+
+    assert index.search(catalog, 'nata') == []
+    assert index.stats()['establishments'] == 2
+    assert index.stats()['items'] == 5
+
+
+def test_chat_confirms_fuzzy_item():
+    import app as bot
+
+    phone_number = 'whatsapp:+258842000001'
+    for message in ['oi', 'categorias', '1', '1']:
+        bot.process_message(phone_number, message)
+
+    assert 'Você quis dizer Portuguesa?' in bot.process_message(phone_number, 'sem cebola')
+    assert 'Quantos Portuguesa' in bot.process_message(phone_number, 'sim')
+
+
+def test_chat_selects_misspelled_item_name():
+    import app as bot
+
+    phone_number = 'whatsapp:+258842000002'
+    for message in ['oi', 'categorias', '1', '1']:
+        bot.process_message(phone_number, message)
+
+    assert 'Quantos Pepperoni' in bot.process_message(phone_number, 'peperoni')
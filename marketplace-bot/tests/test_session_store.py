@@ -0,0 +1,67 @@
+import pytest
+
+from session_store import VERSION_KEY, MemorySessionStore, SessionConflict, SQLiteSessionStore
+
+
+def test_memory_store_evicts_least_recently_used():
+    store = MemorySessionStore(ttl_seconds=60, max_sessions=2)
+    store.save('a', {'state': 'initial'})
+    store.save('b', {'state': 'initial'})
+    store.get('a')
+    store.save('c', {'state': 'initial'})
+
+    assert store.get('b') is None
+    assert store.get('a') is not None
+    assert len(store) == 2
+
+
+def test_memory_store_expires_sessions():
+    store = MemorySessionStore(ttl_seconds=0)
+    store.save('a', {'state': 'initial'})
+
+    assert store.get('a') is None
+
+
+@pytest.fixture
+def sqlite_store(tmp_path):
+    return SQLiteSessionStore(str(tmp_path / 'sessions.db'), ttl_seconds=60)
+
+
+def test_sqlite_store_round_trip(sqlite_store):
+    sqlite_store.save('a', {'state': 'viewing_cart', 'cart': [[1, '1:1', 25.0, 2]]})
+
+    session = sqlite_store.get('a')
+
+    assert session['state'] == 'viewing_cart'
+    assert session['cart'] == [[1, '1:1', 25.0, 2]]
+    assert VERSION_KEY in session
+
+
+def test_sqlite_store_rejects_stale_save(sqlite_store):
+    sqlite_store.save('a', {'state': 'initial'})
+    first = sqlite_store.get('a')
+    second = sqlite_store.get('a')
+
+    second['state'] = 'showing_categories'
+    sqlite_store.save('a', second)
+    first['state'] = 'showing_menu'
+
+    with pytest.raises(SessionConflict):
+        sqlite_store.save('a', first)
+    assert sqlite_store.get('a')['state'] == 'showing_categories'
+
+
+def test_sqlite_store_same_session_saved_twice(sqlite_store):
+    session = {'state': 'initial'}
+    sqlite_store.save('a', session)
+    session['state'] = 'showing_categories'
+    sqlite_store.save('a', session)
+
+    assert sqlite_store.get('a')['state'] == 'showing_categories'
+
+
+def test_sqlite_store_new_session_conflicts_with_existing(sqlite_store):
+    sqlite_store.save('a', {'state': 'showing_categories'})
+
+    with pytest.raises(SessionConflict):
+        sqlite_store.save('a', {'state': 'initial'})
@@ -0,0 +1,102 @@
+from datetime import datetime
+
+import pytest
+
+import stats_rollup
+from models import DailyEstablishmentStats, Order, db
+
+CREATED_AT = datetime(2024, 3, 5, 12, 30)
+
+
+def stats(establishment_id, day=CREATED_AT.date()):
+    """
+    (pedidos, receita, cancelados, receita cancelada, entregas, retiradas) do dia
+    """
+    row = DailyEstablishmentStats.query.filter_by(establishment_id=establishment_id, day=day).one_or_none()
+    if row is None:
+        return None
+    return (row.order_count, row.revenue, row.cancelled_count, row.cancelled_revenue,
+            row.delivery_count, row.pickup_count)
+
+
+@pytest.fixture
+def order(establishment):
+    order = Order(user_id=establishment.owner_id, establishment_id=establishment.id, total_amount=100.0,
+                  order_status='pending_payment', delivery_type='delivery', created_at=CREATED_AT)
+    db.session.add(order)
+    db.session.commit()
+    return order
+
+
+def test_insert(order):
+    assert stats(order.establishment_id) == (1, 100.0, 0, 0.0, 1, 0)
+
+
+def test_update_after_commit(order):
+    # O commit expirou o pedido: o valor antigo tem de vir da base de dados
+    order.order_status = 'cancelled'
+    db.session.commit()
+    assert stats(order.establishment_id) == (1, 100.0, 1, 100.0, 1, 0)
+
+    order.total_amount = 150.0
+    order.delivery_type = 'pickup'
+    db.session.commit()
+    assert stats(order.establishment_id) == (1, 150.0, 1, 150.0, 0, 1)
+
+
+def test_update_moves_order_to_another_day(order):
+    order.created_at = datetime(2024, 3, 6, 9)
+    db.session.commit()
+
+    assert stats(order.establishment_id) == (0, 0.0, 0, 0.0, 0, 0)
+    assert stats(order.establishment_id, datetime(2024, 3, 6).date()) == (1, 100.0, 0, 0.0, 1, 0)
+
+
+def test_update_in_a_new_session(order, db_app):
+    establishment_id, order_id = order.establishment_id, order.id
+    db.session.remove()
+
+    db.session.get(Order, order_id).order_status = 'cancelled'
+    db.session.commit()
+
+    assert stats(establishment_id) == (1, 100.0, 1, 100.0, 1, 0)
+
+
+def test_delete_after_commit(order):
+    establishment_id = order.establishment_id
+    order.order_status = 'cancelled'
+    db.session.commit()
+
+    db.session.delete(order)
+    db.session.commit()
+
+    assert stats(establishment_id) == (0, 0.0, 0, 0.0, 0, 0)
+
+
+def test_rebuild_matches_incremental_rollup(establishment):
+    orders = []
+    for i in range(12):
+        orders.append(Order(user_id=establishment.owner_id, establishment_id=establishment.id,
+                            total_amount=10.0 * (i + 1), order_status='delivered',
+                            delivery_type='delivery' if i % 2 else 'pickup',
+                            created_at=datetime(2024, 3, 1 + i % 3, 10)))
+    db.session.add_all(orders)
+    db.session.commit()
+    for order in orders[::3]:
+        order.order_status = 'cancelled'
+    db.session.commit()
+    orders[1].total_amount = 999.0
+    orders[2].created_at = datetime(2024, 3, 9, 10)
+    db.session.commit()
+    db.session.delete(orders[4])
+    db.session.commit()
+
+    def snapshot():
+        # O rollup deixa a zeros as linhas dos dias que ficaram sem pedidos; a reconstrução não as cria
+        return sorted((row.day,) + stats(establishment.id, row.day) for row in DailyEstablishmentStats.query
+                      if any(stats(establishment.id, row.day)))
+
+    incremental = snapshot()
+    stats_rollup.rebuild_daily_stats()
+
+    assert snapshot() == incremental
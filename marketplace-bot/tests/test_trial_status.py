@@ -0,0 +1,82 @@
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+import dashboard_routes
+import entitlements
+from models import PlanType, Subscription, db
+
+
+@pytest.fixture
+def trial(establishment):
+    # Faltam 3 dias e 100 segundos: days_left passa a 2 daqui a 100 segundos
+    subscription = Subscription(user_id=establishment.owner_id, plan_type=PlanType.HIGH, is_trial=True,
+                                trial_end=datetime.utcnow() + timedelta(days=3, seconds=100))
+    db.session.add(subscription)
+    db.session.commit()
+    return subscription
+
+
+def test_status_and_cache_headers(dashboard_client, trial):
+    response = dashboard_client.get('/dashboard/api/trial-status')
+
+    assert response.status_code == 200
+    assert response.get_json() == {'is_trial': True, 'days_left': 3, 'trial_expired': False}
+    assert response.cache_control.private
+    # O max-age acaba na próxima descida de days_left
+    assert 95 <= response.cache_control.max_age <= 101
+    assert response.headers['ETag']
+    assert response.last_modified is not None
+
+
+def test_max_age_is_capped(dashboard_client, trial, monkeypatch):
+    monkeypatch.setattr(dashboard_routes, 'TRIAL_STATUS_MAX_AGE', 30)
+
+    assert dashboard_client.get('/dashboard/api/trial-status').cache_control.max_age == 30
+
+
+def test_etag_revalidation(dashboard_client, trial):
+    etag = dashboard_client.get('/dashboard/api/trial-status').headers['ETag']
+
+    response = dashboard_client.get('/dashboard/api/trial-status', headers={'If-None-Match': etag})
+
+    assert response.status_code == 304
+    assert response.data == b''
+
+
+def test_last_modified_revalidation(dashboard_client, trial):
+    last_modified = dashboard_client.get('/dashboard/api/trial-status').headers['Last-Modified']
+
+    response = dashboard_client.get('/dashboard/api/trial-status', headers={'If-Modified-Since': last_modified})
+
+    assert response.status_code == 304
+
+
+def test_etag_changes_with_status(dashboard_client, trial):
+    etag = dashboard_client.get('/dashboard/api/trial-status').headers['ETag']
+    trial.is_trial = False
+    db.session.commit()
+    entitlements.invalidate_entitlements(trial.user_id)
+
+    response = dashboard_client.get('/dashboard/api/trial-status', headers={'If-None-Match': etag})
+
+    assert response.status_code == 200
+    assert response.get_json() == {'is_trial': False, 'days_left': 0, 'trial_expired': False}
+
+
+def test_stream_disabled_by_default(dashboard_client, trial):
+    assert not dashboard_routes.TRIAL_STATUS_SSE
+    assert dashboard_client.get('/dashboard/api/trial-status/stream').status_code == 404
+
+
+def test_stream_sends_status(dashboard_client, trial, monkeypatch):
+    monkeypatch.setattr(dashboard_routes, 'TRIAL_STATUS_SSE', True)
+    monkeypatch.setattr(dashboard_routes, 'TRIAL_STATUS_STREAM_DURATION', 0.05)
+
+    response = dashboard_client.get('/dashboard/api/trial-status/stream')
+
+    assert response.mimetype == 'text/event-stream'
+    events = response.get_data(as_text=True).split('\n\n')
+    assert json.loads(events[0][len('data: '):]) == {'is_trial': True, 'days_left': 3, 'trial_expired': False}
+    assert events[-2] == 'retry: 1000'
@@ -0,0 +1,69 @@
+import xml.etree.ElementTree as ET
+
+import pytest
+
+import app as bot
+from sharded_executor import ShardedExecutor
+from webhook_pipeline import WebhookPipeline
+
+
+@pytest.fixture
+def client():
+    bot.app.config['TESTING'] = True
+    with bot.app.test_client() as client:
+        yield client
+
+
+def post(client, phone_number, body, **values):
+    response = client.post('/webhook', data=dict({'From': phone_number, 'To': 'whatsapp:+258840000000',
+                                                  'Body': body}, **values))
+    assert response.status_code == 200
+    return [message.text for message in ET.fromstring(response.data).iter('Message')]
+
+
+def test_sync_reply_is_twiml(client):
+    replies = post(client, 'whatsapp:+258841000001', 'oi')
+
+    assert len(replies) == 1
+    assert 'Bem-vindo' in replies[0]
+
+
+def test_sync_conversation_fills_cart(client):
+    phone_number = 'whatsapp:+258841000002'
+    for body in ['oi', 'categorias', '1', '1']:
+        post(client, phone_number, body)
+
+    assert 'Quantos Margherita' in post(client, phone_number, '1')[0]
+    reply = post(client, phone_number, '2')[0]
+
+    assert '2x Margherita - 50.0 MT' in reply
+    assert 'Total parcial: 50.0 MT' in reply
+    assert bot.session_store.get(phone_number)['state'] == 'asking_more_items'
+
+
+def test_cancel_is_global(client):
+    phone_number = 'whatsapp:+258841000003'
+    for body in ['oi', 'categorias', '1', '1', '1', '2']:
+        post(client, phone_number, body)
+    assert bot.session_store.get(phone_number).get('cart')
+
+    post(client, phone_number, 'cancelar')
+
+    assert not bot.session_store.get(phone_number).get('cart')
+
+
+def test_async_reply_goes_through_twilio(client, monkeypatch):
+    executor = ShardedExecutor(shards=2, max_queue=10)
+    monkeypatch.setattr(bot, 'webhook_pipeline', WebhookPipeline(bot.process_and_reply, executor))
+    phone_number = 'whatsapp:+258841000004'
+    bot.twilio_client.messages.clear()
+
+    # O webhook só confirma o recebimento; a resposta segue pela API REST
+    assert post(client, phone_number, 'oi') == []
+    assert post(client, phone_number, 'categorias') == []
+    executor.shutdown(timeout=10)
+
+    sent = bot.twilio_client.messages.sent_to(phone_number)
+    assert [message.from_ for message in sent] == ['whatsapp:+258840000000'] * 2
+    assert 'Bem-vindo' in sent[0].body
+    assert 'Pizzarias' in sent[1].body
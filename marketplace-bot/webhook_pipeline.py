@@ -0,0 +1,42 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookPipeline:
+    """
+    Processa as mensagens recebidas pelo webhook fora do pedido HTTP.
+
+    As mensagens são entregues ao executor por shards com o telefone como
+    chave: as de um mesmo usuário são processadas uma de cada vez e pela
+    ordem de chegada, enquanto usuários diferentes são atendidos em paralelo.
+    """
+
+    def __init__(self, handler, executor):
+        # handler(phone_number, message_text, media_url, reply_from, location)
+        self.handler = handler
+        self.executor = executor
+
+    def submit(self, phone_number, message_text, media_url=None, reply_from=None, location=None):
+        """
+        Enfileira a mensagem e retorna imediatamente.
+
+        Levanta ShardQueueFull se o shard do usuário estiver sobrecarregado.
+        """
+        future = self.executor.submit(
+            phone_number, self.handler, phone_number, message_text, media_url, reply_from, location
+        )
+        future.add_done_callback(self._log_failure)
+        return future
+
+    def pending(self):
+        """
+        Número de mensagens à espera de processamento
+        """
+        return self.executor.pending()
+
+    def _log_failure(self, future):
+        error = future.exception()
+        if error is not None:
+            logger.error(f"Erro no processamento assíncrono: {error}")
+